@@ -358,6 +358,9 @@ https://{{- required "host is required" .Values.host -}}:{{- .Values.port -}}
 -
     name: INFRABOX_OPA_PUSH_INTERVAL
     value: "30"
+-
+    name: INFRABOX_OPA_CACHE_TTL
+    value: "10"
 {{ end }}
 
 {{ define "env_general" }}
@@ -0,0 +1,34 @@
+import unittest
+
+from api import server
+
+class SocketIOTest(unittest.TestCase):
+
+    def join_and_leave(self, manager):
+        manager.enter_room('sid1', '/', 'room1')
+        self.assertTrue(manager.has_clients('room1'))
+
+        manager.leave_room('sid1', '/', 'room1')
+
+    def test_client_manager(self):
+        manager = server.ClientManager()
+        self.join_and_leave(manager)
+        self.assertFalse(manager.has_clients('room1'))
+
+    def test_redis_client_manager(self):
+        try:
+            import redis #pylint: disable=unused-variable
+        except ImportError:
+            raise unittest.SkipTest('redis is not installed')
+
+        manager = server.RedisClientManager('redis://localhost:6379/0')
+        self.join_and_leave(manager)
+
+    def test_kombu_client_manager(self):
+        try:
+            import kombu #pylint: disable=unused-variable
+        except ImportError:
+            raise unittest.SkipTest('kombu is not installed')
+
+        manager = server.KombuClientManager('memory://')
+        self.join_and_leave(manager)
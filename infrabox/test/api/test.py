@@ -12,6 +12,7 @@ from tokens_test import TokensTest
 from secrets_test import SecretsTest
 from collaborators_test import CollaboratorsTest
 from user_test import UserTest
+from socketio_test import SocketIOTest
 
 from pyinfraboxutils.storage import storage
 
@@ -31,6 +32,7 @@ if __name__ == '__main__':
         suite.addTest(unittest.TestLoader().loadTestsFromTestCase(TokensTest))
         suite.addTest(unittest.TestLoader().loadTestsFromTestCase(SecretsTest))
         suite.addTest(unittest.TestLoader().loadTestsFromTestCase(UserTest))
+        suite.addTest(unittest.TestLoader().loadTestsFromTestCase(SocketIOTest))
 
         testRunner = XMLTestRunner(output=output)
         #unittest.main(testRunner = XMLTestRunner(output=output),
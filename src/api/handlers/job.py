@@ -1,10 +1,10 @@
 #pylint: disable=unused-argument
-from flask import g, jsonify, abort, send_file
+from flask import g, jsonify, abort
 from flask_restplus import Resource, fields
 
 from pyinfraboxutils.ibflask import check_job_belongs_to_project
 from pyinfraboxutils.ibrestplus import api
-from pyinfraboxutils.storage import storage
+from pyinfraboxutils.storage import storage, send_object
 
 ns = api.namespace('Jobs',
                    path='/api/v1/projects/<project_id>/jobs/<job_id>',
@@ -73,12 +73,12 @@ class Output(Resource):
         g.release_db()
 
         key = '%s.tar.snappy' % job_id
-        f = storage.download_output(key)
+        f = storage.open_output(key)
 
         if not f:
             abort(404)
 
-        return send_file(f, attachment_filename=key)
+        return send_object(f, attachment_filename=key)
 
 @ns.route('/manifest', doc=False)
 @api.doc(responses={403: 'Not Authorized'})
@@ -1,15 +1,22 @@
 #pylint: disable=too-many-lines,too-few-public-methods,too-many-locals,too-many-statements,too-many-branches
 import os
+import re
 import json
 import uuid
 import copy
+import zlib
 import urllib
+import time
 import random
+import hashlib
+import threading
+from io import BytesIO
 from datetime import datetime
 
 import requests
+from past.builtins import basestring
 
-from flask import jsonify, request, send_file, g, after_this_request, abort
+from flask import jsonify, request, g, after_this_request, abort
 from flask_restplus import Resource
 
 from werkzeug.datastructures import FileStorage
@@ -17,15 +24,16 @@ from werkzeug.datastructures import FileStorage
 from pyinfrabox.utils import validate_uuid
 from pyinfrabox.badge import validate_badge
 from pyinfrabox.markup import validate_markup
-from pyinfrabox.testresult import validate_result
+from pyinfrabox.testresult import validate_result, validate_header, validate_test
 from pyinfrabox import ValidationError
 
 from pyinfraboxutils.token import encode_job_token
 from pyinfraboxutils.ibrestplus import api
-from pyinfraboxutils.ibflask import app
-from pyinfraboxutils.storage import storage
+from pyinfraboxutils.ibflask import app, invalidate_job_token
+from pyinfraboxutils.storage import storage, send_object
 from pyinfraboxutils.secrets import decrypt_secret
 from pyinfraboxutils import get_root_url
+from pyinfraboxutils import dbpool
 
 def allowed_file(filename, extensions):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in extensions
@@ -44,39 +52,61 @@ class Job(Resource):
         job_id = g.token['job']['id']
         data = {}
 
-        # get all the job details
-        r = g.db.execute_one('''
+        # get all the job details in one query
+        r = g.db.execute_one_dict('''
+            WITH RECURSIVE next_job(id, parent) AS (
+                    SELECT j.id, (p->>'job-id')::uuid parent
+                    FROM job j, jsonb_array_elements(j.dependencies) AS p
+                    WHERE j.id = %s
+                UNION
+                    SELECT j.id, (p->>'job-id')::uuid parent
+                    FROM job j
+                    LEFT JOIN LATERAL jsonb_array_elements(j.dependencies) AS p ON true,
+                    next_job nj WHERE j.id = nj.parent
+            ), dependency AS (
+                SELECT id, name, state, start_date, end_date, dependencies
+                FROM job WHERE id IN (SELECT distinct id FROM next_job WHERE id != %s)
+            )
             SELECT
                 j.name,
-                null,
                 j.dockerfile,
-                p.id,
-                p.type,
-                p.name,
-                b.id,
-                b.commit_id,
-                b.source_upload_id,
-                b.build_number,
-                u.github_api_token,
-                u.username,
-                null,
                 j.type,
-                null,
-                null,
                 j.repo,
-                null,
                 j.state,
-                null,
                 j.env_var,
                 j.env_var_ref,
-                null,
-                null,
-                u.id,
                 j.build_arg,
                 j.deployment,
-                null,
+                j.definition,
+                p.id project_id,
+                p.type project_type,
+                p.name project_name,
+                b.id build_id,
+                b.commit_id,
+                b.source_upload_id,
+                b.build_number,
                 b.restart_counter,
-                j.definition
+                u.github_api_token,
+                u.username,
+                r.clone_url,
+                r.name repository_name,
+                r.private,
+                c.branch,
+                c.committer_name,
+                c.tag,
+                c.pull_request_id,
+                su.filename,
+                (SELECT json_agg(json_build_object('id', d.id, 'name', d.name, 'state', d.state,
+                                                   'depends_on', d.dependencies) ORDER BY d.id)
+                 FROM dependency d) dependencies,
+                ARRAY(SELECT d.start_date FROM dependency d ORDER BY d.id) dependency_start_dates,
+                ARRAY(SELECT d.end_date FROM dependency d ORDER BY d.id) dependency_end_dates,
+                (SELECT json_agg(json_build_object('id', pj.id, 'name', pj.name))
+                 FROM job pj
+                 WHERE pj.id IN (SELECT (deps->>'job-id')::uuid FROM jsonb_array_elements(j.dependencies) as deps)) parents,
+                (SELECT json_agg(json_build_object('name', s.name, 'value', s.value))
+                 FROM secret s
+                 WHERE s.project_id = j.project_id) secrets
             FROM job j
             INNER JOIN build b
                 ON j.build_id = b.id
@@ -88,11 +118,18 @@ class Job(Resource):
                 ON co.user_id = u.id
             INNER JOIN project p
                 ON co.project_id = p.id
+            LEFT OUTER JOIN repository r
+                ON r.project_id = p.id
+            LEFT OUTER JOIN commit c
+                ON c.id = b.commit_id
+                AND c.project_id = p.id
+            LEFT OUTER JOIN source_upload su
+                ON su.id = b.source_upload_id
             WHERE j.id = %s
-        ''', [job_id])
+        ''', [job_id, job_id, job_id])
 
         limits = {}
-        definition = r[29]
+        definition = r['definition']
         build_only = True
 
         if definition:
@@ -101,44 +138,44 @@ class Job(Resource):
 
         data['job'] = {
             "id": job_id,
-            "name": r[0],
-            "dockerfile": r[2],
+            "name": r['name'],
+            "dockerfile": r['dockerfile'],
             "build_only": build_only,
-            "type": r[13],
-            "repo": r[16],
-            "state": r[18],
+            "type": r['type'],
+            "repo": r['repo'],
+            "state": r['state'],
             "cpu": limits.get('cpu', 1),
             "memory": limits.get('memory', 1024),
-            "build_arguments": r[25],
-            "definition": r[29]
+            "build_arguments": r['build_arg'],
+            "definition": r['definition']
         }
 
         state = data['job']['state']
         if state in ("finished", "error", "failure", "skipped", "killed"):
             abort(409, 'job not running anymore')
 
-        env_vars = r[20]
-        env_var_refs = r[21]
-        deployments = r[26]
+        env_vars = r['env_var']
+        env_var_refs = r['env_var_ref']
+        deployments = r['deployment']
 
         data['project'] = {
-            "id": r[3],
-            "type": r[4],
-            "name": r[5],
+            "id": r['project_id'],
+            "type": r['project_type'],
+            "name": r['project_name'],
         }
 
         data['build'] = {
-            "id": r[6],
-            "commit_id": r[7],
-            "source_upload_id": r[8],
-            "build_number": r[9],
-            "restart_counter": r[28]
+            "id": r['build_id'],
+            "commit_id": r['commit_id'],
+            "source_upload_id": r['source_upload_id'],
+            "build_number": r['build_number'],
+            "restart_counter": r['restart_counter']
         }
 
         data['repository'] = {
-            "owner": r[11],
+            "owner": r['username'],
             "name": None,
-            "github_api_token": r[10],
+            "github_api_token": r['github_api_token'],
             "private": False
         }
 
@@ -149,92 +186,46 @@ class Job(Resource):
 
         pull_request_id = None
         if data['project']['type'] == 'github' or data['project']['type'] == 'gerrit':
-            r = g.db.execute_one('''
-                SELECT
-                    r.clone_url, r.name, r.private
-                FROM repository r
-                WHERE r.project_id = %s
-            ''', [data['project']['id']])
-
-            data['repository']['clone_url'] = r[0]
-            data['repository']['name'] = r[1]
-            data['repository']['private'] = r[2]
+            data['repository']['clone_url'] = r['clone_url']
+            data['repository']['name'] = r['repository_name']
+            data['repository']['private'] = r['private']
 
             # A regular commit
-            r = g.db.execute_one('''
-                SELECT
-                    c.branch, c.committer_name, c.tag, c.pull_request_id
-                FROM commit c
-                WHERE c.id = %s
-                    AND c.project_id = %s
-            ''', [data['build']['commit_id'], data['project']['id']])
-
             data['commit'] = {
                 "id": data['build']['commit_id'],
-                "branch": r[0],
-                "committer_name": r[1],
-                "tag": r[2]
+                "branch": r['branch'],
+                "committer_name": r['committer_name'],
+                "tag": r['tag']
             }
-            pull_request_id = r[3]
+            pull_request_id = r['pull_request_id']
 
         if data['project']['type'] == 'upload':
-            r = g.db.execute_one('''
-                SELECT filename FROM source_upload
-                WHERE id = %s
-            ''', [data['build']['source_upload_id']])
-
             data['source_upload'] = {
-                "filename": r[0]
+                "filename": r['filename']
             }
 
         # get dependencies
-        r = g.db.execute_many('''
-              WITH RECURSIVE next_job(id, parent) AS (
-                      SELECT j.id, (p->>'job-id')::uuid parent
-                      FROM job j, jsonb_array_elements(j.dependencies) AS p
-                      WHERE j.id = %s
-                  UNION
-                      SELECT j.id, (p->>'job-id')::uuid parent
-                      FROM job j
-                      LEFT JOIN LATERAL jsonb_array_elements(j.dependencies) AS p ON true,
-                      next_job nj WHERE j.id = nj.parent
-              )
-              SELECT id, name, state, start_date, end_date, dependencies
-              FROM job WHERE id IN (SELECT distinct id FROM next_job WHERE id != %s)
-        ''', [data['job']['id'], data['job']['id']])
-
         data['dependencies'] = []
 
-        for d in r:
+        dependencies = zip(r['dependencies'] or [],
+                           r['dependency_start_dates'],
+                           r['dependency_end_dates'])
+
+        for d, start_date, end_date in dependencies:
             data['dependencies'].append({
-                "id": d[0],
-                "name": d[1],
-                "state": d[2],
-                "start_date": str(d[3]),
-                "end_date": str(d[4]),
-                "depends_on": d[5]
+                "id": d['id'],
+                "name": d['name'],
+                "state": d['state'],
+                "start_date": str(start_date),
+                "end_date": str(end_date),
+                "depends_on": d['depends_on']
             })
 
         # get parents
-        r = g.db.execute_many('''
-          SELECT id, name FROM job where id
-              IN (SELECT (deps->>'job-id')::uuid FROM job, jsonb_array_elements(job.dependencies) as deps WHERE id = %s)
-        ''', [data['job']['id']])
-
-        data['parents'] = []
-
-        for d in r:
-            data['parents'].append({
-                "id": d[0],
-                "name": d[1]
-            })
+        data['parents'] = r['parents'] or []
 
         # get the secrets
-        secrets = g.db.execute_many('''
-             SELECT name, value
-             FROM secret
-             WHERE project_id = %s
-        ''', [data['project']['id']])
+        secrets = [(e['name'], e['value']) for e in r['secrets'] or []]
 
         is_fork = data['job'].get('fork', False)
         def get_secret(name):
@@ -418,12 +409,16 @@ class Source(Resource):
 
         g.release_db()
 
-        f = storage.download_source(filename)
+        f = storage.open_source(filename)
 
         if not f:
             abort(404)
 
-        return send_file(f)
+        return send_object(f)
+
+def get_cache_key(project_id, job_name, extension):
+    key = 'project_%s_job_%s.%s' % (project_id, job_name, extension)
+    return key.replace('/', '_')
 
 cache_upload_parser = api.parser()
 cache_upload_parser.add_argument('cache.tar.snappy', location='files',
@@ -436,34 +431,158 @@ class Cache(Resource):
     def get(self):
         project_id = g.token['project']['id']
         job_name = g.token['job']['name']
-
-        template = 'project_%s_job_%s.tar.snappy'
-        key = template % (project_id, job_name)
-        key = key.replace('/', '_')
+        key = get_cache_key(project_id, job_name, 'tar.snappy')
 
         g.release_db()
 
-        f = storage.download_cache(key)
+        f = storage.open_cache(key)
 
         if not f:
             abort(404)
 
-        return send_file(f)
+        return send_object(f)
 
     @api.expect(cache_upload_parser)
     def post(self):
         project_id = g.token['project']['id']
         job_name = g.token['job']['name']
-
-        template = 'project_%s_job_%s.tar.snappy'
-        key = template % (project_id, job_name)
-        key = key.replace('/', '_')
+        key = get_cache_key(project_id, job_name, 'tar.snappy')
 
         g.release_db()
 
         storage.upload_cache(request.files['cache.tar.snappy'].stream, key)
         return jsonify({})
 
+# Maximum size of a cache chunk, must be the same as in the job
+CACHE_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Max number of chunks which are checked at once
+CACHE_CHUNKS_PER_REQUEST = 1000
+
+def get_cache_chunk_key(project_id, chunk):
+    # Chunks are shared by all jobs of a project
+    return 'project_%s_chunk_%s' % (project_id, chunk)
+
+def validate_cache_chunk(chunk):
+    return isinstance(chunk, basestring) and re.match(r'^[0-9a-f]{64}$', chunk) is not None
+
+@api.route("/api/job/cache/manifest", doc=False)
+class CacheManifest(Resource):
+
+    def get(self):
+        project_id = g.token['project']['id']
+        job_name = g.token['job']['name']
+        key = get_cache_key(project_id, job_name, 'manifest.json')
+
+        g.release_db()
+
+        f = storage.open_cache(key)
+
+        if not f:
+            abort(404)
+
+        return send_object(f)
+
+    def post(self):
+        project_id = g.token['project']['id']
+        job_name = g.token['job']['name']
+        key = get_cache_key(project_id, job_name, 'manifest.json')
+
+        g.release_db()
+
+        manifest = request.get_json(silent=True)
+
+        if not isinstance(manifest, dict) or manifest.get('version', None) != 1 or \
+           not isinstance(manifest.get('entries', None), list):
+            abort(400, "Invalid manifest")
+
+        storage.upload_cache(BytesIO(request.get_data()), key)
+
+        # The cache has been converted to the manifest format
+        storage.delete_cache(get_cache_key(project_id, job_name, 'tar.snappy'))
+        return jsonify({})
+
+@api.route("/api/job/cache/chunks", doc=False)
+class CacheChunks(Resource):
+
+    def post(self):
+        # Returns the chunks which are not yet stored for the project. The
+        # others are marked as used, so the gc doesn't delete them.
+        project_id = g.token['project']['id']
+
+        chunks = (request.get_json(silent=True) or {}).get('chunks', None)
+
+        if not isinstance(chunks, list) or len(chunks) > CACHE_CHUNKS_PER_REQUEST:
+            abort(400, "Invalid chunks")
+
+        for c in chunks:
+            if not validate_cache_chunk(c):
+                abort(400, "Invalid chunk")
+
+        stored = g.db.execute_many('''
+            UPDATE cache_chunk SET last_used = now()
+            WHERE project_id = %s
+            AND chunk = ANY(%s)
+            RETURNING chunk
+        ''', [project_id, chunks])
+        g.db.commit()
+
+        stored = set(r[0] for r in stored)
+        return jsonify({'missing': [c for c in chunks if c not in stored]})
+
+@api.route("/api/job/cache/chunks/<chunk>", doc=False)
+class CacheChunk(Resource):
+
+    def get(self, chunk):
+        project_id = g.token['project']['id']
+
+        if not validate_cache_chunk(chunk):
+            abort(400, "Invalid chunk")
+
+        g.release_db()
+
+        f = storage.open_cache(get_cache_chunk_key(project_id, chunk))
+
+        if not f:
+            abort(404)
+
+        return send_object(f)
+
+    def post(self, chunk):
+        project_id = g.token['project']['id']
+
+        if not validate_cache_chunk(chunk) or 'chunk' not in request.files:
+            abort(400, "Invalid chunk")
+
+        g.release_db()
+
+        # Chunks are shared, so make sure the content matches the hash
+        data = request.files['chunk'].stream.read(2 * CACHE_CHUNK_SIZE + 1)
+
+        try:
+            d = zlib.decompressobj()
+            content = d.decompress(data, CACHE_CHUNK_SIZE + 1)
+        except zlib.error:
+            abort(400, "Invalid chunk")
+
+        if len(data) > 2 * CACHE_CHUNK_SIZE or len(content) > CACHE_CHUNK_SIZE or \
+           hashlib.sha256(content).hexdigest() != chunk:
+            abort(400, "Invalid chunk")
+
+        storage.upload_cache(BytesIO(data), get_cache_chunk_key(project_id, chunk))
+
+        db = dbpool.get()
+        try:
+            db.execute('''
+                INSERT INTO cache_chunk (project_id, chunk) VALUES (%s, %s)
+                ON CONFLICT (project_id, chunk) DO UPDATE SET last_used = now()
+            ''', [project_id, chunk])
+            db.commit()
+        finally:
+            dbpool.put(db)
+
+        return jsonify({})
+
 
 @api.route("/api/job/archive", doc=False)
 class Archive(Resource):
@@ -492,6 +611,47 @@ class Archive(Resource):
 
         return jsonify({"message": "File uploaded"})
 
+def get_output_clusters(job_id):
+    # Root urls of the other clusters with children of the job, they need a copy of the output
+    jobs = g.db.execute_many_dict('''
+        SELECT cluster_name, dependencies
+        FROM job
+        WHERE build_id = (SELECT build_id FROM job WHERE id = %s)
+        AND state = 'queued'
+    ''', [job_id])
+
+    current_cluster = g.db.execute_one_dict('''
+        SELECT cluster_name
+        FROM job
+        WHERE id = %s
+    ''', [job_id])['cluster_name']
+
+    clusters = set()
+
+    for j in jobs:
+        dependencies = j.get('dependencies', None)
+
+        if not dependencies:
+            continue
+
+        for dep in dependencies:
+            if dep['job-id'] != job_id:
+                continue
+
+            clusters.add(j['cluster_name'])
+
+    clusters = g.db.execute_many_dict('''
+        SELECT root_url
+        FROM cluster
+        WHERE active = true
+        AND enabled = true
+        AND name = ANY (%s)
+        AND name != %s
+        AND name != %s
+    ''', [list(clusters), os.environ['INFRABOX_CLUSTER_NAME'], current_cluster])
+
+    return [c['root_url'] for c in clusters]
+
 @api.route("/api/job/output", doc=False)
 class Output(Resource):
 
@@ -503,51 +663,15 @@ class Output(Resource):
 
             stream = request.files[f].stream
 
-            # determine all children
-            jobs = g.db.execute_many_dict('''
-                SELECT cluster_name, dependencies
-                FROM job
-                WHERE build_id = (SELECT build_id FROM job WHERE id = %s)
-                AND state = 'queued'
-            ''', [job_id])
-
-            current_cluster = g.db.execute_one_dict('''
-                SELECT cluster_name
-                FROM job
-                WHERE id = %s
-            ''', [job_id])['cluster_name']
-
-            clusters = set()
-
-            for j in jobs:
-                dependencies = j.get('dependencies', None)
-
-                if not dependencies:
-                    continue
-
-                for dep in dependencies:
-                    if dep['job-id'] != job_id:
-                        continue
-
-                    clusters.add(j['cluster_name'])
-
-            clusters = g.db.execute_many_dict('''
-                SELECT root_url
-                FROM cluster
-                WHERE active = true
-                AND enabled = true
-                AND name = ANY (%s)
-                AND name != %s
-                AND name != %s
-            ''', [list(clusters), os.environ['INFRABOX_CLUSTER_NAME'], current_cluster])
+            clusters = get_output_clusters(job_id)
 
             g.release_db()
 
             storage.upload_output(stream, key)
 
-            for c in clusters:
+            for root_url in clusters:
                 stream.seek(0)
-                url = '%s/api/job/output' % c['root_url']
+                url = '%s/api/job/output' % root_url
                 files = {f: stream}
                 token = encode_job_token(job_id)
                 headers = {'Authorization': 'bearer ' + token}
@@ -559,6 +683,108 @@ class Output(Resource):
 
             return jsonify({})
 
+# Size of the parts when copying an output to another cluster
+FORWARD_PART_SIZE = 32 * 1024 * 1024
+
+def forward_output(job_id, key, filename, root_url):
+    # Copy the output to another cluster as multipart upload, so it's never completely in memory
+    url = '%s/api/job/multipart/output' % root_url
+    token = encode_job_token(job_id)
+    headers = {'Authorization': 'bearer ' + token}
+    params = {'filename': filename}
+
+    r = requests.post(url + '/start', params=params, headers=headers, timeout=120, verify=False)
+    if r.status_code != 200:
+        app.logger.error(r.text)
+        abort(500, "Failed to upload data")
+
+    params['upload_id'] = r.json()['upload_id']
+
+    f = storage.open_output(key)
+    parts = []
+    for i, start in enumerate(range(0, f.size, FORWARD_PART_SIZE)):
+        end = min(start + FORWARD_PART_SIZE, f.size) - 1
+        data = b''.join(f.iter_range(start, end))
+
+        params['part'] = i + 1
+        r = requests.post(url + '/part', params=params, files={'part': data},
+                          headers=headers, timeout=120, verify=False)
+
+        if r.status_code != 200:
+            app.logger.error(r.text)
+            abort(500, "Failed to upload data")
+
+        parts.append(r.json())
+
+    del params['part']
+    r = requests.post(url + '/complete', params=params, json={'parts': parts},
+                      headers=headers, timeout=120, verify=False)
+
+    if r.status_code != 200:
+        app.logger.error(r.text)
+        abort(500, "Failed to upload data")
+
+@api.route("/api/job/multipart/<kind>/<action>", doc=False)
+class MultipartUpload(Resource):
+    # Uploads an output in parts, which may be uploaded
+    # in parallel and are committed together by 'complete'
+
+    def post(self, kind, action):
+        job_id = g.token['job']['id']
+
+        if kind == 'output':
+            filename = request.args.get('filename', None)
+
+            if not filename or '/' in filename:
+                abort(400, "Invalid filename")
+
+            key = "%s/%s" % (job_id, filename)
+        else:
+            abort(404)
+
+        clusters = []
+        if kind == 'output' and action == 'complete':
+            clusters = get_output_clusters(job_id)
+
+        g.release_db()
+
+        if action == 'start':
+            upload_id = storage.start_multipart_upload(kind, key)
+            return jsonify({'upload_id': upload_id})
+
+        upload_id = request.args.get('upload_id', None)
+
+        if not upload_id or not storage.validate_upload_id(upload_id):
+            abort(400, "Invalid upload_id")
+
+        if action == 'part':
+            try:
+                part = int(request.args.get('part', ''))
+            except ValueError:
+                abort(400, "Invalid part")
+
+            if part < 1 or part > 10000 or 'part' not in request.files:
+                abort(400, "Invalid part")
+
+            return jsonify(storage.upload_part(kind, key, upload_id, part, request.files['part'].stream))
+        elif action == 'complete':
+            parts = request.json.get('parts', None)
+
+            if not parts:
+                abort(400, "No parts")
+
+            storage.complete_multipart_upload(kind, key, upload_id, parts)
+
+            for root_url in clusters:
+                forward_output(job_id, key, filename, root_url)
+
+            return jsonify({})
+        elif action == 'abort':
+            storage.abort_multipart_upload(kind, key, upload_id)
+            return jsonify({})
+
+        abort(404)
+
 @api.route("/api/job/output/<parent_job_id>", doc=False)
 class OutputParent(Resource):
 
@@ -591,12 +817,15 @@ class OutputParent(Resource):
         key = "%s/%s" % (parent_job_id, filename)
 
         g.release_db()
-        f = storage.download_output(key)
+        f = storage.open_output(key)
 
         if not f:
             abort(404)
 
-        return send_file(f)
+        return send_object(f)
+
+# Max number of jobs created with one INSERT
+CREATE_JOBS_PER_INSERT = 500
 
 def find_leaf_jobs(jobs):
     parent_jobs = {}
@@ -693,7 +922,6 @@ class CreateJobs(Resource):
                 ON b.id = j.build_id
         """, [parent_job_id])
 
-        build_number = result[1]
         project_id = result[2]
 
         # name->id mapping
@@ -703,6 +931,32 @@ class CreateJobs(Resource):
             job_id = job['id']
             jobname_id[name] = job_id
 
+        # Average durations of the recent runs of the jobs
+        names = [job['name'] for job in jobs if job['type'] != "wait"]
+        avg_durations = dict(g.db.execute_many("""
+            SELECT name, avg_duration
+            FROM job_stats
+            WHERE project_id = %s
+            AND branch = ''
+            AND name = ANY(%s)
+        """, [project_id, names]))
+
+        # Secrets which are referenced by any job
+        secret_names = set()
+        for job in jobs:
+            if job['type'] == "wait":
+                continue
+
+            for value in job.get('environment', {}).values():
+                if isinstance(value, dict):
+                    secret_names.add(value['$secret'])
+
+        existing_secrets = set()
+        if secret_names:
+            existing_secrets = set(r[0] for r in g.db.execute_many("""
+                SELECT name FROM secret WHERE name = ANY(%s) and project_id = %s
+            """, [list(secret_names), project_id]))
+
         for job in jobs:
             job['env_var_refs'] = None
             job['env_vars'] = copy.deepcopy(base_env_var)
@@ -710,19 +964,7 @@ class CreateJobs(Resource):
             if job['type'] == "wait":
                 continue
 
-            avg_duration = g.db.execute_one("""
-                SELECT EXTRACT(EPOCH FROM avg(j.end_date - j.start_date))
-                FROM job j
-                INNER JOIN build b
-                    ON b.id = j.build_id
-                    AND j.project_id = %s
-                    AND b.project_id = %s
-                    AND b.build_number between %s and %s
-                    AND j.name = %s
-                    AND j.state = 'finished'
-            """, [project_id, project_id, build_number - 10, build_number, job['name']])[0]
-
-            job['avg_duration'] = avg_duration
+            job['avg_duration'] = avg_durations.get(job['name'], None)
 
             # Handle environment vars
             if 'environment' in job:
@@ -731,11 +973,8 @@ class CreateJobs(Resource):
 
                     if isinstance(value, dict):
                         env_var_ref_name = value['$secret']
-                        result = g.db.execute_many("""
-                                    SELECT value FROM secret WHERE name = %s and project_id = %s
-                                    """, [env_var_ref_name, project_id])
 
-                        if not result:
+                        if env_var_ref_name not in existing_secrets:
                             abort(400, "Secret '%s' not found" % env_var_ref_name)
 
                         if not job['env_var_refs']:
@@ -757,28 +996,31 @@ class CreateJobs(Resource):
 
             leaf_jobs = find_leaf_jobs(jobs)
 
-            for j in leaf_jobs:
-                wait_job = {
-                    'job': j['name'],
-                    'job-id': j['id'],
-                    'on': ['finished']
-                }
-
-                # Update direct children of this job to now wait for the leaf jobs
-                g.db.execute('''
-                    UPDATE job
-                    SET dependencies = dependencies || %s::jsonb
-                    WHERE id IN (
-                        SELECT id parent_id
-                        FROM job, jsonb_array_elements(job.dependencies) as deps
-                        WHERE (deps->>'job-id')::uuid = %s
-                            AND build_id = %s
-                            AND project_id = %s
-                    )
-                ''', [json.dumps(wait_job), job_id, build_id, project_id])
+            wait_jobs = [{
+                'job': j['name'],
+                'job-id': j['id'],
+                'on': ['finished']
+            } for j in leaf_jobs]
+
+            # Update direct children of this job to now wait for the leaf jobs
+            g.db.execute('''
+                UPDATE job
+                SET dependencies = dependencies || %s::jsonb
+                WHERE id IN (
+                    SELECT id parent_id
+                    FROM job, jsonb_array_elements(job.dependencies) as deps
+                    WHERE (deps->>'job-id')::uuid = %s
+                        AND build_id = %s
+                        AND project_id = %s
+                )
+            ''', [json.dumps(wait_jobs), job_id, build_id, project_id])
 
         self.assign_cluster(jobs)
 
+        created_at = datetime.now()
+        cursor = g.db.conn.cursor()
+        rows = []
+
         for job in jobs:
             name = job["name"]
 
@@ -838,25 +1080,166 @@ class CreateJobs(Resource):
                     if 'labels' not in s['metadata']:
                         s['metadata']['labels'] = {}
 
-            # Create job
-            g.db.execute("""
-                         INSERT INTO job (id, state, build_id, type, dockerfile, name,
-                             project_id, dependencies,
-                             created_at, repo,
-                             env_var_ref, env_var, build_arg, deployment,
-                             definition, cluster_name)
-                         VALUES (%s, 'queued', %s, %s, %s, %s, %s, %s, %s, %s,
-                                 %s, %s, %s, %s, %s, %s);
-                         """, [job_id, build_id, t, f, name,
-                               project_id,
-                               json.dumps(depends_on), datetime.now(),
-                               repo, env_var_refs, env_vars,
-                               build_arguments, deployments,
-                               json.dumps(job), job['cluster']['name']])
-
+            rows.append(cursor.mogrify("""
+                (%s, 'queued', %s, %s, %s, %s, %s, %s, %s, %s,
+                 %s, %s, %s, %s, %s, %s)
+            """, [job_id, build_id, t, f, name,
+                  project_id,
+                  json.dumps(depends_on), created_at,
+                  repo, env_var_refs, env_vars,
+                  build_arguments, deployments,
+                  json.dumps(job), job['cluster']['name']]))
+
+        # Create the jobs with a few statements, not one per job
+        for i in range(0, len(rows), CREATE_JOBS_PER_INSERT):
+            cursor.execute("""
+                INSERT INTO job (id, state, build_id, type, dockerfile, name,
+                    project_id, dependencies,
+                    created_at, repo,
+                    env_var_ref, env_var, build_arg, deployment,
+                    definition, cluster_name)
+                VALUES %s
+            """ % ','.join(rows[i:i + CREATE_JOBS_PER_INSERT]))
+
+        cursor.close()
         g.db.commit()
         return "Successfully create jobs"
 
+# Limits of the console output of a job
+CONSOLE_MAX_SIZE = 16 * 1024 * 1024
+CONSOLE_MAX_UPDATES = 4000
+
+# Time to wait for more console updates which are then written together
+CONSOLE_BATCH_WINDOW = 0.05
+
+class ConsoleWriter(object):
+    # Writes the console updates of all jobs together in one transaction.
+    # A request only returns once its update has been committed, so the
+    # updates of a job are still written in the order they were sent.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.pending = []
+        self.thread = None
+
+    def write(self, job_id, output):
+        # Returns an error message if the update has been rejected,
+        # raises the exception of the flush if it could not be written
+        update = {
+            'job_id': job_id,
+            'output': output,
+            'done': threading.Event(),
+            'error': None,
+            'exception': None
+        }
+
+        with self.lock:
+            self.pending.append(update)
+
+            if not self.thread:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+
+        self.ready.set()
+        update['done'].wait()
+
+        if update['exception']:
+            raise update['exception']
+
+        return update['error']
+
+    def run(self):
+        while True:
+            self.ready.wait()
+            time.sleep(CONSOLE_BATCH_WINDOW)
+
+            with self.lock:
+                updates = self.pending
+                self.pending = []
+                self.ready.clear()
+
+            try:
+                self.flush(updates)
+            except Exception as e:
+                app.logger.exception(e)
+
+                # The output has not been written, the job has to send it again
+                for u in updates:
+                    u['exception'] = e
+            finally:
+                for u in updates:
+                    u['done'].set()
+
+    def flush(self, updates):
+        if not updates:
+            return
+
+        totals = {}
+        for u in updates:
+            t = totals.setdefault(u['job_id'], [0, 0])
+            t[0] += len(u['output'])
+            t[1] += 1
+
+        db = dbpool.get()
+        try:
+            cursor = db.conn.cursor()
+
+            # Sorted, so concurrent flushes always lock the rows in the same order
+            values = ','.join(cursor.mogrify('(%s, %s, %s)', (job_id, t[0], t[1]))
+                              for job_id, t in sorted(totals.items()))
+            cursor.execute("""
+                INSERT INTO console_stats (job_id, size, updates) VALUES %s
+                ON CONFLICT (job_id) DO UPDATE
+                SET size = console_stats.size + EXCLUDED.size,
+                    updates = console_stats.updates + EXCLUDED.updates
+                RETURNING job_id, size, updates
+            """ % values)
+
+            # Size and number of updates of the jobs before this batch
+            stats = {}
+            for job_id, size, count in cursor.fetchall():
+                t = totals[str(job_id)]
+                stats[str(job_id)] = [size - t[0], count - t[1]]
+
+            rows = []
+            started = []
+            for u in updates:
+                s = stats[u['job_id']]
+
+                if s[0] > CONSOLE_MAX_SIZE:
+                    u['error'] = "Console output too big"
+                elif s[1] > CONSOLE_MAX_UPDATES:
+                    u['error'] = "Too many console updates"
+                else:
+                    if s[1] == 0:
+                        started.append(u['job_id'])
+
+                    # All rows get the same now(), so the offset keeps them in order
+                    rows.append(cursor.mogrify("(%s, %s, now() + %s * interval '1 microsecond')",
+                                               (u['job_id'], u['output'], len(rows))))
+
+                s[0] += len(u['output'])
+                s[1] += 1
+
+            if rows:
+                cursor.execute("INSERT INTO console (job_id, output, date) VALUES %s" % ','.join(rows))
+
+            if started:
+                cursor.execute("""
+                    UPDATE job SET state = 'running', start_date = current_timestamp
+                    WHERE id = ANY(%s::uuid[]) and state = 'scheduled'""", [started])
+
+            cursor.close()
+            db.commit()
+        finally:
+            dbpool.put(db)
+
+        for job_id in started:
+            invalidate_job_token(job_id)
+
+console_writer = ConsoleWriter()
+
 @api.route("/api/job/consoleupdate", doc=False)
 class ConsoleUpdate(Resource):
 
@@ -865,30 +1248,12 @@ class ConsoleUpdate(Resource):
 
         job_id = g.token['job']['id']
 
-        r = g.db.execute_one("""
-            SELECT sum(char_length(output)), count(*) FROM console WHERE job_id = %s
-        """, [job_id])
-
-        if not r:
-            abort(404, "Not found")
-
-        console_output_len = r[0]
-        console_output_updates = r[1]
-
-        if console_output_len > 16 * 1024 * 1024:
-            abort(400, "Console output too big")
+        g.release_db()
 
-        if console_output_updates > 4000:
-            abort(400, "Too many console updates")
+        error = console_writer.write(job_id, output)
 
-        try:
-            g.db.execute("INSERT INTO console (job_id, output) VALUES (%s, %s)", [job_id, output])
-            g.db.execute("""
-                UPDATE job SET state = 'running', start_date = current_timestamp
-                WHERE id = %s and state = 'scheduled'""", [job_id])
-            g.db.commit()
-        except:
-            pass
+        if error:
+            abort(400, error)
 
         return jsonify({})
 
@@ -935,6 +1300,10 @@ def insert(c, cols, rows, table):
     cursor.execute(stmt)
     cursor.close()
 
+# Max number of markup or badge files of one request and of a job
+JSON_UPLOADS_PER_REQUEST = 10
+JSON_UPLOADS_PER_JOB = 100
+
 @api.route("/api/job/markup", doc=False)
 class Markup(Resource):
 
@@ -946,10 +1315,9 @@ class Markup(Resource):
             SELECT count(*) FROM job_markup WHERE job_id = %s
         """, [job_id])
 
-        if r[0] > 0:
-            abort(403, "Forbidden")
-
-        if len(request.files) > 10:
+        # Uploaded in several requests, if the job has more files than fit into one
+        if len(request.files) > JSON_UPLOADS_PER_REQUEST or \
+           r[0] + len(request.files) > JSON_UPLOADS_PER_JOB:
             abort(400, "Too many uploads")
 
         path = '/tmp/%s.json' % uuid.uuid4()
@@ -998,10 +1366,8 @@ class Badge(Resource):
         r = g.db.execute_one(""" SELECT count(*) FROM job_badge WHERE job_id = %s
                              """, [job_id])
 
-        if r[0] > 0:
-            abort(403, "Forbidden")
-
-        if len(request.files) > 10:
+        if len(request.files) > JSON_UPLOADS_PER_REQUEST or \
+           r[0] + len(request.files) > JSON_UPLOADS_PER_JOB:
             abort(400, "Too many uploads")
 
         path = '/tmp/%s.json' % uuid.uuid4()
@@ -1042,6 +1408,58 @@ class Badge(Resource):
 
         return jsonify({})
 
+# Number of test runs inserted with one statement
+TESTRESULT_BATCH_SIZE = 1000
+
+# Max size of test results in the NDJSON format, which are read line by line
+TESTRESULT_MAX_NDJSON_SIZE = 512 * 1024 * 1024
+
+def get_test_run_rows(t, job_id, project_id):
+    # Returns the test run and its measurements
+    if len(t['suite']) > 250:
+        t['suite'] = t['suite'][0:250]
+
+    if len(t['name']) > 250:
+        t['name'] = t['name'][0:250]
+
+    # Track stats
+    if t['status'] == 'fail' or t['status'] == 'failure':
+        t['status'] = 'failure'
+
+    # Create the corresponding test run
+    test_run_id = str(uuid.uuid4())
+    test_run = (
+        test_run_id,
+        t['status'],
+        job_id,
+        t['duration'],
+        project_id,
+        t.get('message', None),
+        t.get('stack', None),
+        t['name'],
+        t['suite']
+    )
+
+    # create measurements
+    measurements = []
+    for m in t.get('measurements', []):
+        measurements.append((
+            test_run_id,
+            m['name'],
+            m['unit'],
+            m['value'],
+            project_id
+        ))
+
+    return test_run, measurements
+
+def insert_test_runs(conn, test_runs, measurements):
+    if measurements:
+        insert(conn, ("test_run_id", "name", "unit", "value", "project_id"), measurements, 'measurement')
+
+    insert(conn, ("id", "state", "job_id", "duration",
+                  "project_id", "message", "stack", "name", "suite"), test_runs, 'test_run')
+
 @api.route("/api/job/testresult", doc=False)
 class Testresult(Resource):
 
@@ -1054,6 +1472,9 @@ class Testresult(Resource):
 
         f = request.files['data']
 
+        if allowed_file(f.filename, ("ndjson",)):
+            return self.post_ndjson(f, job_id)
+
         if not allowed_file(f.filename, ("json")):
             abort(400, 'file ending not allowed')
 
@@ -1098,45 +1519,76 @@ class Testresult(Resource):
 
         tests = data['tests']
         for t in tests:
-            if len(t['suite']) > 250:
-                t['suite'] = t['suite'][0:250]
-
-            if len(t['name']) > 250:
-                t['name'] = t['name'][0:250]
-
-            # Track stats
-            if t['status'] == 'fail' or t['status'] == 'failure':
-                t['status'] = 'failure'
-
-            # Create the corresponding test run
-            test_run_id = str(uuid.uuid4())
-            test_runs.append((
-                test_run_id,
-                t['status'],
-                job_id,
-                t['duration'],
-                project_id,
-                t.get('message', None),
-                t.get('stack', None),
-                t['name'],
-                t['suite']
-            ))
-
-            # create measurements
-            for m in t.get('measurements', []):
-                measurements.append((
-                    test_run_id,
-                    m['name'],
-                    m['unit'],
-                    m['value'],
-                    project_id
-                ))
-
-        if measurements:
-            insert(g.db.conn, ("test_run_id", "name", "unit", "value", "project_id"), measurements, 'measurement')
-
-        insert(g.db.conn, ("id", "state", "job_id", "duration",
-                           "project_id", "message", "stack", "name", "suite"), test_runs, 'test_run')
+            test_run, test_measurements = get_test_run_rows(t, job_id, project_id)
+            test_runs.append(test_run)
+            measurements += test_measurements
+
+        insert_test_runs(g.db.conn, test_runs, measurements)
+
+        g.db.commit()
+        return jsonify({})
+
+    def post_ndjson(self, f, job_id):
+        # The version and then one test per line. The tests are read
+        # and inserted in batches, so the result is never completely
+        # in memory. All of them are committed together.
+        rows = g.db.execute_one("""
+            SELECT j.project_id
+            FROM job  j
+            INNER JOIN build b
+                ON j.id = %s
+                AND b.id = j.build_id
+        """, [job_id])
+        project_id = rows[0]
+
+        test_runs = []
+        measurements = []
+        size = 0
+        count = 0
+        header = None
+
+        for line in f.stream:
+            size += len(line)
+
+            if size > TESTRESULT_MAX_NDJSON_SIZE:
+                abort(400, "File too big")
+
+            if not line.strip():
+                continue
+
+            try:
+                d = json.loads(line)
+            except:
+                abort(400, 'Failed to parse json')
+
+            try:
+                if header is None:
+                    header = d
+                    validate_header(header)
+                    continue
+
+                validate_test(d, "#tests[%s]" % count)
+            except ValidationError as e:
+                abort(400, e.message)
+
+            test_run, test_measurements = get_test_run_rows(d, job_id, project_id)
+            test_runs.append(test_run)
+            measurements += test_measurements
+            count += 1
+
+            if len(test_runs) >= TESTRESULT_BATCH_SIZE:
+                insert_test_runs(g.db.conn, test_runs, measurements)
+                test_runs = []
+                measurements = []
+
+        if header is None:
+            abort(400, "#: property 'version' is required")
+
+        if count == 0:
+            abort(400, "#tests: must not be empty")
+
+        if test_runs:
+            insert_test_runs(g.db.conn, test_runs, measurements)
 
         g.db.commit()
         return jsonify({})
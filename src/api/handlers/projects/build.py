@@ -154,6 +154,9 @@ class BuildCacheClear(Resource):
             key = 'project_%s_job_%s.tar.snappy' % (project_id, j['name'])
             storage.delete_cache(key)
 
+            key = 'project_%s_job_%s.manifest.json' % (project_id, j['name'])
+            storage.delete_cache(key.replace('/', '_'))
+
         return OK('Cleared cache')
 
 @ns.route('/<build_number>/<build_restart_counter>/state', doc=False)
@@ -1,18 +1,17 @@
 import json
 import os
 
-from io import BytesIO
-
 import requests
 
-from flask import g, abort, Response, send_file, request
+from flask import g, abort, Response, request
 from flask_restplus import Resource, fields
 
 from pyinfraboxutils import get_logger
-from pyinfraboxutils.ibflask import OK
+from pyinfraboxutils.ibflask import OK, invalidate_job_token
 from pyinfraboxutils.ibrestplus import api, response_model
-from pyinfraboxutils.storage import storage
+from pyinfraboxutils.storage import storage, send_object, CHUNK_SIZE
 from pyinfraboxutils.token import encode_user_token
+from pyinfraboxutils.console import ConsoleRange, get_range, read_range
 
 logger = get_logger('api')
 
@@ -268,11 +267,16 @@ class JobRestart(Resource):
                 UPDATE job
                 SET state = 'queued', console = null, message = null, start_date = null
                 WHERE id = %s;
+                DELETE FROM console_chunk WHERE job_id = %s;
+                DELETE FROM console_stats WHERE job_id = %s;
                 INSERT INTO console (job_id, output)
                 VALUES (%s, %s);
-            ''', [j, j, msg])
+            ''', [j, j, j, j, msg])
         g.db.commit()
 
+        for j in restart_jobs:
+            invalidate_job_token(j)
+
         return OK('Successfully restarted job')
 
 @ns.route('/<job_id>/abort')
@@ -330,31 +334,50 @@ class ArchiveDownload(Resource):
         key = '%s/%s' % (job_id, filename)
 
         if os.environ['INFRABOX_CLUSTER_NAME'] == job_cluster:
-            f = storage.download_archive(key)
-        else:
-            c = g.db.execute_one_dict('''
-                SELECT *
-                FROM cluster
-                WHERE name=%s
-            ''', [job_cluster])
-            url = '%s/api/v1/projects/%s/jobs/%s/archive/download?filename=%s' % (c['root_url'], project_id, job_id, filename)
-            try:
-                token = encode_user_token(g.token['user']['id'])
-            except Exception:
-                #public project has no token here.
-                token = ""
-            headers = {'Authorization': 'bearer ' + token}
-
-            # TODO(ib-steffen): allow custom ca bundles
-            r = requests.get(url, headers=headers, timeout=120, verify=False)
-            f = BytesIO(r.content)
-            f.seek(0)
+            f = storage.open_archive(key)
+
+            if not f:
+                logger.error(key)
+                abort(404)
+
+            return send_object(f, as_attachment=True, attachment_filename=os.path.basename(filename))
+
+        c = g.db.execute_one_dict('''
+            SELECT *
+            FROM cluster
+            WHERE name=%s
+        ''', [job_cluster])
+        url = '%s/api/v1/projects/%s/jobs/%s/archive/download?filename=%s' % (c['root_url'], project_id, job_id, filename)
+        try:
+            token = encode_user_token(g.token['user']['id'])
+        except Exception:
+            #public project has no token here.
+            token = ""
+        headers = {'Authorization': 'bearer ' + token}
+
+        if request.headers.get('Range', None):
+            headers['Range'] = request.headers['Range']
 
-        if not f:
+        g.release_db()
+
+        # TODO(ib-steffen): allow custom ca bundles
+        r = requests.get(url, headers=headers, timeout=120, verify=False, stream=True)
+
+        if r.status_code not in (200, 206):
             logger.error(key)
-            abort(404)
+            abort(r.status_code)
+
+        # Pass the content through without buffering it
+        headers = {}
+        for h in ('Content-Length', 'Content-Range', 'Accept-Ranges', 'Content-Disposition'):
+            if h in r.headers:
+                headers[h] = r.headers[h]
 
-        return send_file(f, as_attachment=True, attachment_filename=os.path.basename(filename))
+        return Response(r.iter_content(CHUNK_SIZE),
+                        status=r.status_code,
+                        headers=headers,
+                        mimetype=r.headers.get('Content-Type', None),
+                        direct_passthrough=True)
 
 @ns.route('/<job_id>/archive')
 @api.response(403, 'Not Authorized')
@@ -377,6 +400,24 @@ class Archive(Resource):
         return result['archive']
 
 
+def get_console_range():
+    args = {}
+    for name in ('offset', 'length', 'line', 'lines', 'tail'):
+        value = request.args.get(name, None)
+
+        if value is None:
+            continue
+
+        try:
+            args[name] = int(value)
+        except ValueError:
+            abort(400, 'Invalid %s' % name)
+
+        if args[name] < 0:
+            abort(400, 'Invalid %s' % name)
+
+    return ConsoleRange(**args)
+
 @ns.route('/<job_id>/console')
 @api.response(403, 'Not Authorized')
 class Console(Resource):
@@ -384,32 +425,38 @@ class Console(Resource):
     def get(self, project_id, job_id):
         '''
         Returns job's console output
+
+        Parts of it can be requested as byte range (offset, length),
+        line range (line, lines) or as the last lines (tail)
         '''
+        console_range = get_console_range()
+
         result = g.db.execute_one_dict('''
-            SELECT console
-            FROM job
+            SELECT console, EXISTS(SELECT 1 FROM console_chunk c WHERE c.job_id = j.id) chunked
+            FROM job j
             WHERE   id = %s
                 AND project_id = %s
         ''', [job_id, project_id])
 
         if result and result['console']:
-            return Response(result['console'], mimetype='text/plain')
-
-        result = g.db.execute_many_dict('''
-            SELECT output
-            FROM console
-            WHERE job_id = %s
-            ORDER BY date
-        ''', [job_id])
-
-        if not result:
-            return ''
+            output, size, lines = get_range(result['console'], console_range)
+        elif result and result['chunked']:
+            output, size, lines = read_range(g.db, job_id, console_range)
+        else:
+            # Still running
+            result = g.db.execute_many_dict('''
+                SELECT output
+                FROM console
+                WHERE job_id = %s
+                ORDER BY date
+            ''', [job_id])
 
-        output = ''
-        for r in result:
-            output += r['output']
+            output, size, lines = get_range(''.join(r['output'] for r in result), console_range)
 
-        return Response(output, mimetype='text/plain')
+        return Response(output, mimetype='text/plain', headers={
+            'X-Console-Size': str(size),
+            'X-Console-Lines': str(lines)
+        })
 
 
 @ns.route('/<job_id>/output', doc=False)
@@ -421,12 +468,12 @@ class Output(Resource):
         g.release_db()
 
         key = '%s.tar.gz' % job_id
-        f = storage.download_output(key)
+        f = storage.open_output(key)
 
         if not f:
             abort(404)
 
-        return send_file(f, attachment_filename=key)
+        return send_object(f, attachment_filename=key)
 
 @ns.route('/<job_id>/testruns', doc=False)
 @api.response(403, 'Not Authorized')
@@ -598,6 +645,38 @@ class Stats(Resource):
 
         return r
 
+@ns.route('/<job_id>/duration', doc=False)
+@api.response(403, 'Not Authorized')
+class Duration(Resource):
+
+    def get(self, project_id, job_id):
+        # Statistics of the recent runs of the job on its branch,
+        # or on all branches if it has not run on the branch yet
+        result = g.db.execute_one_dict('''
+            SELECT s.branch, s.runs, s.avg_duration, s.p50_duration, s.p95_duration,
+                   s.failure_rate, s.avg_cpu, s.max_memory
+            FROM job j
+            INNER JOIN build b
+                ON b.id = j.build_id
+                AND b.project_id = j.project_id
+            LEFT OUTER JOIN commit c
+                ON c.id = b.commit_id
+                AND c.project_id = b.project_id
+            INNER JOIN job_stats s
+                ON s.project_id = j.project_id
+                AND s.name = j.name
+                AND s.branch IN ('', coalesce(c.branch, ''))
+            WHERE j.id = %s
+                AND j.project_id = %s
+            ORDER BY s.branch DESC
+            LIMIT 1
+        ''', [job_id, project_id])
+
+        if not result:
+            return {}
+
+        return result
+
 @ns.route('/<job_id>/cache/clear')
 @api.response(200, 'Success', response_model)
 @api.response(403, 'Not Authorized')
@@ -626,4 +705,7 @@ class JobCacheClear(Resource):
         key = 'project_%s_job_%s.tar.snappy' % (project_id, job['name'])
         storage.delete_cache(key)
 
+        key = 'project_%s_job_%s.manifest.json' % (project_id, job['name'])
+        storage.delete_cache(key.replace('/', '_'))
+
         return OK('Cleared cache')
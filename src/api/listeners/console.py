@@ -1,6 +1,9 @@
 import json
+import time
+from collections import OrderedDict, deque
 
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+import eventlet
 from eventlet.hubs import trampoline
 
 from pyinfraboxutils.db import connect_db
@@ -9,11 +12,96 @@ from pyinfraboxutils import get_logger
 
 logger = get_logger('console_listener')
 
-def __handle_event(event, socketio, client_manager):
+# Size of the recent console output which is kept
+# for every job, so new listeners can catch up
+HISTORY_SIZE = 64 * 1024
+
+# Max number of jobs for which the recent output is kept
+HISTORY_JOBS = 1000
+
+# Console updates of a job are collected for this
+# time and then sent to its listeners together
+EMIT_INTERVAL = 0.25
+
+class ConsoleHub(object):
+    # All of it runs in greenlets of the same thread, so no locks are needed
+    def __init__(self):
+        self.history = OrderedDict()
+        self.pending = OrderedDict()
+
+        # Every update gets an offset, so listeners can skip output they already
+        # have. They increase over all jobs and also over restarts of the hub.
+        self.offset = int(time.time() * 1000000)
+
+    def add(self, job_id, output):
+        self.offset += 1
+        self.pending.setdefault(job_id, []).append((self.offset, output))
+
+        history = self.history.pop(job_id, None)
+
+        if history is None:
+            history = {'output': deque(), 'size': 0, 'emitted': 0}
+
+        history['output'].append((self.offset, output))
+        history['size'] += len(output)
+
+        while history['size'] > HISTORY_SIZE and len(history['output']) > 1:
+            history['size'] -= len(history['output'].popleft()[1])
+
+        # Most recently updated jobs are last
+        self.history[job_id] = history
+
+        while len(self.history) > HISTORY_JOBS:
+            self.history.popitem(last=False)
+
+    def drop_history(self, job_id):
+        # Output is missing, so the history would have a gap
+        self.history.pop(job_id, None)
+
+    def get_history(self, job_id):
+        # Only the output which has already been emitted, the rest
+        # is sent to the new listener together with the other listeners
+        history = self.history.get(job_id, None)
+
+        if not history:
+            return None
+
+        return [[offset, output] for offset, output in history['output']
+                if offset <= history['emitted']]
+
+    def emit(self, socketio, client_manager):
+        pending = self.pending
+        self.pending = OrderedDict()
+
+        for job_id, updates in pending.items():
+            offset = updates[-1][0]
+
+            history = self.history.get(job_id, None)
+            if history:
+                history['emitted'] = offset
+
+            if not client_manager.has_clients(job_id):
+                continue
+
+            socketio.emit('notify:console', {
+                'data': ''.join(output for _, output in updates),
+                'job_id': job_id,
+                'offset': offset
+            }, room=job_id)
+
+hub = ConsoleHub()
+
+def __handle_event(event, client_manager):
     job_id = event['job_id']
     console_id = event['id']
 
+    if 'output' in event:
+        hub.add(job_id, event['output'])
+        return
+
+    # Output was too big for the notification
     if not client_manager.has_clients(job_id):
+        hub.drop_history(job_id)
         return
 
     logger.debug('start console %s', console_id)
@@ -25,37 +113,68 @@ def __handle_event(event, socketio, client_manager):
         logger.debug('retrived console %s', console_id)
 
         if not r:
+            hub.drop_history(job_id)
             return
 
-        r = r[0]
-
-        socketio.emit('notify:console', {
-            'data': r,
-            'job_id': job_id
-        }, room=job_id)
+        hub.add(job_id, r[0])
     finally:
         dbpool.put(conn)
         logger.debug('stop console %s', console_id)
 
-def listen(socketio, client_manager):
+def __handle_history_request(req, socketio):
+    history = hub.get_history(req['job_id'])
+
+    if not history:
+        return
+
+    # List of [offset, output], the offsets are the same as in notify:console
+    socketio.emit('notify:console-history', {
+        'data': history,
+        'job_id': req['job_id']
+    }, room=req['sid'])
+
+def __emit(socketio, client_manager):
     while True:
+        socketio.sleep(EMIT_INTERVAL)
+
         try:
-            __listen(socketio, client_manager)
+            hub.emit(socketio, client_manager)
         except Exception as e:
             logger.exception(e)
 
+def listen(socketio, client_manager):
+    # Stopped by killing the greenlet, which also stops the emitter
+    emitter = eventlet.spawn(__emit, socketio, client_manager)
+
+    try:
+        while True:
+            try:
+                __listen(socketio, client_manager)
+            except Exception as e:
+                logger.exception(e)
+    finally:
+        emitter.kill()
+
 def __listen(socketio, client_manager):
     conn = connect_db()
-    conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
-    cur = conn.cursor()
-    cur.execute("LISTEN console_update")
+    try:
+        conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        cur = conn.cursor()
+        cur.execute("LISTEN console_update")
+        cur.execute("LISTEN console_history")
 
-    while True:
-        trampoline(conn, read=True)
-        conn.poll()
-        while conn.notifies:
-            n = conn.notifies.pop()
-            socketio.start_background_task(__handle_event,
-                                           json.loads(n.payload),
-                                           socketio,
-                                           client_manager)
+        while True:
+            trampoline(conn, read=True)
+            conn.poll()
+
+            # Handled in order, so the output of a job stays in order
+            notifies = conn.notifies[:]
+            del conn.notifies[:]
+
+            for n in notifies:
+                if n.channel == 'console_history':
+                    __handle_history_request(json.loads(n.payload), socketio)
+                else:
+                    __handle_event(json.loads(n.payload), client_manager)
+    finally:
+        conn.close()
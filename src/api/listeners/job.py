@@ -1,56 +1,53 @@
 import json
+from collections import OrderedDict
 
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+import eventlet
 from eventlet.hubs import trampoline
 
 from pyinfraboxutils import get_logger
 from pyinfraboxutils.db import connect_db
+from pyinfraboxutils.cache import TTLCache
+from pyinfraboxutils.ibflask import invalidate_job_token
 from pyinfraboxutils import dbpool
 
 logger = get_logger('job_listener')
 
-def __handle_event(event, socketio):
-    job_id = event['job_id']
-
-    db = dbpool.get()
-
-    try:
-        job = db.execute_one_dict('''
-            SELECT id, state, to_char(start_date, 'YYYY-MM-DD HH24:MI:SS') start_date, type, dockerfile,
-                   to_char(end_date, 'YYYY-MM-DD HH24:MI:SS') end_date,
-                   name, dependencies, to_char(created_at, 'YYYY-MM-DD HH24:MI:SS') created_at, message,
-                   project_id, build_id, node_name, avg_cpu, definition
-            FROM job
-            WHERE id = %s
-        ''', [job_id])
-
-        if not job:
-            return
-
-        project_id = job['project_id']
-        build_id = job['build_id']
-
-        project = db.execute_one_dict('''
-            SELECT id, name, type
-            FROM project
-            WHERE id = %s
-        ''', [project_id])
-
-        if not project:
-            return
-
-        build = db.execute_one_dict('''
-            SELECT id, build_number, restart_counter, commit_id
-            FROM build
-            WHERE id = %s
-        ''', [build_id])
-
-        commit_id = build['commit_id']
-
-        commit = None
-        pr = None
-        if project['type'] in ('gerrit', 'github'):
-            commit = db.execute_one_dict('''
+# Updates of jobs are collected for this time and then sent
+# together, so bursts of updates of a build are one message
+EMIT_INTERVAL = 0.25
+
+# Project, build, commit and pull request rows rarely
+# change while a build is running, so they are cached
+snapshots = TTLCache(max_size=2000, ttl=60)
+
+# Pending events by job id
+pending = OrderedDict()
+
+def get_room(room, options):
+    # Clients which handle notify:jobs listen in their own room, the
+    # others still get one notify:job message for every job
+    if isinstance(options, dict) and options.get('batched', False):
+        return 'batched:%s' % room
+
+    return room
+
+def __get_project(db, project_id):
+    return snapshots.get_or_load(('project', project_id), lambda: db.execute_one_dict('''
+        SELECT id, name, type
+        FROM project
+        WHERE id = %s
+    ''', [project_id]))
+
+def __get_build(db, build_id):
+    return snapshots.get_or_load(('build', build_id), lambda: db.execute_one_dict('''
+        SELECT id, build_number, restart_counter, commit_id
+        FROM build
+        WHERE id = %s
+    ''', [build_id]))
+
+def __get_commit(db, commit_id, project_id):
+    return snapshots.get_or_load(('commit', commit_id, project_id), lambda: db.execute_one_dict('''
 		SELECT
                     c.id,
                     split_part(c.message, '\n', 1) as message,
@@ -66,42 +63,140 @@ def __handle_event(event, socketio):
 		FROM commit c
 		WHERE c.id = %s
                 AND   c.project_id = %s
-            ''', [commit_id, project_id])
+    ''', [commit_id, project_id]))
+
+def __get_pull_request(db, pull_request_id, project_id):
+    return snapshots.get_or_load(('pull_request', pull_request_id, project_id), lambda: db.execute_one_dict('''
+        SELECT title, url
+        FROM pull_request
+        WHERE id = %s
+        AND   project_id = %s
+    ''', [pull_request_id, project_id]))
+
+def __handle_events(events, socketio):
+    # Sends all updated jobs of a build as one message
+    db = dbpool.get()
+
+    try:
+        jobs = db.execute_many_dict('''
+            SELECT id, state, to_char(start_date, 'YYYY-MM-DD HH24:MI:SS') start_date, type, dockerfile,
+                   to_char(end_date, 'YYYY-MM-DD HH24:MI:SS') end_date,
+                   name, dependencies, to_char(created_at, 'YYYY-MM-DD HH24:MI:SS') created_at, message,
+                   project_id, build_id, node_name, avg_cpu, definition
+            FROM job
+            WHERE id = ANY(%s::uuid[])
+        ''', [list(events.keys())])
+
+        jobs = dict((str(j['id']), j) for j in jobs)
 
-            pull_request_id = commit['pull_request_id']
+        builds = OrderedDict()
+        for job_id, event_type in events.items():
+            job = jobs.get(job_id, None)
 
-            pr = db.execute_one_dict('''
-                SELECT title, url
-                FROM pull_request
-                WHERE id = %s
-                AND   project_id = %s
-            ''', [pull_request_id, project_id])
+            if not job:
+                continue
 
+            project_id = job['project_id']
+            build_id = job['build_id']
+
+            project = __get_project(db, project_id)
+
+            if not project:
+                continue
+
+            build = __get_build(db, build_id)
+
+            commit = None
+            pr = None
+            if project['type'] in ('gerrit', 'github'):
+                commit = __get_commit(db, build['commit_id'], project_id)
+
+                # Most builds are not for a pull request, there is nothing to load
+                if commit and commit['pull_request_id'] is not None:
+                    pr = __get_pull_request(db, commit['pull_request_id'], project_id)
+
+            builds.setdefault((build_id, project_id), []).append({
+                'type': event_type,
+                'data': {
+                    'build': build,
+                    'project': project,
+                    'commit': commit,
+                    'pull_request': pr,
+                    'job': job
+                }
+            })
     finally:
         dbpool.put(db)
 
-    msg = {
-        'type': event['type'],
-        'data': {
-            'build': build,
-            'project': project,
-            'commit': commit,
-            'pull_request': pr,
-            'job': job
-        }
-    }
+    batched = {'batched': True}
+    for (build_id, project_id), msgs in builds.items():
+        socketio.emit('notify:jobs', msgs, room=get_room(build_id, batched))
+        socketio.emit('notify:jobs', msgs, room=get_room(project_id, batched))
 
-    socketio.emit('notify:job', msg, room=build_id)
-    socketio.emit('notify:job', msg, room=project_id)
+        for msg in msgs:
+            socketio.emit('notify:job', msg, room=build_id)
+            socketio.emit('notify:job', msg, room=project_id)
+
+def __emit(socketio):
+    global pending
 
-def listen(socketio):
     while True:
+        socketio.sleep(EMIT_INTERVAL)
+
+        if not pending:
+            continue
+
+        events = pending
+        pending = OrderedDict()
+
         try:
-            __listen(socketio)
+            __handle_events(events, socketio)
         except Exception as e:
             logger.exception(e)
 
+def listen(socketio):
+    # Stopped by killing the greenlet, which also stops the emitter
+    emitter = eventlet.spawn(__emit, socketio)
+
+    try:
+        while True:
+            try:
+                __listen(socketio)
+            except Exception as e:
+                logger.exception(e)
+    finally:
+        emitter.kill()
+
 def __listen(socketio):
+    conn = connect_db()
+    try:
+        conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        cur = conn.cursor()
+        cur.execute("LISTEN job_update")
+
+        while True:
+            trampoline(conn, read=True)
+            conn.poll()
+            while conn.notifies:
+                n = conn.notifies.pop(0)
+                event = json.loads(n.payload)
+
+                # A job which has been inserted in this interval is still new
+                if pending.get(event['job_id'], None) != 'INSERT':
+                    pending[event['job_id']] = event['type']
+    finally:
+        conn.close()
+
+def listen_tokens():
+    # Every replica caches the validation of job tokens,
+    # so all of them have to drop it once the job changes
+    while True:
+        try:
+            __listen_tokens()
+        except Exception as e:
+            logger.exception(e)
+
+def __listen_tokens():
     conn = connect_db()
     conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
     cur = conn.cursor()
@@ -111,7 +206,6 @@ def __listen(socketio):
         trampoline(conn, read=True)
         conn.poll()
         while conn.notifies:
-            n = conn.notifies.pop()
-            socketio.start_background_task(__handle_event,
-                                           json.loads(n.payload),
-                                           socketio)
+            n = conn.notifies.pop(0)
+            event = json.loads(n.payload)
+            invalidate_job_token(event['job_id'])
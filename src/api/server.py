@@ -1,7 +1,9 @@
 #pylint: disable=unused-import,relative-import,wrong-import-position
 import uuid
 import os
+import json
 import sys
+import socket
 
 import urllib3
 
@@ -20,6 +22,8 @@ from pyinfraboxutils import get_env, get_logger
 from pyinfraboxutils.ibflask import get_token, normalize_token
 from pyinfraboxutils.ibrestplus import api, app
 from pyinfraboxutils.ibopa import opa_do_auth, opa_start_push_loop
+from pyinfraboxutils.db import connect_db
+from pyinfraboxutils.leader import elect_leader, is_leader
 from pyinfraboxutils import dbpool
 
 import handlers
@@ -48,13 +52,14 @@ def status():
         return jsonify(status), 503
     return jsonify({'status': "active"})
 
-class ClientManager(socketio.base_manager.BaseManager):
-    def __init__(self):
-        super(ClientManager, self).__init__()
+class RoomCounter(object):
+    # Counts the clients of every room connected to this replica
+    def __init__(self, *args, **kwargs):
+        super(RoomCounter, self).__init__(*args, **kwargs)
         self.__rooms = {}
 
     def enter_room(self, sid, namespace, room):
-        super(ClientManager, self).enter_room(sid, namespace, room)
+        super(RoomCounter, self).enter_room(sid, namespace, room)
         logger.debug('%s joined room %s', sid, room)
 
         if room not in self.__rooms:
@@ -63,7 +68,7 @@ class ClientManager(socketio.base_manager.BaseManager):
         self.__rooms[room] += 1
 
     def leave_room(self, sid, namespace, room):
-        super(ClientManager, self).leave_room(sid, namespace, room)
+        super(RoomCounter, self).leave_room(sid, namespace, room)
         logger.debug('%s left room %s', sid, room)
         self.__rooms[room] -= 1
 
@@ -78,6 +83,55 @@ class ClientManager(socketio.base_manager.BaseManager):
 
         return False
 
+class ClientManager(RoomCounter, socketio.base_manager.BaseManager):
+    pass
+
+class RedisClientManager(RoomCounter, socketio.RedisManager):
+    def has_clients(self, room):
+        # Clients may be connected to any replica
+        return True
+
+class KombuClientManager(RoomCounter, socketio.KombuManager):
+    def has_clients(self, room):
+        # Clients may be connected to any replica
+        return True
+
+def create_client_manager(message_queue):
+    if not message_queue:
+        return ClientManager()
+
+    if message_queue.startswith('redis://'):
+        return RedisClientManager(message_queue)
+
+    return KombuClientManager(message_queue)
+
+def start_listeners(sio, client_manager):
+    return [
+        eventlet.spawn(listeners.job.listen, sio),
+        eventlet.spawn(listeners.console.listen, sio, client_manager)
+    ]
+
+def publish_notifications(sio, client_manager):
+    # Only the leader listens to the database notifications, the messages
+    # are published to all replicas through the message queue
+    service_name = 'api-socketio-%s' % get_env('INFRABOX_CLUSTER_NAME')
+    replica_name = socket.gethostname()
+
+    conn = connect_db()
+
+    while True:
+        elect_leader(conn, service_name, replica_name)
+        threads = start_listeners(sio, client_manager)
+
+        while is_leader(conn, service_name, replica_name, exit=False):
+            eventlet.sleep(10)
+
+        # Another replica is the leader now. Only the listeners are
+        # stopped, the requests served by this replica go on.
+        logger.error('Lost leadership for socket.io notifications')
+        for t in threads:
+            t.kill()
+
 def main(): # pragma: no cover
     get_env('INFRABOX_VERSION')
     get_env('INFRABOX_DATABASE_HOST')
@@ -97,7 +151,8 @@ def main(): # pragma: no cover
         get_env('INFRABOX_STORAGE_S3_REGION')
 
     app.config['MAX_CONTENT_LENGTH'] = 1024 * 1024 * 1024 * 4
-    client_manager = ClientManager()
+    message_queue = os.environ.get('INFRABOX_API_SOCKETIO_MESSAGE_QUEUE', '')
+    client_manager = create_client_manager(message_queue)
     sio = flask_socketio.SocketIO(app,
                                   path='/api/v1/socket.io',
                                   async_mode='eventlet',
@@ -106,7 +161,7 @@ def main(): # pragma: no cover
     urllib3.disable_warnings()
 
     @sio.on('listen:jobs')
-    def __listen_jobs(project_id):
+    def __listen_jobs(project_id, options=None):
         logger.debug('listen:jobs for %s', project_id)
 
         if not project_id:
@@ -116,10 +171,10 @@ def main(): # pragma: no cover
         if not sio_is_authorized(["listen:jobs", project_id]):
             return flask_socketio.disconnect()
 
-        flask_socketio.join_room(project_id)
+        flask_socketio.join_room(listeners.job.get_room(project_id, options))
 
     @sio.on('listen:build')
-    def __listen_build(build_id):
+    def __listen_build(build_id, options=None):
         logger.debug('listen:build for %s', build_id)
 
         if not build_id:
@@ -156,7 +211,7 @@ def main(): # pragma: no cover
         finally:
             dbpool.put(conn)
 
-        flask_socketio.join_room(build_id)
+        flask_socketio.join_room(listeners.job.get_room(build_id, options))
 
     @sio.on('listen:console')
     def __listen_console(job_id):
@@ -196,6 +251,7 @@ def main(): # pragma: no cover
             dbpool.put(conn)
 
         flask_socketio.join_room(job_id)
+        emit_console_history(job_id)
 
     @sio.on('listen:dashboard-console')
     def __listen_dashboard_console(job_id):
@@ -235,6 +291,21 @@ def main(): # pragma: no cover
             dbpool.put(conn)
 
         flask_socketio.join_room(job_id)
+        emit_console_history(job_id)
+
+    def emit_console_history(job_id):
+        # Recent output of the job, so the new listener can catch up. Only the replica
+        # which listens to the console updates has it, it sends the history to the
+        # client, through the message queue if the client is connected to another replica.
+        conn = dbpool.get()
+        try:
+            conn.execute("SELECT pg_notify('console_history', %s)", [json.dumps({
+                'job_id': job_id,
+                'sid': request.sid
+            })])
+            conn.commit()
+        finally:
+            dbpool.put(conn)
 
     def sio_is_authorized(path):
         g.db = dbpool.get()
@@ -261,9 +332,15 @@ def main(): # pragma: no cover
             g.db = None
 
 
-    logger.info('Starting DB listeners')
-    sio.start_background_task(listeners.job.listen, sio)
-    sio.start_background_task(listeners.console.listen, sio, client_manager)
+    # Independent of the leader, every replica has its own token cache
+    sio.start_background_task(listeners.job.listen_tokens)
+
+    if message_queue:
+        logger.info('Starting DB listeners once elected as leader')
+        sio.start_background_task(publish_notifications, sio, client_manager)
+    else:
+        logger.info('Starting DB listeners')
+        start_listeners(sio, client_manager)
 
     logger.info('Starting repeated push of data to Open Policy Agent')
     opa_start_push_loop()
@@ -25,16 +25,21 @@ export default new Vue({
         disconnect () {
             this.$emit('DISCONNECTED')
         },
-        'notify:job' (val) {
-            this.$emit('NOTIFY_JOBS', val)
+        'notify:jobs' (vals) {
+            for (let val of vals) {
+                this.$emit('NOTIFY_JOBS', val)
+            }
         },
         'notify:console' (val) {
             this.$emit('NOTIFY_CONSOLE', val)
+        },
+        'notify:console-history' (val) {
+            this.$emit('NOTIFY_CONSOLE_HISTORY', val)
         }
     },
     methods: {
         listenJobs (project) {
-            this.$socket.emit('listen:jobs', project.id)
+            this.$socket.emit('listen:jobs', project.id, { batched: true })
         },
         listenConsole (id) {
             this.$socket.emit('listen:dashboard-console', id)
@@ -100,6 +100,8 @@ export default class Job {
         this.archive = []
         this.currentSection = null
         this.linesProcessed = 0
+        // Offset of the last console update, to skip updates which were already received
+        this.consoleOffset = null
         this.message = message
         this.definition = definition
         this.nodeName = nodeName
@@ -340,6 +342,7 @@ export default class Job {
                 this.sections = []
                 this.currentSection = null
                 this.linesProcessed = 0
+                this.consoleOffset = null
                 this.endDate = null
                 this.startDate = null
                 this.message = null
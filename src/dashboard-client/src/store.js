@@ -261,10 +261,48 @@ function handleConsoleUpdate (state, update) {
         return
     }
 
+    if (update.offset) {
+        if (job.consoleOffset !== null && update.offset <= job.consoleOffset) {
+            return
+        }
+
+        job.consoleOffset = update.offset
+    }
+
     const lines = update.data.split('\n')
     job._addLines(lines)
 }
 
+function handleConsoleHistory (state, history) {
+    const job = state.jobs[history.job_id]
+    if (!job) {
+        return
+    }
+
+    if (!history.data || !history.data.length) {
+        return
+    }
+
+    if (job.consoleOffset === null) {
+        // The console has just been loaded, it already contains the history
+        job.consoleOffset = history.data[history.data.length - 1][0]
+        return
+    }
+
+    // Listening again, only the output which has been missed in the meantime
+    let output = ''
+    for (let [offset, data] of history.data) {
+        if (offset > job.consoleOffset) {
+            output += data
+            job.consoleOffset = offset
+        }
+    }
+
+    if (output) {
+        job._addLines(output.split('\n'))
+    }
+}
+
 function setConsole (state, data) {
     const job = data.job
     const console = data.console
@@ -302,6 +340,7 @@ const mutations = {
     setUser,
     setGithubRepos,
     handleConsoleUpdate,
+    handleConsoleHistory,
     deleteProject,
     setSettings,
     setBadges,
@@ -332,4 +371,8 @@ events.$on('NOTIFY_CONSOLE', (update) => {
     store.commit('handleConsoleUpdate', update)
 })
 
+events.$on('NOTIFY_CONSOLE_HISTORY', (history) => {
+    store.commit('handleConsoleHistory', history)
+})
+
 export default store
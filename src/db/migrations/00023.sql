@@ -0,0 +1,14 @@
+CREATE OR REPLACE FUNCTION job_queue_notify() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+BEGIN
+	IF TG_OP = 'DELETE' THEN
+		RETURN OLD;
+	END IF;
+
+	PERFORM pg_notify('job_update', json_build_object('type', TG_OP, 'job_id', NEW.id, 'state', NEW.state, 'build_id', NEW.build_id)::text);
+
+  RETURN NEW;
+END;
+$$;
@@ -0,0 +1,10 @@
+CREATE TABLE console_stats (
+    job_id uuid NOT NULL PRIMARY KEY,
+    size bigint NOT NULL,
+    updates integer NOT NULL
+);
+
+INSERT INTO console_stats (job_id, size, updates)
+SELECT job_id, sum(char_length(output)), count(*)
+FROM console
+GROUP BY job_id;
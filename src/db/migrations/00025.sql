@@ -0,0 +1,10 @@
+CREATE TABLE console_chunk (
+    job_id uuid NOT NULL,
+    chunk integer NOT NULL,
+    byte_offset bigint NOT NULL,
+    first_line integer NOT NULL,
+    lines integer NOT NULL,
+    size integer NOT NULL,
+    data bytea NOT NULL,
+    PRIMARY KEY (job_id, chunk)
+);
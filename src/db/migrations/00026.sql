@@ -0,0 +1,28 @@
+CREATE OR REPLACE FUNCTION console_notify() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+  payload text;
+BEGIN
+  IF TG_OP = 'DELETE' THEN
+    RETURN OLD;
+  END IF;
+
+  IF TG_OP = 'UPDATE' THEN
+    RETURN NEW;
+  END IF;
+
+  -- The output is sent with the notification, so the listeners don't have
+  -- to read it again. Only if it's too big for a notification (8000 bytes)
+  -- the listeners have to read it.
+  payload := json_build_object('id', NEW.id, 'job_id', NEW.job_id, 'output', NEW.output)::text;
+
+  IF octet_length(payload) > 7900 THEN
+    payload := json_build_object('id', NEW.id, 'job_id', NEW.job_id)::text;
+  END IF;
+
+  PERFORM pg_notify('console_update', payload);
+
+  RETURN NEW;
+END;
+$$;
@@ -0,0 +1,38 @@
+-- Changes of the data used by Open Policy Agent are sent as notifications,
+-- so they can be pushed as patches instead of pushing the complete tables.
+CREATE OR REPLACE FUNCTION opa_notify() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+  old_row json;
+  new_row json;
+BEGIN
+  IF TG_TABLE_NAME = 'collaborator' THEN
+    IF TG_OP <> 'INSERT' THEN
+      old_row := json_build_object('user_id', OLD.user_id, 'project_id', OLD.project_id, 'role', OLD.role);
+    END IF;
+
+    IF TG_OP <> 'DELETE' THEN
+      new_row := json_build_object('user_id', NEW.user_id, 'project_id', NEW.project_id, 'role', NEW.role);
+    END IF;
+  ELSE
+    IF TG_OP <> 'INSERT' THEN
+      old_row := json_build_object('id', OLD.id, 'public', OLD.public, 'name', OLD.name);
+    END IF;
+
+    IF TG_OP <> 'DELETE' THEN
+      new_row := json_build_object('id', NEW.id, 'public', NEW.public, 'name', NEW.name);
+    END IF;
+  END IF;
+
+  PERFORM pg_notify('opa_update', json_build_object('table', TG_TABLE_NAME, 'old', old_row, 'new', new_row)::text);
+
+  RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER collaborator_opa_notify AFTER INSERT OR UPDATE OR DELETE ON collaborator
+    FOR EACH ROW EXECUTE PROCEDURE opa_notify();
+
+CREATE TRIGGER project_opa_notify AFTER INSERT OR UPDATE OF id, public, name OR DELETE ON project
+    FOR EACH ROW EXECUTE PROCEDURE opa_notify();
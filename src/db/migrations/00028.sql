@@ -0,0 +1,144 @@
+-- Statistics of the recent runs of a job, by project, job name and branch.
+-- The row with the empty branch contains the runs of all branches.
+CREATE TABLE job_stats (
+    project_id uuid NOT NULL,
+    name character varying NOT NULL,
+    branch character varying NOT NULL DEFAULT '',
+    runs integer NOT NULL DEFAULT 0,
+    -- Recent runs, the most recent one last
+    durations double precision[] NOT NULL DEFAULT '{}',
+    failures boolean[] NOT NULL DEFAULT '{}',
+    cpu double precision[] NOT NULL DEFAULT '{}',
+    memory double precision[] NOT NULL DEFAULT '{}',
+    avg_duration double precision,
+    p50_duration double precision,
+    p95_duration double precision,
+    failure_rate double precision,
+    avg_cpu double precision,
+    max_memory double precision,
+    updated_at timestamp with time zone NOT NULL DEFAULT now(),
+    PRIMARY KEY (project_id, name, branch)
+);
+
+-- The last 20 elements of an array, an empty array stays empty
+CREATE FUNCTION job_stats_window(a anyarray) RETURNS anyarray
+    LANGUAGE sql IMMUTABLE
+    AS $$
+  SELECT CASE
+      WHEN array_length(a, 1) IS NULL THEN a
+      ELSE a[greatest(array_length(a, 1) - 19, 1):array_length(a, 1)]
+  END
+$$;
+
+CREATE FUNCTION job_stats_add(p_project_id uuid, p_name character varying, p_branch character varying,
+                              p_duration double precision, p_failed boolean,
+                              p_cpu double precision, p_memory double precision) RETURNS void
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+  INSERT INTO job_stats (project_id, name, branch)
+  VALUES (p_project_id, p_name, p_branch)
+  ON CONFLICT (project_id, name, branch) DO NOTHING;
+
+  -- Only the duration of successful runs is used
+  UPDATE job_stats SET
+      runs = runs + 1,
+      durations = CASE WHEN p_failed THEN durations ELSE job_stats_window(durations || p_duration) END,
+      failures = job_stats_window(failures || p_failed),
+      cpu = job_stats_window(cpu || p_cpu),
+      memory = job_stats_window(memory || p_memory),
+      updated_at = now()
+  WHERE project_id = p_project_id AND name = p_name AND branch = p_branch;
+
+  UPDATE job_stats SET
+      avg_duration = (SELECT avg(d) FROM unnest(durations) d),
+      p50_duration = (SELECT percentile_cont(0.5) WITHIN GROUP (ORDER BY d) FROM unnest(durations) d),
+      p95_duration = (SELECT percentile_cont(0.95) WITHIN GROUP (ORDER BY d) FROM unnest(durations) d),
+      failure_rate = (SELECT avg(CASE WHEN f THEN 1.0 ELSE 0.0 END) FROM unnest(failures) f),
+      avg_cpu = (SELECT avg(c) FROM unnest(cpu) c),
+      max_memory = (SELECT max(m) FROM unnest(memory) m)
+  WHERE project_id = p_project_id AND name = p_name AND branch = p_branch;
+END;
+$$;
+
+CREATE FUNCTION job_stats_update() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+  duration double precision;
+  failed boolean;
+  memory double precision;
+  branch_name character varying;
+BEGIN
+  IF NEW.type = 'wait' OR NEW.start_date IS NULL OR NEW.end_date IS NULL THEN
+    RETURN NULL;
+  END IF;
+
+  duration := EXTRACT(EPOCH FROM NEW.end_date - NEW.start_date);
+  failed := NEW.state <> 'finished';
+
+  -- Stats are sent by the job, they must not stop the update of the job
+  BEGIN
+    SELECT max((v->>'mem')::double precision) INTO memory
+    FROM json_each(NEW.stats::json) c, json_array_elements(c.value) v;
+  EXCEPTION WHEN others THEN
+    memory := NULL;
+  END;
+
+  SELECT c.branch INTO branch_name
+  FROM build b
+  INNER JOIN commit c
+    ON c.id = b.commit_id
+    AND c.project_id = b.project_id
+  WHERE b.id = NEW.build_id;
+
+  PERFORM job_stats_add(NEW.project_id, NEW.name, '', duration, failed, NEW.avg_cpu, memory);
+
+  IF branch_name IS NOT NULL AND branch_name <> '' THEN
+    PERFORM job_stats_add(NEW.project_id, NEW.name, branch_name, duration, failed, NEW.avg_cpu, memory);
+  END IF;
+
+  RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER job_stats_update AFTER UPDATE OF state ON job
+    FOR EACH ROW
+    WHEN (OLD.state IS DISTINCT FROM NEW.state AND NEW.state IN ('finished', 'failure', 'error'))
+    EXECUTE PROCEDURE job_stats_update();
+
+-- Runs of the last 10 builds
+INSERT INTO job_stats (project_id, name, branch, runs, durations, failures, cpu)
+SELECT j.project_id, j.name, '', count(*),
+       coalesce(array_agg(EXTRACT(EPOCH FROM j.end_date - j.start_date)::double precision ORDER BY b.build_number)
+                FILTER (WHERE j.state = 'finished'), '{}'),
+       array_agg(j.state <> 'finished' ORDER BY b.build_number),
+       array_agg(j.avg_cpu::double precision ORDER BY b.build_number)
+FROM job j
+INNER JOIN build b
+    ON b.id = j.build_id
+    AND b.project_id = j.project_id
+INNER JOIN (
+    SELECT project_id, max(build_number) build_number
+    FROM build
+    GROUP BY project_id
+) l
+    ON l.project_id = b.project_id
+    AND b.build_number > l.build_number - 10
+WHERE j.state IN ('finished', 'failure', 'error')
+AND j.type <> 'wait'
+AND j.start_date IS NOT NULL
+AND j.end_date IS NOT NULL
+GROUP BY j.project_id, j.name;
+
+UPDATE job_stats SET
+    durations = job_stats_window(durations),
+    failures = job_stats_window(failures),
+    cpu = job_stats_window(cpu);
+
+UPDATE job_stats SET
+    avg_duration = (SELECT avg(d) FROM unnest(durations) d),
+    p50_duration = (SELECT percentile_cont(0.5) WITHIN GROUP (ORDER BY d) FROM unnest(durations) d),
+    p95_duration = (SELECT percentile_cont(0.95) WITHIN GROUP (ORDER BY d) FROM unnest(durations) d),
+    failure_rate = (SELECT avg(CASE WHEN f THEN 1.0 ELSE 0.0 END) FROM unnest(failures) f),
+    avg_cpu = (SELECT avg(c) FROM unnest(cpu) c);
@@ -0,0 +1,10 @@
+-- Chunks of the job caches, they are shared by all jobs of a project.
+-- Chunks which have not been used for some time are deleted by the gc.
+CREATE TABLE cache_chunk (
+    project_id uuid NOT NULL,
+    chunk character varying NOT NULL,
+    last_used timestamp with time zone NOT NULL DEFAULT now(),
+    PRIMARY KEY (project_id, chunk)
+);
+
+CREATE INDEX cache_chunk_last_used ON cache_chunk (last_used);
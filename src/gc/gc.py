@@ -6,6 +6,10 @@ from pyinfraboxutils.storage import storage
 
 logger = get_logger("gc")
 
+def get_cache_key(project_id, job_name, extension):
+    key = 'project_%s_job_%s.%s' % (project_id, job_name, extension)
+    return key.replace('/', '_')
+
 class GC(object):
     def run(self):
         # TODO: Delete storage objects: uploads, outputs
@@ -31,6 +35,7 @@ class GC(object):
         self._gc_test_runs(db)
         self._gc_orphaned_projects(db)
         self._gc_storage_job_cache(db)
+        self._gc_storage_cache_chunks(db)
 
     def _gc_job_console_output(self, db):
         # Delete the console output of jobs
@@ -39,7 +44,7 @@ class GC(object):
             SELECT count(*) as count
             FROM job
             WHERE created_at < NOW() - INTERVAL '30 days'
-            AND console != 'deleted'
+            AND console IS DISTINCT FROM 'deleted'
         ''')
 
         logger.info('Deleting console output of %s jobs', r['count'])
@@ -48,7 +53,19 @@ class GC(object):
 	        UPDATE job
             SET console = 'deleted'
             WHERE created_at < NOW() - INTERVAL '30 days'
-            AND console != 'deleted'
+            AND console IS DISTINCT FROM 'deleted'
+        ''')
+
+        # Also the console chunks of deleted jobs
+        r = db.execute('''
+            DELETE
+            FROM console_chunk cc
+            WHERE NOT EXISTS (
+                SELECT j.id
+                FROM job j
+                WHERE j.id = cc.job_id
+                AND j.created_at >= NOW() - INTERVAL '30 days'
+            )
         ''')
 
         db.commit()
@@ -90,6 +107,17 @@ class GC(object):
             WHERE date < NOW() - INTERVAL '1 day'
         ''')
 
+        # Console counters of jobs which have no console entries left
+        r = db.execute('''
+            DELETE
+            FROM console_stats cs
+            WHERE NOT EXISTS (
+                SELECT c.job_id
+                FROM console c
+                WHERE c.job_id = cs.job_id
+            )
+        ''')
+
         db.commit()
 
     def _gc_orphaned_projects(self, db):
@@ -97,7 +125,7 @@ class GC(object):
         # project has been deleted
         tables = [
             'auth_token', 'build', 'collaborator', 'commit',
-            'job', 'job_badge', 'job_markup', 'measurement',
+            'job', 'job_badge', 'job_markup', 'job_stats', 'measurement',
             'pull_request', 'repository', 'secret', 'source_upload',
             'test_run'
         ]
@@ -150,6 +178,37 @@ class GC(object):
             logger.info('Deleting cache %s/%s', j['project_id'], j['name'])
             key = 'project_%s_job_%s.tar.snappy' % (j['project_id'], j['name'])
             storage.delete_cache(key)
+            storage.delete_cache(get_cache_key(j['project_id'], j['name'], 'manifest.json'))
+
+    def _gc_storage_cache_chunks(self, db):
+        # Delete the cache chunks which have not been used for 14 days. A job
+        # marks all chunks of its cache as used when it uploads the cache, the
+        # caches of jobs which have not run for 7 days are already deleted.
+        deleted = 0
+
+        while True:
+            chunks = db.execute_many('''
+                DELETE FROM cache_chunk
+                WHERE last_used < NOW() - INTERVAL '14 days'
+                AND (project_id, chunk) IN (
+                    SELECT project_id, chunk
+                    FROM cache_chunk
+                    WHERE last_used < NOW() - INTERVAL '14 days'
+                    LIMIT 1000
+                )
+                RETURNING project_id, chunk
+            ''')
+            db.commit()
+
+            if not chunks:
+                break
+
+            for project_id, chunk in chunks:
+                storage.delete_cache('project_%s_chunk_%s' % (project_id, chunk))
+
+            deleted += len(chunks)
+
+        logger.info('Deleted %s unused cache chunks', deleted)
 
 def main():
     get_env('INFRABOX_DATABASE_DB')
@@ -0,0 +1,157 @@
+import os
+import tarfile
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from collections import deque
+
+import snappy
+
+# Size of the blocks which are compressed in parallel
+BLOCK_SIZE = 1024 * 1024
+
+# Size of the reads when uncompressing
+READ_SIZE = 1024 * 1024
+
+# The stream identifier, written once at the beginning of the snappy
+# framing format. All following frames are independent of each other.
+STREAM_HEADER = snappy.StreamCompressor().add_chunk(b'')
+
+def _compress_block(data):
+    return snappy.StreamCompressor().add_chunk(data)[len(STREAM_HEADER):]
+
+class SnappyWriter(object):
+    # File object which compresses everything written to it in the snappy
+    # framing format, the same format as 'python -m snappy -c' creates.
+    # Blocks are compressed in parallel by a pool of threads, snappy
+    # releases the GIL while compressing. A process pool could deadlock,
+    # because it would be forked after other threads were started.
+    def __init__(self, output, threads=None):
+        self.output = output
+        self.threads = threads or multiprocessing.cpu_count()
+        self.pool = ThreadPool(self.threads)
+        self.pending = deque()
+        self.buf = []
+        self.buf_size = 0
+        self.size = 0
+
+        self._write_output(STREAM_HEADER)
+
+    def write(self, data):
+        self.buf.append(data)
+        self.buf_size += len(data)
+
+        if self.buf_size >= BLOCK_SIZE:
+            self._flush_block()
+
+    def close(self):
+        try:
+            self._flush_block()
+
+            while self.pending:
+                self._write_output(self.pending.popleft().get())
+        finally:
+            self.pool.terminate()
+
+    def _flush_block(self):
+        if not self.buf:
+            return
+
+        data = b''.join(self.buf)
+        self.buf = []
+        self.buf_size = 0
+
+        self.pending.append(self.pool.apply_async(_compress_block, (data,)))
+
+        # Keep the order of the blocks and only a few of them in memory
+        while len(self.pending) > 2 * self.threads:
+            self._write_output(self.pending.popleft().get())
+
+    def _write_output(self, data):
+        self.output.write(data)
+        self.size += len(data)
+
+class SnappyReader(object):
+    # File object which uncompresses a stream in the snappy framing format
+    def __init__(self, source):
+        self.source = source
+        self.decompressor = snappy.StreamDecompressor()
+        self.buf = b''
+        self.pos = 0
+        self.eof = False
+
+    def read(self, size=-1):
+        result = []
+
+        while size != 0:
+            if self.pos == len(self.buf):
+                if not self._fill():
+                    break
+
+            if size < 0:
+                end = len(self.buf)
+            else:
+                end = min(self.pos + size, len(self.buf))
+                size -= end - self.pos
+
+            result.append(self.buf[self.pos:end])
+            self.pos = end
+
+        return b''.join(result)
+
+    def _fill(self):
+        while not self.eof:
+            data = self.source.read(READ_SIZE)
+
+            if not data:
+                self.decompressor.flush()
+                self.eof = True
+                break
+
+            self.buf = self.decompressor.decompress(data)
+            self.pos = 0
+
+            if self.buf:
+                return True
+
+        return False
+
+def compress(source, output):
+    # Writes the content of the directory source as tar.snappy to the file object output
+    writer = SnappyWriter(output)
+
+    try:
+        with tarfile.open(fileobj=writer, mode='w|', format=tarfile.GNU_FORMAT) as tar:
+            for name in sorted(os.listdir(source)):
+                tar.add(os.path.join(source, name), arcname=name)
+    finally:
+        writer.close()
+
+    return writer.size
+
+def uncompress(source, target):
+    # Extracts the tar.snappy from the file object source into the directory target
+    target = os.path.realpath(target)
+
+    def check_path(member, path):
+        # Symlinks which were already extracted are resolved, too
+        path = os.path.realpath(path)
+
+        if path != target and not path.startswith(target + os.sep):
+            raise ValueError('Invalid path in archive: %s' % member.name)
+
+    def get_members(tar):
+        for member in tar:
+            path = os.path.join(target, member.name)
+            check_path(member, path)
+
+            # Links must not point outside of the target either. Symlinks are
+            # relative to their directory, hardlinks to the archive root.
+            if member.issym():
+                check_path(member, os.path.join(os.path.dirname(path), member.linkname))
+            elif member.islnk():
+                check_path(member, os.path.join(target, member.linkname))
+
+            yield member
+
+    with tarfile.open(fileobj=SnappyReader(source), mode='r|') as tar:
+        tar.extractall(target, members=get_members(tar))
@@ -0,0 +1,238 @@
+import os
+import stat
+import time
+import zlib
+import uuid
+import hashlib
+
+# Maximum size of a chunk, must be the same as in the API
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# Files smaller than CHUNK_SIZE are packed together into one chunk. A pack
+# also ends after every file whose path hash is divisible by PACK_BOUNDARY,
+# so a changed or new file only changes the pack it is in.
+PACK_BOUNDARY = 64
+
+# Chunks in the local chunk directory which haven't been used for this
+# time are removed
+CHUNK_MAX_AGE = 7 * 24 * 60 * 60
+
+MANIFEST_VERSION = 1
+
+def get_chunk_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+def compress_chunk(data):
+    return zlib.compress(data, 1)
+
+def decompress_chunk(data, chunk_hash):
+    data = zlib.decompress(data)
+
+    if get_chunk_hash(data) != chunk_hash:
+        raise ValueError('Chunk %s is corrupted' % chunk_hash)
+
+    return data
+
+def is_pack_boundary(path):
+    if not isinstance(path, bytes):
+        path = path.encode('utf-8')
+
+    return (zlib.crc32(path) & 0xffffffff) % PACK_BOUNDARY == 0
+
+class Pack(object):
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.size = 0
+        self.pieces = []
+        self.segments = []
+        self.hash = hashlib.sha256()
+
+    def add(self, path, data):
+        segment = [None, self.size, len(data)]
+        self.pieces.append([path, 0, len(data)])
+        self.segments.append(segment)
+        self.hash.update(data)
+        self.size += len(data)
+        return segment
+
+    def flush(self):
+        if not self.pieces:
+            return
+
+        # The hash of the pack is only known once it's complete
+        chunk_hash = self.hash.hexdigest()
+        for segment in self.segments:
+            segment[0] = chunk_hash
+
+        self.chunks[chunk_hash] = self.pieces
+        self.__init__(self.chunks)
+
+def create_manifest(source):
+    # Returns the manifest of all files in source and for every
+    # chunk the pieces of the files of which it consists
+    entries = []
+    chunks = {}
+    pack = Pack(chunks)
+
+    for root, dirs, files in os.walk(source):
+        dirs.sort()
+
+        for name in sorted(dirs + files):
+            path = os.path.join(root, name)
+            rel_path = os.path.relpath(path, source)
+            st = os.lstat(path)
+
+            if stat.S_ISLNK(st.st_mode):
+                entries.append({
+                    'path': rel_path,
+                    'type': 'symlink',
+                    'target': os.readlink(path)
+                })
+            elif stat.S_ISDIR(st.st_mode):
+                entries.append({
+                    'path': rel_path,
+                    'type': 'dir',
+                    'mode': stat.S_IMODE(st.st_mode)
+                })
+            elif stat.S_ISREG(st.st_mode):
+                segments = []
+
+                with open(path, 'rb') as f:
+                    if st.st_size >= CHUNK_SIZE:
+                        offset = 0
+                        while True:
+                            data = f.read(CHUNK_SIZE)
+
+                            if not data:
+                                break
+
+                            chunk_hash = get_chunk_hash(data)
+                            chunks[chunk_hash] = [[path, offset, len(data)]]
+                            segments.append([chunk_hash, 0, len(data)])
+                            offset += len(data)
+                    elif st.st_size > 0:
+                        data = f.read()
+
+                        if pack.size + len(data) > CHUNK_SIZE:
+                            pack.flush()
+
+                        segments.append(pack.add(path, data))
+
+                        if is_pack_boundary(rel_path):
+                            pack.flush()
+
+                entries.append({
+                    'path': rel_path,
+                    'type': 'file',
+                    'mode': stat.S_IMODE(st.st_mode),
+                    'mtime': int(st.st_mtime),
+                    'segments': segments
+                })
+
+    pack.flush()
+
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'entries': entries
+    }
+
+    return manifest, chunks
+
+def get_chunks(manifest):
+    result = set()
+
+    for e in manifest['entries']:
+        for s in e.get('segments', []):
+            result.add(s[0])
+
+    return result
+
+def read_chunk(pieces):
+    data = []
+
+    for path, offset, length in pieces:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data.append(f.read(length))
+
+    return b''.join(data)
+
+def get_chunk_path(chunk_dir, chunk_hash):
+    return os.path.join(chunk_dir, chunk_hash)
+
+def store_chunk(chunk_dir, chunk_hash, path):
+    # Rename is atomic, so other jobs never see a partially written chunk
+    os.rename(path, get_chunk_path(chunk_dir, chunk_hash))
+
+def get_temp_chunk_path(chunk_dir, chunk_hash):
+    return os.path.join(chunk_dir, '%s.%s.tmp' % (chunk_hash, uuid.uuid4().hex))
+
+def load_chunk(chunk_dir, chunk_hash):
+    path = get_chunk_path(chunk_dir, chunk_hash)
+
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    try:
+        data = decompress_chunk(data, chunk_hash)
+    except Exception:
+        # Download it again next time
+        os.remove(path)
+        raise
+
+    # Mark the chunk as used
+    os.utime(path, None)
+    return data
+
+def prune_chunks(chunk_dir):
+    now = time.time()
+
+    for name in os.listdir(chunk_dir):
+        path = os.path.join(chunk_dir, name)
+
+        try:
+            if now - os.path.getmtime(path) > CHUNK_MAX_AGE:
+                os.remove(path)
+        except OSError:
+            # Removed by another job
+            pass
+
+def restore_manifest(manifest, target, chunk_dir):
+    target = os.path.realpath(target)
+
+    # Entries of a pack are next to each other, so
+    # every chunk has to be decompressed only once
+    current = [None, None]
+
+    def get_chunk(chunk_hash):
+        if current[0] != chunk_hash:
+            current[1] = load_chunk(chunk_dir, chunk_hash)
+            current[0] = chunk_hash
+
+        return current[1]
+
+    for e in manifest['entries']:
+        path = os.path.abspath(os.path.join(target, e['path']))
+
+        if not path.startswith(target + os.sep):
+            raise ValueError('Invalid path in cache: %s' % e['path'])
+
+        # Symlinks of the cache must not redirect any entry out of the target
+        parent = os.path.realpath(os.path.dirname(path))
+        if os.path.islink(path) or (parent != target and not parent.startswith(target + os.sep)):
+            raise ValueError('Invalid path in cache: %s' % e['path'])
+
+        if e['type'] == 'dir':
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+            os.chmod(path, e['mode'])
+        elif e['type'] == 'symlink':
+            os.symlink(e['target'], path)
+        elif e['type'] == 'file':
+            with open(path, 'wb') as f:
+                for chunk_hash, offset, length in e['segments']:
+                    f.write(get_chunk(chunk_hash)[offset:offset + length])
+
+            os.chmod(path, e['mode'])
+            os.utime(path, (e['mtime'], e['mtime']))
@@ -1,13 +1,185 @@
 import os
 import sys
 import json
-import glob
 import copy
 import time
-import shutil
+import random
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
 import requests
 
 from infrabox_job.process import Failure
+from infrabox_job import cache
+
+# Size of the parts of multipart uploads
+MULTIPART_PART_SIZE = 32 * 1024 * 1024
+
+# Number of parts which are uploaded at the same time
+MULTIPART_PARALLEL_UPLOADS = 4
+
+# Size of the chunks in which streamed downloads are read
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Number of cache chunks which are transferred at the same time
+CACHE_PARALLEL_TRANSFERS = 8
+
+# Max number of chunks the API checks at once
+CACHE_CHUNKS_PER_REQUEST = 1000
+
+# Number of files which are uploaded at the same time
+UPLOAD_PARALLEL_FILES = 8
+
+# Max delay between two attempts of an upload, in seconds
+RETRY_MAX_DELAY = 30
+
+def get_retry_delay(attempt):
+    # Exponential backoff with jitter, so parallel uploads don't retry in lockstep
+    delay = min(2 ** attempt, RETRY_MAX_DELAY)
+    return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+class MultipartUpload(object):
+    # File object which uploads everything written to it as multipart upload.
+    # Parts are uploaded in parallel while the next ones are written.
+    def __init__(self, job, kind, filename):
+        self.job = job
+        self.url = '%s/multipart/%s' % (job.api_server, kind)
+        self.params = {'filename': filename}
+        self.params['upload_id'] = job._post_multipart(self.url + '/start', self.params)['upload_id']
+        self.pool = ThreadPool(MULTIPART_PARALLEL_UPLOADS)
+        self.pending = deque()
+        self.parts = []
+        self.buf = []
+        self.buf_size = 0
+        self.size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type:
+            self.abort()
+        else:
+            self.close()
+
+    def write(self, data):
+        self.buf.append(data)
+        self.buf_size += len(data)
+        self.size += len(data)
+
+        if self.buf_size >= MULTIPART_PART_SIZE:
+            self._flush_part()
+
+    def close(self):
+        try:
+            # An empty file is uploaded as one empty part
+            if self.buf or (not self.pending and not self.parts):
+                self._flush_part()
+
+            while self.pending:
+                self.parts.append(self.pending.popleft().get())
+        except:
+            self.abort()
+            raise
+
+        self.pool.close()
+        self.job._post_multipart(self.url + '/complete', self.params, data={'parts': self.parts})
+
+    def abort(self):
+        self.pool.terminate()
+
+        try:
+            self.job._post_multipart(self.url + '/abort', self.params)
+        except Exception as e:
+            print(e)
+
+    def _flush_part(self):
+        data = b''.join(self.buf)
+        self.buf = []
+        self.buf_size = 0
+
+        part_params = dict(self.params)
+        part_params['part'] = len(self.parts) + len(self.pending) + 1
+        self.pending.append(self.pool.apply_async(self.job._post_multipart,
+                                                  (self.url + '/part', part_params),
+                                                  {'files': {'part': data}}))
+
+        # Only keep the parts in memory which are currently uploaded
+        while len(self.pending) > MULTIPART_PARALLEL_UPLOADS:
+            self.parts.append(self.pending.popleft().get())
+
+class ApiFileReader(object):
+    # File object which streams files from the API one after another.
+    # Interrupted downloads are resumed where they stopped.
+    def __init__(self, job, urls, response=None):
+        self.job = job
+        self.urls = urls
+        self.response = response
+        self.chunks = self._iter_chunks()
+        self.buf = b''
+        self.pos = 0
+
+    def read(self, size=-1):
+        result = []
+
+        while size != 0:
+            if self.pos == len(self.buf):
+                self.buf = next(self.chunks, b'')
+                self.pos = 0
+
+                if not self.buf:
+                    break
+
+            if size < 0:
+                end = len(self.buf)
+            else:
+                end = min(self.pos + size, len(self.buf))
+                size -= end - self.pos
+
+            result.append(self.buf[self.pos:end])
+            self.pos = end
+
+        return b''.join(result)
+
+    def _iter_chunks(self):
+        for url in self.urls:
+            r = self.response
+            self.response = None
+
+            for chunk in self._iter_file(url, r):
+                yield chunk
+
+    def _iter_file(self, url, r):
+        offset = 0
+
+        for _ in xrange(0, 20):
+            if not r:
+                r = self.job._request_file_from_api_server(url, offset)
+
+            if not r:
+                raise Failure('Failed to download file: %s not found' % url)
+
+            # The whole file is sent again if the range is not supported
+            skip = offset if r.status_code == 200 else 0
+
+            try:
+                for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    if skip:
+                        n = min(skip, len(chunk))
+                        chunk = chunk[n:]
+                        skip -= n
+
+                    if chunk:
+                        offset += len(chunk)
+                        yield chunk
+
+                return
+            except Exception as e:
+                self.job.console.collect('Download interrupted (%s), resuming' % e, show=True)
+                r = None
+                time.sleep(10)
+
+        raise Failure('Failed to download file: %s' % url)
 
 class Job(object):
     def __init__(self):
@@ -17,6 +189,12 @@ class Job(object):
         if os.environ.get('INFRABOX_GENERAL_DONT_CHECK_CERTIFICATES', 'false') == 'true':
             self.verify = False
 
+        # Keep-alive connections to the API, shared by all upload threads
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=UPLOAD_PARALLEL_FILES)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
         self.job = None
         self.project = None
         self.build = None
@@ -30,15 +208,17 @@ class Job(object):
         self.source_upload = None
         self.deployments = None
         self.registries = None
+        self.cache_manifest = None
 
     def load_data(self):
+        retry_delay = 1
+
         while True:
             try:
                 r = requests.get("%s/job" % self.api_server,
                                  headers=self.get_headers(),
                                  timeout=10,
                                  verify=self.verify)
-                time.sleep(1)
 
                 if r.status_code == 409:
                     sys.exit(0)
@@ -53,14 +233,15 @@ class Job(object):
                     raise Failure(msg)
                 elif r.status_code == 200:
                     break
-                else:
-                    # Retry on any other error
-                    continue
             except Failure:
                 raise
             except Exception as e:
                 print(e)
 
+            # Retry on any other error
+            time.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, 30)
+
         data = r.json()
         self.job = data['job']
         self.project = data['project']
@@ -141,39 +322,63 @@ class Job(object):
 
         self.post_api_server('stats', data=payload)
 
-    def get_file_from_api_server(self, url, path, split=False):
-        if split:
-            if os.path.isfile('/tmp/output.json'):
-                os.remove('/tmp/output.json')
+    def get_file_from_api_server(self, url, path):
+        self._get_file_from_api_server(url, path)
 
-            self._get_file_from_api_server(url + "?filename=output.json", '/tmp/output.json')
+    def open_file_from_api_server(self, url, filename=None):
+        # Returns a file object which streams the file or None if it doesn't exist.
+        # If filename is set the file may have been uploaded split into the parts
+        # listed in output.json.
+        if filename:
+            r = self._request_file_from_api_server(url + "?filename=output.json")
 
-            if not os.path.isfile('/tmp/output.json'):
-                return
+            if r:
+                return ApiFileReader(self, [url + "?filename=" + f for f in r.json()])
 
-            with open('/tmp/output.json') as filelist:
-                files = json.load(filelist)
+            url = url + "?filename=" + filename
 
-            if os.path.exists('/tmp/output'):
-                shutil.rmtree('/tmp/output')
+        r = self._request_file_from_api_server(url)
 
-            os.makedirs('/tmp/output/parts')
+        if not r:
+            return None
 
-            with open(path, 'w+b') as final:
-                for f in files:
-                    self._get_file_from_api_server(url + "?filename=" + f, '/tmp/output/parts/%s' % f)
+        return ApiFileReader(self, [url], r)
 
-                    with open('/tmp/output/parts/%s' % f, 'rb') as part:
-                        shutil.copyfileobj(part, final, 1024*1024*10)
+    def _request_file_from_api_server(self, url, offset=0):
+        # Returns the streamed response or None if the file doesn't exist
+        message = None
 
-                    os.remove('/tmp/output/parts/%s' % f)
+        for _ in xrange(0, 20):
+            headers = self.get_headers()
 
-            shutil.rmtree('/tmp/output')
-        else:
-            self._get_file_from_api_server(url, path)
+            if offset:
+                headers['Range'] = 'bytes=%s-' % offset
+
+            try:
+                r = requests.get("%s%s" % (self.api_server, url),
+                                 headers=headers, timeout=600,
+                                 stream=True, verify=self.verify)
+            except Exception as e:
+                message = str(e)
+                self.console.collect('Failed to download file (%s), retrying' % message, show=True)
+                time.sleep(10)
+                continue
+
+            if r.status_code == 404:
+                return None
 
-    def _get_file_from_api_server(self, url, path):
-        self.console.collect('Downloading %s' % path, show=True)
+            if r.status_code in (200, 206):
+                return r
+
+            message = r.text
+            self.console.collect('Failed to download file (%s), retrying' % r.status_code, show=True)
+            time.sleep(10)
+
+        raise Failure('Failed to download file: %s' % message)
+
+    def _get_file_from_api_server(self, url, path, log=True):
+        if log:
+            self.console.collect('Downloading %s' % path, show=True)
 
         message = None
 
@@ -219,48 +424,37 @@ class Job(object):
 
             raise Failure('Failed to download file(%s): %s' % (r.status_code, msg))
 
-    def post_file_to_api_server(self, url, path, filename=None, split=False):
+    def post_file_to_api_server(self, url, path, filename=None):
         if not filename:
             filename = os.path.basename(path)
 
-        if split:
-            self.console.execute(["split", "-b", "64m", path, path + "-"], show=True)
-            files = glob.glob(path + "-*")
-            files.sort()
-
-            filenames = []
-            for f in files:
-                filenames.append(os.path.basename(f))
-
-            with open('/tmp/files.json', 'w') as out:
-                json.dump(filenames, out)
+        self._post_files_to_api_server(url, [(filename, path)])
 
-            self._post_file_to_api_server(url, '/tmp/files.json', 'output.json')
+    def post_files_to_api_server(self, url, paths):
+        # Uploads several small files with one request
+        self._post_files_to_api_server(url, [(os.path.basename(p), p) for p in paths])
 
-            for f in files:
-                self._post_file_to_api_server(url, f, os.path.basename(f))
-        else:
-            self._post_file_to_api_server(url, path, filename)
-
-    def _post_file_to_api_server(self, url, path, filename):
-        self.console.collect('Uploading %s' % path, show=True)
+    def open_multipart_upload(self, kind, filename):
+        # The parts are committed as one file when the upload is closed
+        return MultipartUpload(self, kind, filename)
 
+    def _post_multipart(self, url, params, files=None, data=None):
         message = None
 
-        for _ in xrange(0, 5):
+        for attempt in xrange(0, 5):
             message = None
-            files = {filename: open(path)}
             try:
-                r = requests.post("%s%s" % (self.api_server, url),
-                                  headers=self.get_headers(),
-                                  files=files, timeout=600, verify=self.verify)
+                r = self.session.post(url, params=params,
+                                      headers=self.get_headers(),
+                                      files=files, json=data,
+                                      timeout=600, verify=self.verify)
             except Exception as e:
                 message = str(e)
-                time.sleep(5)
+                time.sleep(get_retry_delay(attempt))
                 continue
 
             if r.status_code != 200:
-                time.sleep(5)
+                time.sleep(get_retry_delay(attempt))
                 message = r.text
 
                 try:
@@ -268,6 +462,122 @@ class Job(object):
                 except:
                     pass
             else:
+                return r.json()
+
+        raise Failure('Failed to upload file: %s' % message)
+
+    def download_cache(self, target, storage_dir, chunk_dir):
+        # Restores the cache from its manifest, only chunks which are
+        # not yet in chunk_dir are downloaded. Returns False if the
+        # cache has not been uploaded as manifest.
+        manifest_path = os.path.join(storage_dir, 'manifest.json')
+        self._get_file_from_api_server('/cache/manifest', manifest_path)
+
+        if not os.path.isfile(manifest_path):
+            return False
+
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+        os.remove(manifest_path)
+
+        if not os.path.exists(chunk_dir):
+            os.makedirs(chunk_dir)
+
+        cache.prune_chunks(chunk_dir)
+
+        chunks = cache.get_chunks(manifest)
+        missing = [c for c in chunks if not os.path.exists(cache.get_chunk_path(chunk_dir, c))]
+
+        self.console.collect('Downloading %s of %s chunks' % (len(missing), len(chunks)), show=True)
+
+        def download_chunk(chunk_hash):
+            path = cache.get_temp_chunk_path(chunk_dir, chunk_hash)
+            self._get_file_from_api_server('/cache/chunks/%s' % chunk_hash, path, log=False)
+
+            if not os.path.isfile(path):
+                raise Failure('Chunk %s not found' % chunk_hash)
+
+            cache.store_chunk(chunk_dir, chunk_hash, path)
+
+        pool = ThreadPool(CACHE_PARALLEL_TRANSFERS)
+        try:
+            pool.map(download_chunk, missing)
+        finally:
+            pool.close()
+
+        cache.restore_manifest(manifest, target, chunk_dir)
+        self.cache_manifest = manifest
+        return True
+
+    def upload_cache(self, source):
+        # Uploads the cache as manifest, only chunks which
+        # are not yet stored for the project are uploaded
+        manifest, chunks = cache.create_manifest(source)
+
+        # All chunks are checked, also if the cache has not changed,
+        # because this marks them as used and the gc keeps them
+        candidates = sorted(chunks)
+
+        missing = []
+        for i in xrange(0, len(candidates), CACHE_CHUNKS_PER_REQUEST):
+            data = {'chunks': candidates[i:i + CACHE_CHUNKS_PER_REQUEST]}
+            missing += self._post_multipart('%s/cache/chunks' % self.api_server, {}, data=data)['missing']
+
+        if manifest == self.cache_manifest and not missing:
+            self.console.collect('Cache has not changed', show=True)
+            return
+
+        self.console.collect('Uploading %s of %s chunks' % (len(missing), len(chunks)), show=True)
+
+        def upload_chunk(chunk_hash):
+            data = cache.compress_chunk(cache.read_chunk(chunks[chunk_hash]))
+            self._post_multipart('%s/cache/chunks/%s' % (self.api_server, chunk_hash), {},
+                                 files={'chunk': data})
+
+        pool = ThreadPool(CACHE_PARALLEL_TRANSFERS)
+        try:
+            pool.map(upload_chunk, missing)
+        finally:
+            pool.close()
+
+        # Committed last, so the manifest never references missing chunks
+        self._post_multipart('%s/cache/manifest' % self.api_server, {}, data=manifest)
+        self.cache_manifest = manifest
+
+    def _post_files_to_api_server(self, url, files):
+        # files is a list of (name, path), may be called from several threads
+        message = None
+
+        for attempt in xrange(0, 5):
+            message = None
+            handles = [(name, open(path, 'rb')) for name, path in files]
+            try:
+                r = self.session.post("%s%s" % (self.api_server, url),
+                                      headers=self.get_headers(),
+                                      files=handles, timeout=600, verify=self.verify)
+            except Exception as e:
+                message = str(e)
+                time.sleep(get_retry_delay(attempt))
+                continue
+            finally:
+                for _, h in handles:
+                    h.close()
+
+            if r.status_code == 200:
                 return
 
+            message = r.text
+
+            try:
+                message = r.json()['message']
+            except:
+                pass
+
+            if 400 <= r.status_code < 500:
+                # The files have been rejected, sending them again won't help
+                break
+
+            time.sleep(get_retry_delay(attempt))
+
         raise Failure('Failed to upload file: %s' % message)
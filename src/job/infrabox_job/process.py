@@ -104,10 +104,16 @@ class ApiConsole(object):
                 'Authorization': 'token ' + os.environ['INFRABOX_JOB_TOKEN']
             }
 
-            requests.post("%s/consoleupdate" % api_server,
-                          headers=headers,
-                          verify=self.verify,
-                          json=payload).json()
+            r = requests.post("%s/consoleupdate" % api_server,
+                              headers=headers,
+                              verify=self.verify,
+                              json=payload)
+
+            # The output has not been stored, send it again with the next flush
+            if r.status_code >= 500:
+                r.raise_for_status()
+
+            r.json()
             self.output = []
         except Exception as e:
             print(e)
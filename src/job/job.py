@@ -9,6 +9,8 @@ import subprocess
 import uuid
 import base64
 import traceback
+from functools import partial
+from multiprocessing.pool import ThreadPool
 import urllib3
 import yaml
 
@@ -17,7 +19,8 @@ from pyinfrabox.docker_compose import create_from
 
 from infrabox_job.stats import StatsCollector
 from infrabox_job.process import ApiConsole, Failure
-from infrabox_job.job import Job
+from infrabox_job.job import Job, UPLOAD_PARALLEL_FILES
+from infrabox_job import archive
 from infrabox_job import find_infrabox_file
 
 from pyinfraboxutils.testresult import Parser as TestresultParser
@@ -28,6 +31,12 @@ from pyinfraboxutils import get_logger
 urllib3.disable_warnings()
 logger = get_logger('scheduler')
 
+# Number of parent outputs which are downloaded at the same time
+PARALLEL_INPUT_DOWNLOADS = 4
+
+# Max number of markup or badge files of one upload, must be the same as in the API
+JSON_UPLOADS_PER_REQUEST = 10
+
 def makedirs(path):
     os.makedirs(path)
     os.chmod(path, 0o777)
@@ -131,13 +140,9 @@ class RunJob(Job):
     def flush(self):
         self.console.flush()
 
-    def compress(self, source, output):
-        cmd = "tar -cf - --directory %s . | pv -L 500m | python -m snappy -c - %s" % (source, output)
-        self.console.execute(cmd, cwd=source, show=True, shell=True, show_cmd=False)
-
     def uncompress(self, source, output):
-        cmd = "python -m snappy -d %s - | tar -xf - -C %s" % (source, output)
-        self.console.execute(cmd, cwd=output, show=True, shell=True, show_cmd=False)
+        with open(source, 'rb') as f:
+            archive.uncompress(f, output)
 
     def get_files_in_dir(self, d, ending=None):
         result = []
@@ -328,28 +333,6 @@ class RunJob(Job):
         r = parser.parse(self.infrabox_badge_dir)
         return r
 
-    def upload_archive(self):
-        c = self.console
-
-        if os.path.exists(self.infrabox_archive_dir):
-            files = self.get_files_in_dir(self.infrabox_archive_dir)
-
-            if files:
-                c.collect("Uploading /infrabox/upload/archive", show=True)
-
-                for f in files:
-                    c.collect("%s\n" % f, show=True)
-                    self.post_file_to_api_server("/archive", f, filename=f.replace(self.infrabox_upload_dir, ''))
-
-        if os.path.exists(self.infrabox_testresult_dir):
-            files = self.get_files_in_dir(self.infrabox_testresult_dir)
-
-            if files:
-
-                for f in files:
-                    c.collect("%s\n" % f, show=True)
-
-
     def upload_coverage_results(self):
         if not os.path.exists(self.infrabox_coverage_dir):
             return
@@ -365,69 +348,124 @@ class RunJob(Job):
             json.dump(converted_result, out)
 
     def convert_test_result(self, f):
+        # One test per line, so neither the job nor the API
+        # has to keep all tests of a huge report in memory
         parser = TestresultParser(f)
-        r = parser.parse(self.infrabox_badge_dir)
 
-        out = f + '.json'
+        out = f + '.ndjson'
         with open(out, 'w') as testresult:
-            json.dump(r, testresult)
+            parser.write_ndjson(testresult)
 
         return out
 
-    def upload_test_results(self):
+    def get_test_result_uploads(self):
         c = self.console
         if not os.path.exists(self.infrabox_testresult_dir):
-            return
+            return []
 
         c.collect("Uploading /infrabox/upload/testresult", show=True)
         files = self.get_files_in_dir(self.infrabox_testresult_dir, ending=".xml")
+        uploads = []
         for f in files:
             c.collect("%s\n" % f, show=True)
-            self.post_file_to_api_server("/archive", f, filename=f.replace(self.infrabox_upload_dir, ''))
+            uploads.append(partial(self.post_file_to_api_server, "/archive", f,
+                                   filename=f.replace(self.infrabox_upload_dir, '')))
 
             try:
                 converted_result = self.convert_test_result(f)
-                self.post_file_to_api_server("/testresult", converted_result, filename='data')
             except Exception as e:
-                self.console.collect("Failed to parse test result: %s \n" % e, show=True)
+                c.collect("Failed to parse test result: %s \n" % e, show=True)
+                continue
+
+            uploads.append(partial(self.upload_test_result, converted_result))
+
+        return uploads
+
+    def upload_test_result(self, converted_result):
+        try:
+            self.post_file_to_api_server("/testresult", converted_result, filename='data')
+        except Exception as e:
+            return "Failed to upload test result: %s \n" % e
 
+        return None
 
-    def upload_markdown_files(self):
+    def get_markdown_uploads(self):
         c = self.console
         if not os.path.exists(self.infrabox_markdown_dir):
-            return
+            return []
 
         files = self.get_files_in_dir(self.infrabox_markdown_dir, ending=".md")
+        uploads = []
         for f in files:
             c.collect("%s\n" % f, show=True)
 
             file_name = os.path.basename(f)
-            self.post_file_to_api_server("/markdown", f, filename=file_name)
+            uploads.append(partial(self.post_file_to_api_server, "/markdown", f, filename=file_name))
+
+        return uploads
 
-    def upload_markup_files(self):
+    def get_json_uploads(self, directory, url):
+        # Markup and badge files are small, they are uploaded in batches
         c = self.console
-        if not os.path.exists(self.infrabox_markup_dir):
-            return
+        if not os.path.exists(directory):
+            return []
+
+        files = self.get_files_in_dir(directory, ending=".json")
+        if not files:
+            return []
 
-        files = self.get_files_in_dir(self.infrabox_markup_dir, ending=".json")
         for f in files:
             c.collect("%s\n" % f, show=True)
 
-            file_name = os.path.basename(f)
-            self.post_file_to_api_server("/markup", f, filename=file_name)
+        return [partial(self.post_files_to_api_server, url, files[i:i + JSON_UPLOADS_PER_REQUEST])
+                for i in range(0, len(files), JSON_UPLOADS_PER_REQUEST)]
 
-    def upload_badge_files(self):
+    def get_archive_uploads(self):
         c = self.console
-        if not os.path.exists(self.infrabox_badge_dir):
-            return
 
-        files = self.get_files_in_dir(self.infrabox_badge_dir, ending=".json")
+        if not os.path.exists(self.infrabox_archive_dir):
+            return []
+
+        files = self.get_files_in_dir(self.infrabox_archive_dir)
+        if not files:
+            return []
 
+        c.collect("Uploading /infrabox/upload/archive", show=True)
+        uploads = []
         for f in files:
             c.collect("%s\n" % f, show=True)
+            uploads.append(partial(self.post_file_to_api_server, "/archive", f,
+                                   filename=f.replace(self.infrabox_upload_dir, '')))
+
+        return uploads
+
+    def upload_files(self):
+        # The uploads are collected first, test results are converted to
+        # ndjson on the way. Then all files are uploaded at the same time
+        # by a pool of threads.
+        uploads = []
+        uploads += self.get_test_result_uploads()
+        uploads += self.get_markdown_uploads()
+        uploads += self.get_json_uploads(self.infrabox_markup_dir, "/markup")
+        uploads += self.get_json_uploads(self.infrabox_badge_dir, "/badge")
+        uploads += self.get_archive_uploads()
+
+        if not uploads:
+            return
 
-            file_name = os.path.basename(f)
-            self.post_file_to_api_server("/badge", f, filename=file_name)
+        pool = ThreadPool(UPLOAD_PARALLEL_FILES)
+        try:
+            results = [pool.apply_async(u) for u in uploads]
+        finally:
+            pool.close()
+            pool.join()
+
+        # The console is only used by this thread
+        for r in results:
+            message = r.get()
+
+            if message:
+                self.console.collect(message, show=True)
 
     def create_dynamic_jobs(self):
         c = self.console
@@ -458,30 +496,35 @@ class RunJob(Job):
                 total_size += os.path.getsize(fp)
         return total_size
 
+    def sync_input(self, dep):
+        # Streams the output of the parent into its input directory,
+        # without storing the archive on disk
+        f = self.open_file_from_api_server('/output/%s' % dep['id'], filename='output.tar.snappy')
+
+        if not f:
+            return None
+
+        infrabox_input_dir = os.path.join(self.infrabox_inputs_dir, dep['name'].split('/')[-1])
+        os.makedirs(infrabox_input_dir)
+        archive.uncompress(f, infrabox_input_dir)
+        return infrabox_input_dir
+
     def main_run_job(self):
         c = self.console
         self.create_jobs_json()
 
-        # base dir for inputs
-        storage_inputs_dir = os.path.join(self.storage_dir, 'inputs')
-
         # Sync deps
         c.collect("Syncing inputs:", show=True)
-        for dep in self.parents:
-            storage_input_file_dir = os.path.join(storage_inputs_dir, dep['id'])
-            os.makedirs(storage_input_file_dir)
-
-            # Get files.json
-            storage_input_file_tar = os.path.join(storage_input_file_dir, 'output.tar.snappy')
-            self.get_file_from_api_server('/output/%s' % dep['id'], storage_input_file_tar, split=True)
+        pool = ThreadPool(PARALLEL_INPUT_DOWNLOADS)
+        try:
+            infrabox_input_dirs = pool.map(self.sync_input, self.parents)
+        finally:
+            pool.close()
 
-            if os.path.isfile(storage_input_file_tar):
+        for dep, infrabox_input_dir in zip(self.parents, infrabox_input_dirs):
+            if infrabox_input_dir:
                 c.collect("output found for %s\n" % dep['name'], show=True)
-                infrabox_input_dir = os.path.join(self.infrabox_inputs_dir, dep['name'].split('/')[-1])
-                os.makedirs(infrabox_input_dir)
-                self.uncompress(storage_input_file_tar, infrabox_input_dir)
                 c.execute(['ls', '-alh', infrabox_input_dir], show=True)
-                os.remove(storage_input_file_tar)
             else:
                 c.collect("no output found for %s\n" % dep['name'], show=True)
         c.collect("\n", show=True)
@@ -493,13 +536,35 @@ class RunJob(Job):
 
         storage_cache_tar = os.path.join(storage_cache_dir, 'cache.tar.snappy')
 
+        # Keep the chunks on the node if possible, so the next jobs only download changed chunks
+        keep_cache_chunks = os.environ.get('INFRABOX_LOCAL_CACHE_ENABLED', 'false') == 'true' and \
+                            os.path.isdir('/local-cache')
+
+        if keep_cache_chunks:
+            cache_chunk_dir = '/local-cache/.infrabox/cache-chunks'
+        else:
+            cache_chunk_dir = os.path.join(storage_cache_dir, 'chunks')
+
         c.collect("Syncing cache:", show=True)
         if not self.job['definition'].get('cache', {}).get('data', True):
             c.collect("Not downloading cache, because cache.data has been set to false", show=True)
         else:
-            self.get_file_from_api_server("/cache", storage_cache_tar)
+            restored = False
+            try:
+                restored = self.download_cache(self.infrabox_cache_dir, storage_cache_dir, cache_chunk_dir)
+            except Exception as e:
+                c.collect("Failed to restore cache: %s\n" % e, show=True)
+
+            if not keep_cache_chunks:
+                shutil.rmtree(cache_chunk_dir, True)
+
+            if not restored:
+                # Caches uploaded before the manifest format existed
+                self.get_file_from_api_server("/cache", storage_cache_tar)
 
-            if os.path.isfile(storage_cache_tar):
+            if restored:
+                c.collect("Restored cache", show=True)
+            elif os.path.isfile(storage_cache_tar):
                 c.collect("Unpacking cache", show=True)
                 try:
                     self.uncompress(storage_cache_tar, self.infrabox_cache_dir)
@@ -523,43 +588,30 @@ class RunJob(Job):
             raise
         finally:
             self.upload_coverage_results()
-            self.upload_test_results()
-            self.upload_markdown_files()
-            self.upload_markup_files()
-            self.upload_badge_files()
-            self.upload_archive()
+            self.upload_files()
 
         self.create_dynamic_jobs()
 
         # Compressing output
         c.collect("Uploading /infrabox/output", show=True)
         if os.path.isdir(self.infrabox_output_dir) and os.listdir(self.infrabox_output_dir):
-            storage_output_dir = os.path.join(self.storage_dir, self.job['id'])
-            os.makedirs(storage_output_dir)
+            # Compressed and uploaded at the same time, without a file in between
+            with self.open_multipart_upload("output", "output.tar.snappy") as upload:
+                archive.compress(self.infrabox_output_dir, upload)
 
-            storage_output_tar = os.path.join(storage_output_dir, 'output.tar.snappy')
-            self.compress(self.infrabox_output_dir, storage_output_tar)
-            file_size = os.stat(storage_output_tar).st_size
-
-            c.collect("Output size: %s kb" % (file_size / 1024), show=True)
-            self.post_file_to_api_server("/output", storage_output_tar, split=True)
+            c.collect("Output size: %s kb" % (upload.size / 1024), show=True)
         else:
             c.collect("Output is empty", show=True)
 
         c.collect("\n", show=True)
 
-        # Compressing cache
+        # Uploading changed cache chunks
         c.collect("Uploading /infrabox/cache", show=True)
         if not self.job['definition'].get('cache', {}).get('data', True):
             c.collect("Not updating cache, because cache.data has been set to false", show=True)
         else:
             if os.path.isdir(self.infrabox_cache_dir) and os.listdir(self.infrabox_cache_dir):
-                self.compress(self.infrabox_cache_dir, storage_cache_tar)
-
-                file_size = os.stat(storage_cache_tar).st_size
-
-                c.collect("Output size: %s kb" % (file_size / 1024), show=True)
-                self.post_file_to_api_server('/cache', storage_cache_tar)
+                self.upload_cache(self.infrabox_cache_dir)
             else:
                 c.collect("Cache is empty", show=True)
         c.collect("\n", show=True)
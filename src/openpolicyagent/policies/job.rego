@@ -61,4 +61,34 @@ allow {
     suffix = job_suffix[_]
     api.token.type = "job"
     api.token.job.state = job_state[_]
-}
\ No newline at end of file
+}
+
+# Allow access to /api/job/cache/<suffix> for valid job tokens
+allow {
+    cache_method := {"GET", "POST"}
+    api.method = cache_method[_]
+    api.path = ["api", "job", "cache", suffix]
+    cache_suffix := {"manifest", "chunks"}
+    suffix = cache_suffix[_]
+    api.token.type = "job"
+    api.token.job.state = job_state[_]
+}
+
+# Allow access to /api/job/cache/chunks/<chunk> for valid job tokens
+allow {
+    cache_method := {"GET", "POST"}
+    api.method = cache_method[_]
+    api.path = ["api", "job", "cache", "chunks", _]
+    api.token.type = "job"
+    api.token.job.state = job_state[_]
+}
+
+# Allow POST access to /api/job/multipart/output/<action> for valid job tokens
+allow {
+    api.method = "POST"
+    api.path = ["api", "job", "multipart", "output", action]
+    multipart_action := {"start", "part", "complete", "abort"}
+    action = multipart_action[_]
+    api.token.type = "job"
+    api.token.job.state = job_state[_]
+}
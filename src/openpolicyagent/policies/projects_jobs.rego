@@ -196,6 +196,21 @@ allow {
     project_jobs_public(project_id)
 }
 
+# Allow GET /api/v1/projects/<project_id>/jobs/<job_id>/duration for collaborators
+allow {
+    api.method = "GET"
+    api.path = ["api", "v1", "projects", project_id, "jobs", _, "duration"]
+    api.token.type = "user"
+    project_jobs_collaborator([api.token.user.id, project_id])
+}
+
+# Allow GET /api/v1/projects/<project_id>/jobs/<job_id>/duration if project is public
+allow {
+    api.method = "GET"
+    api.path = ["api", "v1", "projects", project_id, "jobs", _, "duration"]
+    project_jobs_public(project_id)
+}
+
 # Allow GET /api/v1/projects/<project_id>/jobs/<job_id>/cache/clear for collaborators
 allow {
     api.method = "GET"
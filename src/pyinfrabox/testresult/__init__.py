@@ -66,3 +66,12 @@ def parse_document(d):
 
 def validate_result(d):
     parse_document(d)
+
+def validate_header(d):
+    # First line of a result in the NDJSON format
+    check_allowed_properties(d, "#", ("version",))
+    check_required_properties(d, "#", ("version",))
+    check_version(d['version'], "#version")
+
+def validate_test(d, path):
+    parse_t(d, path)
@@ -1,6 +1,6 @@
 import unittest
 
-from pyinfrabox.testresult import validate_result
+from pyinfrabox.testresult import validate_result, validate_header, validate_test
 from pyinfrabox import ValidationError
 
 class TestDockerCompose(unittest.TestCase):
@@ -21,3 +21,19 @@ class TestDockerCompose(unittest.TestCase):
         self.raises_expect({'version': 1}, "#: property 'tests' is required")
         self.raises_expect({'version': 1, 'tests': 'asd'}, "#tests: must be an array")
         self.raises_expect({'version': 1, 'tests': []}, "#tests: must not be empty")
+
+    def test_ndjson(self):
+        validate_header({'version': 1})
+        validate_test({'suite': 's', 'name': 'n', 'status': 'ok', 'duration': 1}, "#tests[0]")
+
+        try:
+            validate_header({'version': 1, 'tests': []})
+            assert False
+        except ValidationError as e:
+            self.assertEqual(e.message, "#: invalid property 'tests'")
+
+        try:
+            validate_test({'suite': 's', 'name': 'n', 'status': 'ok'}, "#tests[3]")
+            assert False
+        except ValidationError as e:
+            self.assertEqual(e.message, "#tests[3]: property 'duration' is required")
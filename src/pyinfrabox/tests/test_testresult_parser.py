@@ -0,0 +1,111 @@
+import json
+import unittest
+from io import BytesIO
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from pyinfraboxutils.testresult import Parser
+
+def parse(xml):
+    return Parser(BytesIO(xml)).parse(None)
+
+class TestTestresultParser(unittest.TestCase):
+    def test_testsuite(self):
+        r = parse(b'''
+            <testsuite name="s">
+                <testcase name="a" time="0.5"/>
+                <testcase name="b"><skipped/></testcase>
+            </testsuite>
+        ''')
+
+        self.assertEqual(r, {
+            'version': 1,
+            'tests': [{
+                'measurements': [],
+                'name': 'a',
+                'status': 'ok',
+                'suite': 's',
+                'duration': 500
+            }, {
+                'measurements': [],
+                'name': 'b',
+                'status': 'skipped',
+                'suite': 's',
+                'duration': 0
+            }]
+        })
+
+    def test_testsuites(self):
+        r = parse(b'''
+            <testsuites>
+                <testsuite name="s1">
+                    <testcase name="a"/>
+                </testsuite>
+                <testsuite name="s2">
+                    <testcase name="b"><failure>f</failure></testcase>
+                </testsuite>
+            </testsuites>
+        ''')
+
+        self.assertEqual(r['tests'], [{
+            'measurements': [],
+            'name': 'a',
+            'status': 'ok',
+            'suite': 's1',
+            'duration': 0
+        }, {
+            'measurements': [],
+            'name': 'b',
+            'status': 'fail',
+            'suite': 's2',
+            'duration': 0,
+            'stack': '\nf'
+        }])
+
+    def test_suite_error_after_testcases(self):
+        r = parse(b'''
+            <testsuites>
+                <testsuite name="s1">
+                    <testcase name="a"><error>e</error></testcase>
+                    <error>setup failed</error>
+                </testsuite>
+                <testsuite name="s2">
+                    <testcase name="b"><error>e</error></testcase>
+                </testsuite>
+            </testsuites>
+        ''')
+
+        self.assertEqual(r['tests'][0]['status'], 'error')
+        self.assertEqual(r['tests'][0]['stack'], 'setup failed\ne')
+
+        # The error only belongs to the testcases of its own suite
+        self.assertEqual(r['tests'][1]['status'], 'error')
+        self.assertEqual(r['tests'][1]['stack'], '\ne')
+
+    def test_empty_suite_name(self):
+        r = parse(b'''
+            <testsuites>
+                <testsuite name=""><testcase name="a"/></testsuite>
+                <testsuite><testcase name="b"/></testsuite>
+            </testsuites>
+        ''')
+
+        self.assertEqual([t['suite'] for t in r['tests']], ['None', 'None'])
+
+    def test_write_ndjson(self):
+        xml = b'''
+            <testsuite name="s">
+                <testcase name="a" time="1"/>
+                <testcase name="b"><failure message="m">f</failure></testcase>
+            </testsuite>
+        '''
+
+        output = StringIO()
+        Parser(BytesIO(xml)).write_ndjson(output)
+
+        lines = [json.loads(l) for l in output.getvalue().splitlines()]
+        self.assertEqual(lines[0], {'version': 1})
+        self.assertEqual(lines[1:], parse(xml)['tests'])
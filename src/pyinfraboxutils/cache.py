@@ -0,0 +1,53 @@
+import time
+import threading
+from collections import OrderedDict
+
+class TTLCache(object):
+    # Bounded cache, the least recently used entries are removed first
+    # and all entries expire ttl seconds after they have been set
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+
+            if entry is None:
+                return default
+
+            if entry[0] < time.time():
+                return default
+
+            self.entries[key] = entry
+            return entry[1]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, value)
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def get_or_load(self, key, load):
+        # Values which are None are not cached
+        value = self.get(key)
+
+        if value is None:
+            value = load()
+
+            if value is not None:
+                self.set(key, value)
+
+        return value
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
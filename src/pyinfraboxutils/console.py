@@ -0,0 +1,177 @@
+import zlib
+
+# Size of the chunks in which the console of finished jobs is stored.
+# Chunks only contain complete lines, so a chunk may be smaller or, for
+# a single very long line, larger.
+CHUNK_SIZE = 64 * 1024
+
+def to_bytes(output):
+    if isinstance(output, bytes):
+        return output
+
+    return output.encode('utf-8')
+
+def count_lines(data):
+    if not data:
+        return 0
+
+    lines = data.count(b'\n')
+
+    if not data.endswith(b'\n'):
+        lines += 1
+
+    return lines
+
+def split_lines(data):
+    # Only \n ends a line, \r is used by progress bars
+    lines = [l + b'\n' for l in data.split(b'\n')]
+    lines[-1] = lines[-1][:-1]
+
+    if not lines[-1]:
+        lines.pop()
+
+    return lines
+
+def create_chunks(output):
+    # Returns the compressed chunks with the byte offset and
+    # the number of the first line of every chunk
+    data = to_bytes(output)
+    chunks = []
+    offset = 0
+    first_line = 0
+
+    while offset < len(data):
+        end = len(data)
+
+        if offset + CHUNK_SIZE < len(data):
+            nl = data.rfind(b'\n', offset, offset + CHUNK_SIZE)
+
+            if nl == -1:
+                nl = data.find(b'\n', offset + CHUNK_SIZE)
+
+            if nl != -1:
+                end = nl + 1
+
+        chunk = data[offset:end]
+        lines = count_lines(chunk)
+
+        chunks.append({
+            'chunk': len(chunks),
+            'byte_offset': offset,
+            'first_line': first_line,
+            'lines': lines,
+            'size': len(chunk),
+            'data': zlib.compress(chunk)
+        })
+
+        offset = end
+        first_line += lines
+
+    return chunks
+
+class ConsoleRange(object):
+    # Part of a console, either a byte range (offset, length),
+    # a line range (line, lines) or the last lines (tail)
+    def __init__(self, offset=None, length=None, line=None, lines=None, tail=None):
+        self.offset = offset
+        self.length = length
+        self.line = line
+        self.lines = lines
+        self.tail = tail
+
+    def resolve(self, total_lines):
+        # Tail is a line range once the number of lines is known
+        if self.tail is not None:
+            return ConsoleRange(line=max(total_lines - self.tail, 0), lines=self.tail)
+
+        return self
+
+    def is_bytes(self):
+        return self.offset is not None or self.length is not None
+
+    def is_lines(self):
+        return self.line is not None or self.lines is not None
+
+    def get_bytes(self, total_size):
+        start = self.offset or 0
+
+        if self.length is None:
+            return start, total_size
+
+        return start, start + self.length
+
+    def get_lines(self, total_lines):
+        start = self.line or 0
+
+        if self.lines is None:
+            return start, total_lines
+
+        return start, start + self.lines
+
+    def apply(self, data, offset, first_line):
+        # Returns the part of data, which starts at the given
+        # byte offset and line number of the whole console
+        if self.is_bytes():
+            start, end = self.get_bytes(offset + len(data))
+            return data[max(start - offset, 0):max(end - offset, 0)]
+
+        if self.is_lines():
+            lines = split_lines(data)
+            start, end = self.get_lines(first_line + len(lines))
+            return b''.join(lines[max(start - first_line, 0):max(end - first_line, 0)])
+
+        return data
+
+def get_range(output, console_range):
+    # Returns the range of a console which is completely in memory
+    data = to_bytes(output)
+    console_range = console_range.resolve(count_lines(data))
+    return console_range.apply(data, 0, 0), len(data), count_lines(data)
+
+def read_range(db, job_id, console_range):
+    # Returns the range of a console, stored as chunks, with
+    # its total size and number of lines. Only the chunks
+    # which contain the range are read.
+    r = db.execute_one('''
+        SELECT coalesce(sum(size), 0), coalesce(sum(lines), 0)
+        FROM console_chunk
+        WHERE job_id = %s
+    ''', [job_id])
+
+    total_size = int(r[0])
+    total_lines = int(r[1])
+    console_range = console_range.resolve(total_lines)
+
+    if console_range.is_bytes():
+        start, end = console_range.get_bytes(total_size)
+        chunks = db.execute_many('''
+            SELECT data, byte_offset, first_line
+            FROM console_chunk
+            WHERE job_id = %s
+            AND byte_offset < %s
+            AND byte_offset + size > %s
+            ORDER BY chunk
+        ''', [job_id, end, start])
+    elif console_range.is_lines():
+        start, end = console_range.get_lines(total_lines)
+        chunks = db.execute_many('''
+            SELECT data, byte_offset, first_line
+            FROM console_chunk
+            WHERE job_id = %s
+            AND first_line < %s
+            AND first_line + lines > %s
+            ORDER BY chunk
+        ''', [job_id, end, start])
+    else:
+        chunks = db.execute_many('''
+            SELECT data, byte_offset, first_line
+            FROM console_chunk
+            WHERE job_id = %s
+            ORDER BY chunk
+        ''', [job_id])
+
+    if not chunks:
+        return b'', total_size, total_lines
+
+    data = b''.join(zlib.decompress(bytes(c[0])) for c in chunks)
+    return console_range.apply(data, chunks[0][1], chunks[0][2]), total_size, total_lines
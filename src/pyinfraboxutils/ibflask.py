@@ -12,12 +12,21 @@ from pyinfraboxutils import get_logger, get_env, dbpool
 from pyinfraboxutils.db import DB, connect_db
 from pyinfraboxutils.token import decode
 from pyinfraboxutils.ibopa import opa_do_auth
+from pyinfraboxutils.cache import TTLCache
 
 app = Flask(__name__)
 app.url_map.strict_slashes = False
 
 logger = get_logger('ibflask')
 
+# Validated user and project tokens and the state, project and name of
+# jobs, so not every request with a token needs a database query
+token_validations = TTLCache(max_size=10000, ttl=5)
+
+def invalidate_job_token(job_id):
+    # Has to be called when the state of a job changes
+    token_validations.delete(('job', str(job_id)))
+
 @app.before_request
 def before_request():
     def release_db():
@@ -203,10 +212,10 @@ def enrich_job_token(token):
 
     job_id = token["job"]["id"]
 
-    r = g.db.execute_one('''
+    r = token_validations.get_or_load(('job', job_id), lambda: g.db.execute_one('''
         SELECT state, project_id, name
         FROM job
-        WHERE id = %s''', [job_id])
+        WHERE id = %s''', [job_id]))
 
     if not r:
         raise LookupError('job not found')
@@ -222,9 +231,9 @@ def validate_user_token(token):
     if not ("user" in token and "id" in token["user"] and validate_uuid(token['user']['id'])):
         return False
 
-    u = g.db.execute_one('''
+    u = token_validations.get_or_load(('user', token['user']['id']), lambda: g.db.execute_one('''
         SELECT id FROM "user" WHERE id = %s
-    ''', [token['user']['id']])
+    ''', [token['user']['id']]))
     if not u:
         logger.warn('user not found')
         return False
@@ -235,10 +244,10 @@ def validate_project_token(token):
             and "id" in token and validate_uuid(token['id'])):
         return False
 
-    r = g.db.execute_one('''
+    r = token_validations.get_or_load(('project', token['id'], token['project']['id']), lambda: g.db.execute_one('''
         SELECT id FROM auth_token
         WHERE id = %s AND project_id = %s
-    ''', (token['id'], token['project']['id'],))
+    ''', (token['id'], token['project']['id'],)))
     if not r:
         logger.warn('project token not valid')
         return False
@@ -1,55 +1,172 @@
+import os
 import json
+import select
 import requests
 
 import threading
 import time
 
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
 from pyinfraboxutils import get_logger, get_env
 from pyinfraboxutils import dbpool
+from pyinfraboxutils.db import connect_db
+from pyinfraboxutils.cache import TTLCache
 
 logger = get_logger('OPA')
 
 OPA_AUTH_URL = "http://%s:%s/v1/data/infrabox/allow" % (get_env('INFRABOX_OPA_HOST'), get_env('INFRABOX_OPA_PORT'))
 COLLABORATOR_DATA_DEST_URL = "http://%s:%s/v1/data/infrabox/collaborators" % (get_env('INFRABOX_OPA_HOST'), get_env('INFRABOX_OPA_PORT'))
 PROJECT_DATA_DEST_URL = "http://%s:%s/v1/data/infrabox/projects" % (get_env('INFRABOX_OPA_HOST'), get_env('INFRABOX_OPA_PORT'))
+SYNC_DATA_DEST_URL = "http://%s:%s/v1/data/infrabox/sync" % (get_env('INFRABOX_OPA_HOST'), get_env('INFRABOX_OPA_PORT'))
 
 exit_flag = 0
 
+# Persistent connections to Open Policy Agent
+session = requests.Session()
+session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=50))
+
+# Decisions by their input, the input contains the token, the method and
+# the path. Cleared whenever new data is pushed to Open Policy Agent.
+decisions = TTLCache(max_size=10000, ttl=float(os.environ.get('INFRABOX_OPA_CACHE_TTL', 10)))
+
 def opa_do_auth(input_dict):
     # Send request to Open Policy Agent and evaluate response
-    payload = json.dumps(input_dict)
+    payload = json.dumps(input_dict, sort_keys=True)
+
+    is_authorized = decisions.get(payload)
+
+    if is_authorized is not None:
+        return is_authorized
+
     logger.debug("Sending OPA Request: %s", payload)
-    rsp = requests.post(OPA_AUTH_URL, data=json.dumps(input_dict))
+    rsp = session.post(OPA_AUTH_URL, data=payload)
     rsp_dict = rsp.json()
     logger.debug("OPA Response: %s", rsp.content)
 
-    return "result" in rsp_dict and rsp_dict["result"] is True
+    is_authorized = "result" in rsp_dict and rsp_dict["result"] is True
+
+    if rsp:
+        decisions.set(payload, is_authorized)
+
+    return is_authorized
 
 def opa_push_data(destination_url, json_payload):
     try:
-        rsp = requests.put(destination_url, data=json_payload, headers={"Content-Type" : "application/json"})
+        rsp = session.put(destination_url, data=json_payload, headers={"Content-Type" : "application/json"})
         if rsp:
+            decisions.clear()
             logger.debug("Pushed data to %s (Status %s):%s", destination_url, str(rsp.status_code), json_payload)
+            return True
         else:
             logger.error("Failed pushing data to %s (Status %s): Req.: %s; Resp.: %s",
                          destination_url, str(rsp.status_code), json_payload, rsp.content)
     except requests.exceptions.RequestException as e:
         logger.exception("Failed pushing data to %s: %s; Req.: %s", destination_url, e, json_payload)
 
+    return False
+
+def opa_patch_data(destination_url, patch):
+    # Applies a JSON patch to the data in Open Policy Agent
+    json_payload = json.dumps(patch)
+
+    try:
+        rsp = session.patch(destination_url, data=json_payload, headers={"Content-Type" : "application/json-patch+json"})
+        if rsp:
+            decisions.clear()
+            logger.debug("Patched data of %s (Status %s):%s", destination_url, str(rsp.status_code), json_payload)
+            return True
+        else:
+            logger.warning("Failed patching data of %s (Status %s): Req.: %s; Resp.: %s",
+                           destination_url, str(rsp.status_code), json_payload, rsp.content)
+    except requests.exceptions.RequestException as e:
+        logger.exception("Failed patching data of %s: %s; Req.: %s", destination_url, e, json_payload)
+
+    return False
+
+def opa_get_data(destination_url):
+    try:
+        rsp = session.get(destination_url)
+        if rsp:
+            return rsp.json().get('result', None)
+    except requests.exceptions.RequestException as e:
+        logger.exception("Failed getting data of %s: %s", destination_url, e)
+
+    return None
+
+class OPAData(object):
+    # A table which is pushed to Open Policy Agent. The rows are pushed as object
+    # by their key, so single rows can be changed with a JSON patch. The hash
+    # of the table is pushed with it, so the data is only pushed again if the
+    # hash of the table in the database is different.
+    def __init__(self, table, document, destination_url, rows_query, hash_query, key_columns):
+        self.table = table
+        self.document = document
+        self.destination_url = destination_url
+        self.rows_query = rows_query
+        self.hash_query = hash_query
+        self.key_columns = key_columns
+
+    def get_key(self, row):
+        return ':'.join(str(row[c]) for c in self.key_columns)
+
+    def get_hash(self, db):
+        return db.execute_one(self.hash_query)[0]
+
+    def push(self, db):
+        data_hash = self.get_hash(db)
+        rows = db.execute_many_dict(self.rows_query)
+        payload = json.dumps({self.document: dict((self.get_key(r), r) for r in rows)})
+
+        if opa_push_data(self.destination_url, payload):
+            opa_push_data(SYNC_DATA_DEST_URL + '/' + self.document, json.dumps(data_hash))
+
+    def sync(self, db):
+        # Pushes the data, if Open Policy Agent has a different version
+        if opa_get_data(SYNC_DATA_DEST_URL + '/' + self.document) != self.get_hash(db):
+            logger.info("Pushing all %s to Open Policy Agent", self.document)
+            self.push(db)
+
+    def patch(self, db, changes):
+        # Applies the changes of the rows, only if it fails all data is pushed
+        patch = []
+        for c in changes:
+            old = c['old']
+            new = c['new']
+
+            if old and (not new or self.get_key(old) != self.get_key(new)):
+                patch.append({'op': 'remove', 'path': '/' + self.get_key(old)})
+
+            if new:
+                patch.append({'op': 'add', 'path': '/' + self.get_key(new), 'value': new})
+
+        if not opa_patch_data(self.destination_url + '/' + self.document, patch):
+            self.push(db)
+            return
+
+        opa_push_data(SYNC_DATA_DEST_URL + '/' + self.document, json.dumps(self.get_hash(db)))
+
+collaborator_data = OPAData('collaborator', 'collaborators', COLLABORATOR_DATA_DEST_URL, """
+    SELECT user_id, project_id, role FROM collaborator
+""", """
+    SELECT md5(coalesce(string_agg(project_id::text || ':' || user_id::text || ':' || role::text, ',' ORDER BY project_id, user_id), ''))
+    FROM collaborator
+""", ['project_id', 'user_id'])
+
+project_data = OPAData('project', 'projects', PROJECT_DATA_DEST_URL, """
+    SELECT id, public, name FROM project
+""", """
+    SELECT md5(coalesce(string_agg(id::text || ':' || public::text || ':' || name, ',' ORDER BY id), ''))
+    FROM project
+""", ['id'])
+
+OPA_DATA = [collaborator_data, project_data]
+
 def opa_push_collaborator_data(db):
-    collaborators = db.execute_many_dict("""
-        SELECT user_id, project_id, role FROM collaborator
-    """)
-    payload = json.dumps({'collaborators': collaborators})
-    opa_push_data(COLLABORATOR_DATA_DEST_URL, payload)
+    collaborator_data.push(db)
 
 def opa_push_project_data(db):
-    projects = db.execute_many_dict("""
-        SELECT id, public, name FROM project
-    """
-    )
-    payload = json.dumps({"projects": projects})
-    opa_push_data(PROJECT_DATA_DEST_URL, payload)
+    project_data.push(db)
 
 def opa_push_all():
     db = dbpool.get()
@@ -60,19 +177,72 @@ def opa_push_all():
     finally:
         dbpool.put(db)
 
+def opa_sync_all():
+    db = dbpool.get()
+
+    try:
+        for data in OPA_DATA:
+            data.sync(db)
+    finally:
+        dbpool.put(db)
+
+def opa_apply_changes(changes):
+    db = dbpool.get()
+
+    try:
+        for data in OPA_DATA:
+            table_changes = [c for c in changes if c['table'] == data.table]
+
+            if table_changes:
+                data.patch(db, table_changes)
+    finally:
+        dbpool.put(db)
+
 def opa_start_push_loop():
+    # Changes of collaborators and projects are pushed as patches when they are
+    # notified. Every push interval the data is pushed completely, but only if
+    # its hash in Open Policy Agent differs from the one in the database.
     class OPA_Push_Thread(threading.Thread):
         stopped = False
         push_interval = float(get_env('INFRABOX_OPA_PUSH_INTERVAL'))
         def run(self):
             while not self.stopped:
                 try:
-                    opa_push_all()
+                    self.listen()
                 except Exception as e:
                     logger.exception(e)
-                finally:
                     time.sleep(self.push_interval)
 
+        def listen(self):
+            conn = connect_db()
+
+            try:
+                conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+                cur = conn.cursor()
+                cur.execute("LISTEN opa_update")
+
+                # Changes before listening are only found by the sync
+                opa_sync_all()
+                next_sync = time.time() + self.push_interval
+
+                while not self.stopped:
+                    timeout = max(next_sync - time.time(), 0)
+
+                    if select.select([conn], [], [], timeout) != ([], [], []):
+                        conn.poll()
+
+                        notifies = conn.notifies[:]
+                        del conn.notifies[:]
+
+                        if notifies:
+                            opa_apply_changes([json.loads(n.payload) for n in notifies])
+
+                    if time.time() >= next_sync:
+                        opa_sync_all()
+                        next_sync = time.time() + self.push_interval
+            finally:
+                conn.close()
+
         def join(self, timeout=None):
             self.stopped = True
             threading.Thread.join(self, timeout)
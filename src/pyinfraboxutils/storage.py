@@ -1,11 +1,17 @@
 #pylint: disable=too-few-public-methods
 import os
+import re
 import uuid
+import json
+import mimetypes
+import threading
+from contextlib import contextmanager
 
 import boto3
 from google.cloud import storage as gcs
-from flask import after_this_request
+from flask import after_this_request, request, Response, abort
 from azure.storage.blob import BlockBlobService
+from azure.storage.blob.models import BlobBlock
 from keystoneauth1 import session
 from keystoneauth1.identity import v3
 from swiftclient.client import Connection, ClientException
@@ -18,6 +24,110 @@ USE_AZURE = get_env('INFRABOX_STORAGE_AZURE_ENABLED') == 'true'
 USE_SWIFT = get_env('INFRABOX_STORAGE_SWIFT_ENABLED') == 'true'
 storage = None
 
+# Size of the chunks read from a streaming body
+CHUNK_SIZE = 1024 * 1024
+
+# Size of the ranged requests for backends without a streaming body
+RANGE_SIZE = 8 * 1024 * 1024
+
+class StorageObject(object):
+    # An object in the storage which can be read in chunks without
+    # loading it into memory or writing it to disk first
+    def __init__(self, size, read_range):
+        self.size = size
+        self._read_range = read_range
+
+    def iter_range(self, start=0, end=None):
+        ''' Yields the content from start to end (inclusive) in chunks '''
+        if end is None:
+            end = self.size - 1
+
+        if end < start:
+            return iter([])
+
+        return self._read_range(start, end)
+
+class ClientPool(object):
+    # Long-lived clients which must not be used by two threads at the same time
+    def __init__(self, create):
+        self._create = create
+        self._clients = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def client(self):
+        client = None
+        with self._lock:
+            if self._clients:
+                client = self._clients.pop()
+
+        if not client:
+            client = self._create()
+
+        try:
+            yield client
+        finally:
+            with self._lock:
+                self._clients.append(client)
+
+def validate_generated_upload_id(upload_id):
+    # Upload ids generated for backends without native multipart
+    # uploads, they become part of the object keys
+    return re.match(r'^[0-9a-f]{32}$', upload_id) is not None
+
+def get_part_key(key, upload_id, part):
+    # Key of a part of a multipart upload for backends which
+    # store the parts as separate objects
+    if not validate_generated_upload_id(upload_id):
+        raise ValueError('Invalid upload_id')
+
+    return '%s.%s.part-%05d' % (key, upload_id, part)
+
+def sort_parts(parts):
+    return sorted(parts, key=lambda p: p['part'])
+
+def iter_ranges(start, end, read):
+    # Splits the range into RANGE_SIZE requests
+    while start <= end:
+        chunk_end = min(start + RANGE_SIZE - 1, end)
+        yield read(start, chunk_end)
+        start = chunk_end + 1
+
+def send_object(obj, attachment_filename=None, as_attachment=False):
+    ''' Streams the object to the client, supports single byte range requests '''
+    start = 0
+    end = obj.size - 1
+    status = 200
+
+    headers = {
+        'Accept-Ranges': 'bytes'
+    }
+
+    if request.range:
+        r = request.range.range_for_length(obj.size)
+
+        if not r:
+            abort(416)
+
+        start, end = r[0], r[1] - 1
+        status = 206
+        headers['Content-Range'] = 'bytes %s-%s/%s' % (start, end, obj.size)
+
+    headers['Content-Length'] = str(end - start + 1)
+
+    mimetype = 'application/octet-stream'
+    if attachment_filename:
+        mimetype = mimetypes.guess_type(attachment_filename)[0] or mimetype
+
+        if as_attachment:
+            headers['Content-Disposition'] = 'attachment; filename=%s' % attachment_filename
+
+    return Response(obj.iter_range(start, end),
+                    status=status,
+                    headers=headers,
+                    mimetype=mimetype,
+                    direct_passthrough=True)
+
 class S3(object):
     def __init__(self):
         url = ''
@@ -32,6 +142,9 @@ class S3(object):
         self.url = url
 
         self.bucket = get_env('INFRABOX_STORAGE_S3_BUCKET')
+
+        # boto3 clients are thread safe, so all requests share one
+        self.client = self._create_client()
         self.create_buckets()
 
     def _upload(self, stream, key):
@@ -64,9 +177,37 @@ class S3(object):
     def download_cache(self, key):
         return self._download('cache/%s' % key)
 
+    def open_source(self, key):
+        return self._open('upload/%s' % key)
+
+    def open_output(self, key):
+        return self._open('output/%s' % key)
+
+    def open_archive(self, key):
+        return self._open('archive/%s' % key)
+
+    def open_cache(self, key):
+        return self._open('cache/%s' % key)
+
     def delete_cache(self, key):
         return self._delete('cache/%s' % key)
 
+    def start_multipart_upload(self, kind, key):
+        return self._start_multipart_upload('%s/%s' % (kind, key))
+
+    def upload_part(self, kind, key, upload_id, part, stream):
+        return self._upload_part('%s/%s' % (kind, key), upload_id, part, stream)
+
+    def complete_multipart_upload(self, kind, key, upload_id, parts):
+        return self._complete_multipart_upload('%s/%s' % (kind, key), upload_id, parts)
+
+    def abort_multipart_upload(self, kind, key, upload_id):
+        return self._abort_multipart_upload('%s/%s' % (kind, key), upload_id)
+
+    def validate_upload_id(self, upload_id):
+        # Upload ids are generated by S3 and only passed as parameter
+        return re.match(r'^[A-Za-z0-9._-]+$', upload_id) is not None
+
     def create_buckets(self):
         client = self._get_client()
         try:
@@ -104,7 +245,63 @@ class S3(object):
 
         return path
 
+    def _start_multipart_upload(self, key):
+        client = self._get_client()
+        result = client.create_multipart_upload(Bucket=self.bucket,
+                                                Key=key)
+        return result['UploadId']
+
+    def _upload_part(self, key, upload_id, part, stream):
+        client = self._get_client()
+        result = client.upload_part(Body=stream,
+                                    Bucket=self.bucket,
+                                    Key=key,
+                                    UploadId=upload_id,
+                                    PartNumber=part)
+        return {'part': part, 'etag': result['ETag']}
+
+    def _complete_multipart_upload(self, key, upload_id, parts):
+        client = self._get_client()
+        parts = [{'PartNumber': p['part'], 'ETag': p['etag']} for p in sort_parts(parts)]
+        client.complete_multipart_upload(Bucket=self.bucket,
+                                         Key=key,
+                                         UploadId=upload_id,
+                                         MultipartUpload={'Parts': parts})
+
+    def _abort_multipart_upload(self, key, upload_id):
+        client = self._get_client()
+        try:
+            client.abort_multipart_upload(Bucket=self.bucket,
+                                          Key=key,
+                                          UploadId=upload_id)
+        except:
+            pass
+
+    def _open(self, key):
+        client = self._get_client()
+        try:
+            head = client.head_object(Bucket=self.bucket,
+                                      Key=key)
+        except:
+            return None
+
+        def read_range(start, end):
+            result = client.get_object(Bucket=self.bucket,
+                                       Key=key,
+                                       Range='bytes=%s-%s' % (start, end))
+            body = result['Body']
+            try:
+                for chunk in iter(lambda: body.read(CHUNK_SIZE), b''):
+                    yield chunk
+            finally:
+                body.close()
+
+        return StorageObject(head['ContentLength'], read_range)
+
     def _get_client(self):
+        return self.client
+
+    def _create_client(self):
         client = boto3.client('s3',
                               endpoint_url=self.url,
                               config=boto3.session.Config(signature_version='s3v4'),
@@ -116,6 +313,15 @@ class S3(object):
 class GCS(object):
     def __init__(self):
         self.bucket = get_env('INFRABOX_STORAGE_GCS_BUCKET')
+        self.client = gcs.Client()
+        self._bucket = None
+
+    def _get_bucket(self):
+        # Only check once if the bucket exists
+        if not self._bucket:
+            self._bucket = self.client.get_bucket(self.bucket)
+
+        return self._bucket
 
 
     def upload_project(self, stream, key):
@@ -142,27 +348,51 @@ class GCS(object):
     def download_cache(self, key):
         return self._download('cache/%s' % key)
 
+    def open_source(self, key):
+        return self._open('upload/%s' % key)
+
+    def open_output(self, key):
+        return self._open('output/%s' % key)
+
+    def open_archive(self, key):
+        return self._open('archive/%s' % key)
+
+    def open_cache(self, key):
+        return self._open('cache/%s' % key)
+
     def delete_cache(self, key):
         return self._delete('cache/%s' % key)
 
+    def start_multipart_upload(self, kind, key):
+        return self._start_multipart_upload('%s/%s' % (kind, key))
+
+    def upload_part(self, kind, key, upload_id, part, stream):
+        return self._upload_part('%s/%s' % (kind, key), upload_id, part, stream)
+
+    def complete_multipart_upload(self, kind, key, upload_id, parts):
+        return self._complete_multipart_upload('%s/%s' % (kind, key), upload_id, parts)
+
+    def abort_multipart_upload(self, kind, key, upload_id):
+        return self._abort_multipart_upload('%s/%s' % (kind, key), upload_id)
+
+    def validate_upload_id(self, upload_id):
+        return validate_generated_upload_id(upload_id)
+
     def _delete(self, key):
         try:
-            client = gcs.Client()
-            bucket = client.get_bucket(self.bucket)
+            bucket = self._get_bucket()
             blob = bucket.blob(key)
             blob.delete()
         except:
             pass
 
     def _upload(self, stream, key):
-        client = gcs.Client()
-        bucket = client.get_bucket(self.bucket)
+        bucket = self._get_bucket()
         blob = bucket.blob(key)
         blob.upload_from_file(stream)
 
     def _download(self, key):
-        client = gcs.Client()
-        bucket = client.get_bucket(self.bucket)
+        bucket = self._get_bucket()
         blob = bucket.get_blob(key)
 
         if not blob:
@@ -181,9 +411,64 @@ class GCS(object):
 
         return path
 
+    def _start_multipart_upload(self, _):
+        return uuid.uuid4().hex
+
+    def _upload_part(self, key, upload_id, part, stream):
+        self._upload(stream, get_part_key(key, upload_id, part))
+        return {'part': part}
+
+    def _complete_multipart_upload(self, key, upload_id, parts):
+        bucket = self._get_bucket()
+        sources = [bucket.blob(get_part_key(key, upload_id, p['part'])) for p in sort_parts(parts)]
+
+        # compose accepts at most 32 sources, so the parts are first combined
+        # into a temporary object which is then copied to the key at once
+        tmp = bucket.blob('%s.%s.compose' % (key, upload_id))
+        tmp.compose(sources[:32])
+        for i in range(32, len(sources), 31):
+            tmp.compose([tmp] + sources[i:i + 31])
+
+        bucket.blob(key).compose([tmp])
+        self._abort_multipart_upload(key, upload_id)
+
+    def _abort_multipart_upload(self, key, upload_id):
+        bucket = self._get_bucket()
+        for blob in bucket.list_blobs(prefix='%s.%s.' % (key, upload_id)):
+            try:
+                blob.delete()
+            except:
+                pass
+
+    def _open(self, key):
+        bucket = self._get_bucket()
+        blob = bucket.get_blob(key)
+
+        if not blob:
+            return None
+
+        def read_range(start, end):
+            return iter_ranges(start, end,
+                               lambda s, e: blob.download_as_string(start=s, end=e))
+
+        return StorageObject(blob.size, read_range)
+
 class AZURE(object):
     def __init__(self):
         self.container = 'infrabox'
+        self.client = BlockBlobService(account_name=get_env('INFRABOX_STORAGE_AZURE_ACCOUNT_NAME'),
+                                       account_key=get_env('INFRABOX_STORAGE_AZURE_ACCOUNT_KEY'))
+        self.container_exists = False
+
+    def _create_container(self):
+        # Only check once if the container exists
+        if self.container_exists:
+            return
+
+        if not self.client.exists(container_name=self.container):
+            self.client.create_container(container_name=self.container)
+
+        self.container_exists = True
 
     def upload_project(self, stream, key):
         return self._upload(stream, 'upload/%s' % key)
@@ -209,13 +494,39 @@ class AZURE(object):
     def download_cache(self, key):
         return self._download('cache/%s' % key)
 
+    def open_source(self, key):
+        return self._open('upload/%s' % key)
+
+    def open_output(self, key):
+        return self._open('output/%s' % key)
+
+    def open_archive(self, key):
+        return self._open('archive/%s' % key)
+
+    def open_cache(self, key):
+        return self._open('cache/%s' % key)
+
     def delete_cache(self, key):
         return self._delete('cache/%s' % key)
 
+    def start_multipart_upload(self, kind, key):
+        return self._start_multipart_upload('%s/%s' % (kind, key))
+
+    def upload_part(self, kind, key, upload_id, part, stream):
+        return self._upload_part('%s/%s' % (kind, key), upload_id, part, stream)
+
+    def complete_multipart_upload(self, kind, key, upload_id, parts):
+        return self._complete_multipart_upload('%s/%s' % (kind, key), upload_id, parts)
+
+    def abort_multipart_upload(self, kind, key, upload_id):
+        return self._abort_multipart_upload('%s/%s' % (kind, key), upload_id)
+
+    def validate_upload_id(self, upload_id):
+        return validate_generated_upload_id(upload_id)
+
     def _upload(self, stream, key):
         client = self._get_client()
-        if not client.exists(container_name=self.container):
-            client.create_container(container_name=self.container)
+        self._create_container()
         client.create_blob_from_stream(container_name=self.container,
                                        blob_name=key,
                                        stream=stream)
@@ -247,10 +558,50 @@ class AZURE(object):
 
         return path
 
+    def _start_multipart_upload(self, _):
+        self._create_container()
+        return uuid.uuid4().hex
+
+    def _upload_part(self, key, upload_id, part, stream):
+        client = self._get_client()
+        client.put_block(container_name=self.container,
+                         blob_name=key,
+                         block=stream.read(),
+                         block_id='%s%05d' % (upload_id, part))
+        return {'part': part}
+
+    def _complete_multipart_upload(self, key, upload_id, parts):
+        client = self._get_client()
+        blocks = [BlobBlock(id='%s%05d' % (upload_id, p['part'])) for p in sort_parts(parts)]
+        client.put_block_list(container_name=self.container,
+                              blob_name=key,
+                              block_list=blocks)
+
+    def _abort_multipart_upload(self, key, upload_id):
+        # Uncommitted blocks are garbage collected by azure
+        pass
+
+    def _open(self, key):
+        client = self._get_client()
+        try:
+            blob = client.get_blob_properties(container_name=self.container,
+                                              blob_name=key)
+        except:
+            return None
+
+        def read(start, end):
+            return client.get_blob_to_bytes(container_name=self.container,
+                                            blob_name=key,
+                                            start_range=start,
+                                            end_range=end).content
+
+        def read_range(start, end):
+            return iter_ranges(start, end, read)
+
+        return StorageObject(blob.properties.content_length, read_range)
+
     def _get_client(self):
-        client = BlockBlobService(account_name=get_env('INFRABOX_STORAGE_AZURE_ACCOUNT_NAME'),
-                                  account_key=get_env('INFRABOX_STORAGE_AZURE_ACCOUNT_KEY'))
-        return client
+        return self.client
 
 class SWIFT(object):
     def __init__(self):
@@ -260,6 +611,16 @@ class SWIFT(object):
         self.project_name = get_env('INFRABOX_STORAGE_SWIFT_PROJECT_NAME')
         self.project_domain_name = get_env('INFRABOX_STORAGE_SWIFT_PROJECT_DOMAIN_NAME')
 
+        auth = v3.Password(auth_url=self.auth_url,
+                           username=os.getenv('INFRABOX_STORAGE_SWIFT_USERNAME'),
+                           password=os.getenv('INFRABOX_STORAGE_SWIFT_PASSWORD'),
+                           user_domain_name=self.user_domain_name,
+                           project_name=self.project_name,
+                           project_domain_name=self.project_domain_name)
+        self.keystone_session = session.Session(auth=auth)
+        self.pool = ClientPool(self._create_client)
+        self.container_exists = False
+
     def upload_project(self, stream, key):
         return self._upload(stream, 'upload/%s' % key)
 
@@ -284,36 +645,129 @@ class SWIFT(object):
     def download_cache(self, key):
         return self._download('cache/%s' % key)
 
+    def open_source(self, key):
+        return self._open('upload/%s' % key)
+
+    def open_output(self, key):
+        return self._open('output/%s' % key)
+
+    def open_archive(self, key):
+        return self._open('archive/%s' % key)
+
+    def open_cache(self, key):
+        return self._open('cache/%s' % key)
+
     def delete_cache(self, key):
         return self._delete('cache/%s' % key)
 
-    def _upload(self, stream, key):
-        client = self._get_client()
+    def start_multipart_upload(self, kind, key):
+        return self._start_multipart_upload('%s/%s' % (kind, key))
+
+    def upload_part(self, kind, key, upload_id, part, stream):
+        return self._upload_part('%s/%s' % (kind, key), upload_id, part, stream)
+
+    def complete_multipart_upload(self, kind, key, upload_id, parts):
+        return self._complete_multipart_upload('%s/%s' % (kind, key), upload_id, parts)
+
+    def abort_multipart_upload(self, kind, key, upload_id):
+        return self._abort_multipart_upload('%s/%s' % (kind, key), upload_id)
+
+    def validate_upload_id(self, upload_id):
+        return validate_generated_upload_id(upload_id)
+
+    def _create_container(self, client):
+        # Only check once if the container exists
+        if self.container_exists:
+            return
+
         try:
             client.head_container(self.container)
         except ClientException:
             client.put_container(self.container)
-        client.put_object(container=self.container,
-                          obj=key,
-                          contents=stream)
+
+        self.container_exists = True
+
+    def _upload(self, stream, key):
+        with self.pool.client() as client:
+            self._create_container(client)
+            client.put_object(container=self.container,
+                              obj=key,
+                              contents=stream)
 
     def _delete(self, key):
-        client = self._get_client()
-        try:
-            client.delete_object(container=self.container,
-                                 obj=key)
-        except:
-            pass
+        with self.pool.client() as client:
+            try:
+                # Also deletes the segments of multipart uploads
+                client.delete_object(container=self.container,
+                                     obj=key,
+                                     query_string='multipart-manifest=delete')
+            except:
+                pass
+
+    def _start_multipart_upload(self, _):
+        with self.pool.client() as client:
+            self._create_container(client)
+
+        return uuid.uuid4().hex
+
+    def _upload_part(self, key, upload_id, part, stream):
+        with self.pool.client() as client:
+            etag = client.put_object(container=self.container,
+                                     obj=get_part_key(key, upload_id, part),
+                                     contents=stream)
+        return {'part': part, 'etag': etag, 'size': stream.tell()}
+
+    def _complete_multipart_upload(self, key, upload_id, parts):
+        with self.pool.client() as client:
+            # Segments of a previous upload to the same key
+            old_segments = []
+            try:
+                headers = client.head_object(self.container, key)
+                if headers.get('x-static-large-object', 'false').lower() == 'true':
+                    _, manifest = client.get_object(self.container, key,
+                                                    query_string='multipart-manifest=get')
+                    old_segments = [s['name'].split('/', 2)[2] for s in json.loads(manifest)]
+            except ClientException:
+                pass
+
+            # Static large object which references the parts
+            manifest = [{
+                'path': '/%s/%s' % (self.container, get_part_key(key, upload_id, p['part'])),
+                'etag': p['etag'],
+                'size_bytes': p['size']
+            } for p in sort_parts(parts)]
+
+            client.put_object(container=self.container,
+                              obj=key,
+                              contents=json.dumps(manifest),
+                              query_string='multipart-manifest=put')
+
+            for segment in old_segments:
+                try:
+                    client.delete_object(container=self.container, obj=segment)
+                except:
+                    pass
+
+    def _abort_multipart_upload(self, key, upload_id):
+        with self.pool.client() as client:
+            try:
+                _, objects = client.get_container(self.container,
+                                                  prefix='%s.%s.' % (key, upload_id),
+                                                  full_listing=True)
+                for o in objects:
+                    client.delete_object(container=self.container, obj=o['name'])
+            except:
+                pass
 
     def _download(self, key):
-        client = self._get_client()
         path = '/tmp/%s' % uuid.uuid4()
-        try:
-            _, contents = client.get_object(self.container, key)
-            with open(path, 'w') as f:
-                f.write(contents)
-        except:
-            return None
+        with self.pool.client() as client:
+            try:
+                _, contents = client.get_object(self.container, key)
+                with open(path, 'w') as f:
+                    f.write(contents)
+            except:
+                return None
 
         if 'g' in globals():
             @after_this_request
@@ -324,15 +778,33 @@ class SWIFT(object):
 
         return path
 
-    def _get_client(self):
-        auth = v3.Password(auth_url=self.auth_url,
-                           username=os.getenv('INFRABOX_STORAGE_SWIFT_USERNAME'),
-                           password=os.getenv('INFRABOX_STORAGE_SWIFT_PASSWORD'),
-                           user_domain_name=self.user_domain_name,
-                           project_name=self.project_name,
-                           project_domain_name=self.project_domain_name)
-        keystone_session = session.Session(auth=auth)
-        return Connection(session=keystone_session)
+    def _open(self, key):
+        with self.pool.client() as client:
+            try:
+                headers = client.head_object(self.container, key)
+            except:
+                return None
+
+        def read_range(start, end):
+            with self.pool.client() as client:
+                _, contents = client.get_object(self.container, key,
+                                                resp_chunk_size=CHUNK_SIZE,
+                                                headers={'Range': 'bytes=%s-%s' % (start, end)})
+
+                # The client goes back to the pool also if the reader
+                # stops early, so the rest of the response is discarded
+                try:
+                    for chunk in contents:
+                        yield chunk
+                finally:
+                    contents.close()
+
+        return StorageObject(int(headers['content-length']), read_range)
+
+    def _create_client(self):
+        # The keystone session caches the token and
+        # authenticates again once it expires
+        return Connection(session=self.keystone_session)
 
 if USE_S3:
     storage = S3()
@@ -1,4 +1,9 @@
-from xml.etree import ElementTree
+import json
+
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
 
 RESULT_MAPPING = {
     'failure': 'fail',
@@ -13,46 +18,79 @@ def get_ms(val):
         return 0
 
 class Parser(object):
+    # Reads the report incrementally, so the memory needed
+    # does not depend on the number of testcases
     def __init__(self, i):
         self.input = i
-        self.tests = []
 
     def parse(self, _badge_dir):
-        xml = ElementTree.parse(self.input)
-        root = xml.getroot()
-        return self.parse_root(root)
-
-    def parse_root(self, root):
-        if root.tag == 'testsuites':
-            for subroot in root:
-                self.parse_testsuite(subroot)
-        else:
-            self.parse_testsuite(root)
-
         res = {
             "version": 1,
-            "tests": self.tests
+            "tests": list(self.iter_tests())
         }
         return res
 
-    def parse_testsuite(self, root):
-        assert root.tag == 'testsuite'
-        ts_name = root.attrib.get('name', 'None')
+    def write_ndjson(self, output):
+        # Writes the version and then one test per line
+        output.write(json.dumps({"version": 1}) + '\n')
+
+        for tc in self.iter_tests():
+            output.write(json.dumps(tc) + '\n')
 
-        if not ts_name:
-            ts_name = 'None'
+    def iter_tests(self):
+        errors = self.get_suite_errors()
 
-        for el in root:
+        for suite, ts_name, el in self.iter_suite_children():
             if el.tag != 'testcase':
                 continue
 
-            error = root.find('error')
+            yield self.parse_testcase(el, ts_name, error=errors.get(suite, None))
+
+    def get_suite_errors(self):
+        # The error of a suite belongs to all of its testcases, but it
+        # may come after them, so the suites are read once before
+        errors = {}
+
+        for suite, _, el in self.iter_suite_children():
+            if el.tag == 'error' and suite not in errors:
+                errors[suite] = el.text
+
+        return errors
+
+    def iter_suite_children(self):
+        # Yields (suite number, suite name, element) for all children of all
+        # testsuites. They are removed from the tree once they have been handled.
+        if hasattr(self.input, 'seek'):
+            self.input.seek(0)
+
+        stack = []
+        suite = -1
+        suite_depth = 1
+        ts_name = None
+
+        for event, el in ElementTree.iterparse(self.input, events=('start', 'end')):
+            if event == 'start':
+                stack.append(el)
+
+                if len(stack) == 1 and el.tag == 'testsuites':
+                    suite_depth = 2
+                elif len(stack) == suite_depth:
+                    assert el.tag == 'testsuite'
+                    suite += 1
+                    ts_name = el.attrib.get('name', 'None')
+
+                    if not ts_name:
+                        ts_name = 'None'
+
+                continue
 
-            if error is not None:
-                error = error.text
+            stack.pop()
 
-            tc = self.parse_testcase(el, ts_name, error=error)
-            self.tests.append(tc)
+            if len(stack) == suite_depth:
+                yield suite, ts_name, el
+                stack[-1].remove(el)
+            elif len(stack) == 1 and suite_depth == 2:
+                stack[-1].remove(el)
 
     def parse_testcase(self, el, ts_name, error=None):
         time = el.attrib.get('time')
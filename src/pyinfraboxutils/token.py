@@ -1,44 +1,78 @@
 import os
+import copy
+import threading
 
 import jwt
 
+from pyinfraboxutils.cache import TTLCache
+
 private_key_path = os.environ.get('INFRABOX_RSA_PRIVATE_KEY_PATH', '/var/run/secrets/infrabox.net/rsa/id_rsa')
 public_key_path = os.environ.get('INFRABOX_RSA_PUBLIC_KEY_PATH', '/var/run/secrets/infrabox.net/rsa/id_rsa.pub')
 
+class KeyFile(object):
+    # Content of a key file, which is only read again if the file has changed
+    def __init__(self, path):
+        self.path = path
+        self.key = None
+        self.mtime = None
+        self.lock = threading.Lock()
+
+    def read(self):
+        mtime = os.stat(self.path).st_mtime
+
+        with self.lock:
+            if self.key is None or mtime != self.mtime:
+                with open(self.path) as s:
+                    self.key = s.read()
+
+                self.mtime = mtime
+
+            return self.key
+
+private_key = KeyFile(private_key_path)
+public_key = KeyFile(public_key_path)
+
+# Claims of verified tokens by the token and the key it has been verified with
+decoded_tokens = TTLCache(max_size=10000, ttl=300)
+
 def encode_user_token(user_id):
-    with open(private_key_path) as s:
-        data = {
-            'user': {
-                'id': user_id
-            },
-            'type': 'user'
-        }
+    data = {
+        'user': {
+            'id': user_id
+        },
+        'type': 'user'
+    }
 
-        return jwt.encode(data, key=s.read(), algorithm='RS256')
+    return jwt.encode(data, key=private_key.read(), algorithm='RS256')
 
 def encode_project_token(token_id, project_id):
-    with open(private_key_path) as s:
-        data = {
-            'id': token_id,
-            'project': {
-                'id': project_id
-            },
-            'type': 'project'
-        }
+    data = {
+        'id': token_id,
+        'project': {
+            'id': project_id
+        },
+        'type': 'project'
+    }
 
-        return jwt.encode(data, key=s.read(), algorithm='RS256')
+    return jwt.encode(data, key=private_key.read(), algorithm='RS256')
 
 def encode_job_token(job_id):
-    with open(private_key_path) as s:
-        data = {
-            'job': {
-                'id': job_id
-            },
-            'type': 'job'
-        }
+    data = {
+        'job': {
+            'id': job_id
+        },
+        'type': 'job'
+    }
 
-        return jwt.encode(data, key=s.read(), algorithm='RS256')
+    return jwt.encode(data, key=private_key.read(), algorithm='RS256')
 
 def decode(encoded):
-    with open(public_key_path) as s:
-        return jwt.decode(encoded, key=s.read(), algorithm='RS256')
+    key = public_key.read()
+    claims = decoded_tokens.get((encoded, key))
+
+    if claims is None:
+        claims = jwt.decode(encoded, key=key, algorithm='RS256')
+        decoded_tokens.set((encoded, key), claims)
+
+    # The claims are changed by the callers
+    return copy.deepcopy(claims)
@@ -1,13 +1,17 @@
 # pylint: disable=too-few-public-methods,line-too-long,too-many-lines,too-many-nested-blocks
 import argparse
+import select
+import threading
 import time
 import os
 import random
 import json
 import copy
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 
 import requests
+import requests.adapters
 
 import psycopg2
 import psycopg2.extensions
@@ -15,23 +19,231 @@ import psycopg2.extensions
 from pyinfraboxutils import get_logger, get_env
 from pyinfraboxutils.db import connect_db
 from pyinfraboxutils.token import encode_job_token
+from pyinfraboxutils.console import create_chunks
 
 class APIException(Exception):
     def __init__(self, result):
         super(APIException, self).__init__("API Server Error (%s)" % result.status_code)
         self.result = result
 
+class WorkQueue(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.keys = set()
+
+    def add(self, key):
+        with self.lock:
+            self.keys.add(key)
+
+    def get_all(self):
+        with self.lock:
+            keys = self.keys
+            self.keys = set()
+
+        return keys
+
+class Informer(object):
+    # Keeps a local copy of all objects of a resource in sync using the
+    # list and watch API of the kubernetes api server
+    def __init__(self, args, path, label_selector=None, resync_period=60):
+        self.args = args
+        self.path = path
+        self.label_selector = label_selector
+        self.resync_period = resync_period
+        self.logger = get_logger("informer")
+        self.lock = threading.Lock()
+        self.store = {}
+        self.resource_version = None
+        self.synced = False
+        self.handlers = []
+
+    def add_handler(self, handler):
+        self.handlers.append(handler)
+
+    def start(self):
+        t = threading.Thread(target=self._run)
+        t.daemon = True
+        t.start()
+
+    def has_synced(self):
+        return self.synced
+
+    def get(self, name):
+        with self.lock:
+            obj = self.store.get(name, None)
+
+        return copy.deepcopy(obj)
+
+    def list(self, predicate=None):
+        with self.lock:
+            objs = [o for o in self.store.values() if not predicate or predicate(o)]
+
+        return copy.deepcopy(objs)
+
+    def set(self, obj):
+        # Objects returned by our own updates are newer than the
+        # cached ones, don't wait for the watch to deliver them
+        with self.lock:
+            self.store[obj['metadata']['name']] = copy.deepcopy(obj)
+
+    def _notify(self, event_type, obj):
+        for h in self.handlers:
+            try:
+                h(event_type, obj)
+            except Exception as e:
+                self.logger.exception(e)
+
+    def _params(self):
+        params = {}
+        if self.label_selector:
+            params['labelSelector'] = self.label_selector
+
+        return params
+
+    def _list(self):
+        h = {'Authorization': 'Bearer %s' % self.args.token}
+        r = self.args.session.get(self.args.api_server + self.path,
+                                  headers=h,
+                                  params=self._params(),
+                                  timeout=30)
+
+        if r.status_code != 200:
+            raise APIException(r)
+
+        data = r.json()
+        store = {}
+        for obj in data.get('items', []):
+            store[obj['metadata']['name']] = obj
+
+        with self.lock:
+            deleted = [o for n, o in self.store.items() if n not in store]
+            self.store = store
+
+        self.resource_version = data['metadata']['resourceVersion']
+        self.synced = True
+
+        for obj in deleted:
+            self._notify('DELETED', obj)
+
+        self._resync()
+
+    def _resync(self):
+        for obj in self.list():
+            self._notify('SYNC', obj)
+
+    def _watch(self):
+        h = {'Authorization': 'Bearer %s' % self.args.token}
+        params = self._params()
+        params['watch'] = 'true'
+        params['allowWatchBookmarks'] = 'true'
+        params['resourceVersion'] = self.resource_version
+        params['timeoutSeconds'] = self.resync_period
+
+        r = self.args.session.get(self.args.api_server + self.path,
+                                  headers=h,
+                                  params=params,
+                                  stream=True,
+                                  timeout=(10, self.resync_period + 30))
+
+        if r.status_code != 200:
+            raise APIException(r)
+
+        for line in r.iter_lines():
+            if not line:
+                continue
+
+            event = json.loads(line)
+            event_type = event['type']
+            obj = event['object']
+
+            if event_type == 'ERROR':
+                if obj.get('code', None) == 410:
+                    # resourceVersion is too old, we have to list again
+                    self.logger.info('Watch of %s expired', self.path)
+                    self.resource_version = None
+                    return
+
+                raise Exception(obj.get('message', 'Watch error'))
+
+            self.resource_version = obj['metadata']['resourceVersion']
+
+            if event_type == 'BOOKMARK':
+                continue
+
+            name = obj['metadata']['name']
+            with self.lock:
+                if event_type == 'DELETED':
+                    self.store.pop(name, None)
+                else:
+                    self.store[name] = obj
+
+            self._notify(event_type, obj)
+
+    def _run(self):
+        while True:
+            try:
+                if not self.resource_version:
+                    self._list()
+                else:
+                    self._watch()
+                    self._resync()
+            except Exception as e:
+                self.logger.exception(e)
+                self.resource_version = None
+                time.sleep(1)
+
+def create_session(pool_size):
+    # Keep-alive connections to the api server shared by all controllers
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def get_limit(limits, name, default):
+    # Limits which are not numeric, like '1Gi', were not validated
+    # and count with the default
+    value = limits.get(name, default)
+
+    if not isinstance(value, (int, float)):
+        return default
+
+    return value
+
+def get_resource_limits(definition):
+    limits = {}
+    if definition:
+        limits = definition.get('resources', {}).get('limits', {})
+
+    memory = get_limit(limits, 'memory', 1024)
+    cpu = get_limit(limits, 'cpu', 1)
+
+    return cpu, memory
+
 class Controller(object):
     def __init__(self, args, resource):
         self.args = args
+        self.pool = ThreadPool(args.workers)
         self.namespace = get_env("INFRABOX_GENERAL_WORKER_NAMESPACE")
         self.logger = get_logger("controller")
         self.resource = resource
+        self.queue = WorkQueue()
+        self.informer = Informer(args, '/apis/core.infrabox.net/v1alpha1/namespaces/%s/%s' % (self.namespace,
+                                                                                              self.resource))
+        self.informer.add_handler(self._enqueue)
+        self.informers = [self.informer]
+
+    def _enqueue(self, _, obj):
+        self.queue.add(obj['metadata']['name'])
+
+    def start(self):
+        for i in self.informers:
+            i.start()
 
     def _get(self, url):
         h = {'Authorization': 'Bearer %s' % self.args.token}
         self.logger.debug('GET: %s', url)
-        r = requests.get(url, headers=h, timeout=10)
+        r = self.args.session.get(url, headers=h, timeout=10)
 
         if r.status_code == 404:
             return None
@@ -45,7 +257,7 @@ class Controller(object):
     def _update(self, url, data):
         h = {'Authorization': 'Bearer %s' % self.args.token}
         self.logger.debug('PUT: %s', url)
-        r = requests.put(url, headers=h, json=data, timeout=10)
+        r = self.args.session.put(url, headers=h, json=data, timeout=10)
 
         if r.status_code != 200:
             raise APIException(r)
@@ -56,7 +268,7 @@ class Controller(object):
     def _create(self, url, data):
         h = {'Authorization': 'Bearer %s' % self.args.token}
         self.logger.debug('POST: %s', url)
-        r = requests.post(url, headers=h, json=data, timeout=10)
+        r = self.args.session.post(url, headers=h, json=data, timeout=10)
 
         if r.status_code == 409:
             # Already exists
@@ -71,7 +283,7 @@ class Controller(object):
     def _delete(self, url):
         h = {'Authorization': 'Bearer %s' % self.args.token}
         self.logger.debug('DELETE: %s', url)
-        r = requests.delete(url, headers=h, timeout=10)
+        r = self.args.session.delete(url, headers=h, timeout=10)
 
         if r.status_code == 404:
             # does not exist
@@ -89,7 +301,9 @@ class Controller(object):
 
         fi['metadata']['finalizers'] = finalizers
         url = self._get_url(fi)
-        return self._update(url, fi)
+        fi = self._update(url, fi)
+        self.informer.set(fi)
+        return fi
 
     def _get_url(self, fi):
         url = '%s/apis/core.infrabox.net/v1alpha1/namespaces/%s/%s/%s' % (self.args.api_server,
@@ -99,32 +313,49 @@ class Controller(object):
         return url
 
     def handle(self):
-        url = '%s/apis/core.infrabox.net/v1alpha1/namespaces/%s/%s' % (self.args.api_server,
-                                                                       self.namespace,
-                                                                       self.resource)
-        data = self._get(url)
+        for i in self.informers:
+            if not i.has_synced():
+                return
+
+        # Every key is only once in the queue, so an object is never
+        # synced by two workers at the same time
+        self.pool.map(self._reconcile, self.queue.get_all())
+
+    def _reconcile(self, name):
+        fi = self.informer.get(name)
 
-        if 'items' not in data:
+        if not fi:
+            # already deleted
             return
 
-        for fi in data['items']:
-            try:
-                before = json.dumps(fi.get('status', {})) + json.dumps(fi['metadata'].get('finalizers', {}))
-                if fi['metadata'].get('deletionTimestamp', None):
-                    fi = self._sync_delete(fi)
-                else:
-                    fi = self._sync(fi)
+        try:
+            before = json.dumps(fi.get('status', {})) + json.dumps(fi['metadata'].get('finalizers', {}))
+            if fi['metadata'].get('deletionTimestamp', None):
+                fi = self._sync_delete(fi)
+            else:
+                fi = self._sync(fi)
 
-                url = self._get_url(fi)
-                after = json.dumps(fi.get('status', {})) + json.dumps(fi['metadata'].get('finalizers', {}))
+            url = self._get_url(fi)
+            after = json.dumps(fi.get('status', {})) + json.dumps(fi['metadata'].get('finalizers', {}))
 
-                if before != after:
-                    self._update(url, fi)
-            except APIException as e:
-                self.logger.exception(e)
-                self.logger.warn(e.result.text)
-            except Exception as e:
-                self.logger.exception(e)
+            if before != after:
+                fi = self._update(url, fi)
+                self.informer.set(fi)
+
+            if self._requeue(fi):
+                self.queue.add(name)
+        except APIException as e:
+            self.logger.exception(e)
+            self.logger.warn(e.result.text)
+            self.queue.add(name)
+        except Exception as e:
+            self.logger.exception(e)
+            self.queue.add(name)
+
+    def _requeue(self, _):
+        # Whether the object depends on resources which are not watched
+        # and has to be synced again in the next run
+        return False
 
     def _sync(self, _):
         assert False
@@ -133,9 +364,16 @@ class Controller(object):
         assert False
 
 class PipelineInvocationController(Controller):
-    def __init__(self, args):
+    def __init__(self, args, function_informer):
         super(PipelineInvocationController, self).__init__(args, 'ibpipelineinvocations')
         self.pipelines = {}
+        self.function_informer = function_informer
+        self.informers.append(function_informer)
+
+    def _requeue(self, pi):
+        # Services and function invocations are checked on every run
+        # until the pipeline invocation is done
+        return pi.get('status', {}).get('state', None) not in ('error', 'terminated')
 
     def _get_pipeline(self, pi):
         if pi['spec']['pipelineName'] not in self.pipelines:
@@ -294,50 +532,50 @@ class PipelineInvocationController(Controller):
             step_invocation = pi['spec']['steps'][step['name']]
 
             fi_name = pi['metadata']['name'] + '-' + step['name']
-            fi = {
-                'apiVersion': 'core.infrabox.net/v1alpha1',
-                'kind': 'IBFunctionInvocation',
-                'metadata': {
-                    'name': fi_name,
-                    'namespace': pi['metadata']['namespace']
-                },
-                'spec': {
-                    'functionName': step['functionName'],
-                    'env': step_invocation['env'],
-                    'volumes': [],
-                    'volumeMounts': []
+            fi = self.function_informer.get(fi_name)
+
+            if not fi:
+                fi = {
+                    'apiVersion': 'core.infrabox.net/v1alpha1',
+                    'kind': 'IBFunctionInvocation',
+                    'metadata': {
+                        'name': fi_name,
+                        'namespace': pi['metadata']['namespace']
+                    },
+                    'spec': {
+                        'functionName': step['functionName'],
+                        'env': step_invocation['env'],
+                        'volumes': [],
+                        'volumeMounts': []
+                    }
                 }
-            }
 
-            if step_invocation.get('resources', None):
-                fi['spec']['resources'] = step_invocation['resources']
+                if step_invocation.get('resources', None):
+                    fi['spec']['resources'] = step_invocation['resources']
 
-            if pi['spec'].get('services', None):
-                for j, s in enumerate(pi['spec']['services']):
-                    name = '%s-%s' % (pi['metadata']['name'], j)
-                    fi['spec']['volumes'] += [{
-                        'name': name,
-                        'secret': {
-                            'secretName': name
-                        }
-                    }]
-
-                    fi['spec']['volumeMounts'] += [{
-                        'name':  name,
-                        'mountPath': '/var/run/infrabox.net/services/' + s['metadata']['name']
-                    }]
+                if pi['spec'].get('services', None):
+                    for j, s in enumerate(pi['spec']['services']):
+                        name = '%s-%s' % (pi['metadata']['name'], j)
+                        fi['spec']['volumes'] += [{
+                            'name': name,
+                            'secret': {
+                                'secretName': name
+                            }
+                        }]
 
-            url = '%s/apis/core.infrabox.net/v1alpha1/namespaces/%s/ibfunctioninvocations/' % (self.args.api_server,
-                                                                                               self.namespace)
-            self._create(url, fi)
+                        fi['spec']['volumeMounts'] += [{
+                            'name':  name,
+                            'mountPath': '/var/run/infrabox.net/services/' + s['metadata']['name']
+                        }]
 
-            url = '%s/apis/core.infrabox.net/v1alpha1/namespaces/%s/ibfunctioninvocations/%s' % (self.args.api_server,
-                                                                                                 self.namespace,
-                                                                                                 fi_name)
+                url = '%s/apis/core.infrabox.net/v1alpha1/namespaces/%s/ibfunctioninvocations/' % (self.args.api_server,
+                                                                                                   self.namespace)
+                fi = self._create(url, fi)
 
-            fi = self._get(url)
+                if fi:
+                    self.function_informer.set(fi)
 
-            if fi.get('status', None):
+            if fi and fi.get('status', None):
                 pi['status']['stepStatuses'][i] = fi['status']
 
                 if fi['status'].get('state', {}).get('terminated', None):
@@ -404,6 +642,18 @@ class FunctionInvocationController(Controller):
     def __init__(self, args):
         super(FunctionInvocationController, self).__init__(args, 'ibfunctioninvocations')
         self.functions = {}
+        self.pod_informer = Informer(args, '/api/v1/namespaces/%s/pods' % self.namespace,
+                                     label_selector='function.infrabox.net/function-invocation-name')
+        self.pod_informer.add_handler(self._enqueue_pod)
+        self.informers.append(self.pod_informer)
+
+    def _enqueue_pod(self, _, pod):
+        self.queue.add(pod['metadata']['labels']['function.infrabox.net/function-invocation-name'])
+
+    def _get_pods(self, fi):
+        name = fi['metadata']['name']
+        return self.pod_informer.list(
+            lambda p: p['metadata']['labels'].get('function.infrabox.net/function-invocation-name', None) == name)
 
     def _get_function(self, fi):
         if fi['spec']['functionName'] not in self.functions:
@@ -420,11 +670,7 @@ class FunctionInvocationController(Controller):
                                                           fi['metadata']['name'])
         self._delete(url)
 
-        url = '%s/api/v1/namespaces/%s/pods?labelSelector=function.infrabox.net/function-invocation-name=%s' % (self.args.api_server,
-                                                                                                                self.namespace,
-                                                                                                                fi['metadata']['name'])
-        pods = self._get(url)
-        for pod in pods['items']:
+        for pod in self._get_pods(fi):
             url = '%s/api/v1/namespaces/%s/pods/%s' % (self.args.api_server,
                                                        self.namespace,
                                                        pod['metadata']['name'])
@@ -498,11 +744,7 @@ class FunctionInvocationController(Controller):
         self._create(url, batch)
 
         # Sync status
-        url = '%s/api/v1/namespaces/%s/pods?labelSelector=function.infrabox.net/function-invocation-name=%s' % (self.args.api_server,
-                                                                                                                self.namespace,
-                                                                                                                fi['metadata']['name'])
-        pods = self._get(url)
-        for pod in pods['items']:
+        for pod in self._get_pods(fi):
             if pod['status'].get('containerStatuses', None):
                 fi['status']['state'] = pod['status']['containerStatuses'][0]['state']
                 fi['status']['nodeName'] = pod['spec']['nodeName']
@@ -524,7 +766,16 @@ class Scheduler(object):
         self.namespace = get_env("INFRABOX_GENERAL_WORKER_NAMESPACE")
         self.logger = get_logger("scheduler")
         self.function_controller = FunctionInvocationController(args)
-        self.pipeline_controller = PipelineInvocationController(args)
+        self.pipeline_controller = PipelineInvocationController(args, self.function_controller.informer)
+        self.event_driven = os.environ.get('INFRABOX_SCHEDULER_EVENT_DRIVEN', 'false') == 'true'
+        self.fallback_interval = float(os.environ.get('INFRABOX_SCHEDULER_FALLBACK_INTERVAL', '30'))
+        self.pending_builds = set()
+        self.blocked_builds = set()
+        self.last_full_schedule = 0
+        self.last_housekeeping = 0
+        self.packing_policy = os.environ.get('INFRABOX_SCHEDULER_PACKING_POLICY', 'none')
+        self.cpu_capacity = 0
+        self.memory_capacity = 0
 
     def handle_function_invocations(self):
         self.function_controller.handle()
@@ -540,14 +791,13 @@ class Scheduler(object):
                                                                                              job_id)
 
         try:
-            r = requests.get(url, headers=h, timeout=5)
-            job = r.json()
+            job = self.pipeline_controller.informer.get(job_id)
 
-            if job['metadata'].get('deletionTimestamp', None):
+            if job and job['metadata'].get('deletionTimestamp', None):
                 # Already marked for deletion, don't delete again to not for an update in the controller
                 return
 
-            requests.delete(url, headers=h, timeout=5)
+            self.args.session.delete(url, headers=h, timeout=5)
         except:
             pass
 
@@ -654,8 +904,8 @@ class Scheduler(object):
             }
         }
 
-        r = requests.post(self.args.api_server + '/apis/core.infrabox.net/v1alpha1/namespaces/%s/ibpipelineinvocations' % self.namespace,
-                          headers=h, json=job, timeout=10)
+        r = self.args.session.post(self.args.api_server + '/apis/core.infrabox.net/v1alpha1/namespaces/%s/ibpipelineinvocations' % self.namespace,
+                                   headers=h, json=job, timeout=10)
 
         if r.status_code != 201:
             self.logger.warn(r.text)
@@ -663,16 +913,7 @@ class Scheduler(object):
 
         return True
 
-    def schedule_job(self, job_id, cpu, memory):
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT definition FROM job j WHERE j.id = %s
-        ''', (job_id,))
-        j = cursor.fetchone()
-        cursor.close()
-
-        definition = j[0]
-
+    def schedule_job(self, job_id, cpu, memory, definition):
         cpu -= 0.2
         self.logger.debug("Scheduling job to kubernetes")
 
@@ -691,59 +932,74 @@ class Scheduler(object):
         self.logger.debug("Finished scheduling job")
         self.logger.debug("")
 
-    def schedule(self):
-        # find jobs
+    def schedule(self, build_ids=None):
+        # find jobs together with the states of their parents
+        build_filter = ''
+        args = [os.environ['INFRABOX_CLUSTER_NAME']]
+
+        if build_ids is not None and self.packing_policy == 'critical-path':
+            # The ranking needs all ready jobs of the cluster, otherwise the jobs
+            # of the notified builds would overtake more important ones
+            build_ids = None
+
+        if build_ids is not None:
+            build_filter = 'AND j.build_id = ANY(%s::uuid[])'
+            args.append(list(build_ids))
+
         cursor = self.conn.cursor()
         cursor.execute('''
-            SELECT j.id, j.type, j.dependencies, j.definition
+            SELECT j.id, j.type, j.dependencies, j.definition,
+                   json_agg(json_build_array(p.id, p.state)) FILTER (WHERE p.id IS NOT NULL),
+                   j.build_id, j.project_id
             FROM job j
-            WHERE j.state = 'queued' and cluster_name = %s
+            LEFT JOIN LATERAL jsonb_array_elements(j.dependencies) deps
+                ON true
+            LEFT JOIN job p
+                ON p.id = (deps->>'job-id')::uuid
+            WHERE j.state = 'queued' and j.cluster_name = %s
+            ''' + build_filter + '''
+            GROUP BY j.id
             ORDER BY j.created_at
-        ''', [os.environ['INFRABOX_CLUSTER_NAME']])
+        ''', args)
         jobs = cursor.fetchall()
         cursor.close()
 
+        if build_ids is None:
+            self.blocked_builds.clear()
+        else:
+            self.blocked_builds.difference_update(build_ids)
+
         if not jobs:
             # No queued job
             return
 
+        # States decided during this run, so children of skipped
+        # or finished wait jobs don't have to wait for the next run
+        decided = {}
+        skipped = []
+        finished = []
+        ready = []
+
         # check dependecies
         for j in jobs:
             job_id = j[0]
             job_type = j[1]
             dependencies = j[2]
             definition = j[3]
-
-            limits = {}
-            if definition:
-                limits = definition.get('resources', {}).get('limits', {})
-
-            memory = limits.get('memory', 1024)
-            cpu = limits.get('cpu', 1)
+            parents = j[4] or []
+            build_id = j[5]
+            project_id = j[6]
 
             self.logger.debug("")
             self.logger.debug("Starting to schedule job: %s", job_id)
             self.logger.debug("Dependencies: %s", dependencies)
 
-            cursor = self.conn.cursor()
-            cursor.execute('''
-                SELECT id, state
-                FROM job
-                WHERE id IN (
-                    SELECT (deps->>'job-id')::uuid
-                    FROM job, jsonb_array_elements(job.dependencies) as deps
-                    WHERE id = %s
-                )
-            ''', (job_id,))
-            result = cursor.fetchall()
-            cursor.close()
-
-            self.logger.debug("Parent states: %s", result)
+            parent_states = [(p[0], decided.get(p[0], p[1])) for p in parents]
+            self.logger.debug("Parent states: %s", parent_states)
 
             # check if there's still some parent running
             parents_running = False
-            for r in result:
-                parent_state = r[1]
+            for _, parent_state in parent_states:
                 if parent_state in ('running', 'scheduled', 'queued'):
                     # dependencies not ready
                     parents_running = True
@@ -754,11 +1010,9 @@ class Scheduler(object):
                 continue
 
             # check if conditions are met
-            skipped = False
-            for r in result:
+            conditions_met = True
+            for parent_id, parent_state in parent_states:
                 on = None
-                parent_id = r[0]
-                parent_state = r[1]
                 for dep in dependencies:
                     if dep['job-id'] == parent_id:
                         on = dep['on']
@@ -770,28 +1024,162 @@ class Scheduler(object):
 
                 if parent_state not in on:
                     self.logger.debug("Condition is not met, skipping job")
-                    skipped = True
-                    # dependency error, don't run this job_id
-                    cursor = self.conn.cursor()
-                    cursor.execute(
-                        "UPDATE job SET state = 'skipped' WHERE id = (%s)", (job_id,))
-                    cursor.close()
+                    conditions_met = False
                     break
 
-            if skipped:
+            if not conditions_met:
+                # dependency error, don't run this job_id
+                decided[job_id] = 'skipped'
+                skipped.append(job_id)
                 continue
 
             # If it's a wait job we are done here
             if job_type == "wait":
                 self.logger.debug("Wait job, we are done")
-                cursor = self.conn.cursor()
-                cursor.execute('''
-                    UPDATE job SET state = 'finished', start_date = now(), end_date = now() WHERE id = %s;
-                ''', (job_id,))
-                cursor.close()
+                decided[job_id] = 'finished'
+                finished.append(job_id)
                 continue
 
-            self.schedule_job(job_id, cpu, memory)
+            ready.append((job_id, definition, build_id, project_id))
+
+        cursor = self.conn.cursor()
+        if skipped:
+            cursor.execute('''
+                UPDATE job SET state = 'skipped' WHERE id = ANY(%s::uuid[])
+            ''', [skipped])
+
+        if finished:
+            cursor.execute('''
+                UPDATE job SET state = 'finished', start_date = now(), end_date = now() WHERE id = ANY(%s::uuid[])
+            ''', [finished])
+        cursor.close()
+
+        admitted = self.admit(ready)
+        admitted_ids = set(r[0] for r in admitted)
+
+        # Builds with ready jobs which did not fit into the cluster are
+        # checked again as soon as any job changes its state
+        self.blocked_builds.update(r[2] for r in ready if r[0] not in admitted_ids)
+
+        for job_id, definition, _, _ in admitted:
+            cpu, memory = get_resource_limits(definition)
+            self.schedule_job(job_id, cpu, memory, definition)
+
+    def get_allocated_resources(self):
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT definition
+            FROM job
+            WHERE state IN ('scheduled', 'running')
+            AND cluster_name = %s
+        ''', [os.environ['INFRABOX_CLUSTER_NAME']])
+        jobs = cursor.fetchall()
+        cursor.close()
+
+        cpu = 0
+        memory = 0
+        for definition, in jobs:
+            job_cpu, job_memory = get_resource_limits(definition)
+            cpu += job_cpu
+            memory += job_memory
+
+        return cpu, memory
+
+    def get_critical_paths(self):
+        # Longest remaining path through the dependency graph of the
+        # queued jobs, based on their average duration in previous builds
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT j.id, j.dependencies, coalesce(s.avg_duration, (j.definition->>'avg_duration')::real, 0)
+            FROM job j
+            LEFT OUTER JOIN job_stats s
+                ON s.project_id = j.project_id
+                AND s.name = j.name
+                AND s.branch = ''
+            WHERE j.state = 'queued'
+            AND j.cluster_name = %s
+        ''', [os.environ['INFRABOX_CLUSTER_NAME']])
+        jobs = cursor.fetchall()
+        cursor.close()
+
+        durations = {}
+        children = {}
+        for job_id, dependencies, avg_duration in jobs:
+            durations[job_id] = avg_duration
+            for dep in dependencies or []:
+                children.setdefault(dep['job-id'], []).append(job_id)
+
+        paths = {}
+
+        def get_path(job_id):
+            if job_id in paths:
+                return paths[job_id]
+
+            paths[job_id] = 0  # guard against cycles
+            longest = 0
+            for c in children.get(job_id, []):
+                longest = max(longest, get_path(c))
+
+            paths[job_id] = durations.get(job_id, 0) + longest
+            return paths[job_id]
+
+        for job_id in durations:
+            get_path(job_id)
+
+        return paths
+
+    def prioritize(self, ready):
+        # Jobs on the longest path of their build are started first. The projects
+        # take turns, so a large build can not starve the builds of other projects.
+        paths = self.get_critical_paths()
+
+        by_project = {}
+        for r in ready:
+            by_project.setdefault(r[3], []).append(r)
+
+        ranked = []
+        for jobs in by_project.values():
+            jobs.sort(key=lambda r: paths.get(r[0], 0), reverse=True)
+            for rank, r in enumerate(jobs):
+                ranked.append((rank, -paths.get(r[0], 0), r))
+
+        ranked.sort(key=lambda r: (r[0], r[1]))
+        return [r[2] for r in ranked]
+
+    def admit(self, ready):
+        # Only start as many jobs as fit into the free capacity of the cluster,
+        # the others stay queued until running jobs finish
+        if self.packing_policy == 'none' or not ready:
+            return ready
+
+        if self.packing_policy == 'first-fit-decreasing':
+            ready = sorted(ready, key=lambda r: get_resource_limits(r[1]), reverse=True)
+        elif self.packing_policy == 'critical-path':
+            ready = self.prioritize(ready)
+        elif self.packing_policy != 'first-fit':
+            self.logger.warn('Unknown packing policy: %s', self.packing_policy)
+
+        allocated_cpu, allocated_memory = self.get_allocated_resources()
+        free_cpu = self.cpu_capacity - allocated_cpu
+        # memory capacity is in Ki, job limits in Mi
+        free_memory = self.memory_capacity / 1024.0 - allocated_memory
+
+        admitted = []
+        for r in ready:
+            cpu, memory = get_resource_limits(r[1])
+
+            if cpu <= free_cpu and memory <= free_memory:
+                free_cpu -= cpu
+                free_memory -= memory
+                admitted.append(r)
+            elif allocated_cpu == 0 and not admitted:
+                # Job is larger than the whole cluster, don't let it wait forever
+                self.logger.warn('Job %s requires more resources than available in the cluster', r[0])
+                admitted.append(r)
+                break
+
+        self.logger.debug('Admitted %s of %s ready jobs', len(admitted), len(ready))
+        return admitted
 
     def handle_aborts(self):
         cursor = self.conn.cursor()
@@ -872,15 +1260,23 @@ class Scheduler(object):
                """, [job_id])
             lines = cursor.fetchall()
 
-            output = ""
-            for l in lines:
-                output += l[0]
+            output = "".join(l[0] for l in lines)
 
             if output:
+                # Stored as compressed chunks, so parts of it can be read
+                rows = ','.join(cursor.mogrify("(%s, %s, %s, %s, %s, %s, %s)",
+                                               [job_id, c['chunk'], c['byte_offset'], c['first_line'],
+                                                c['lines'], c['size'], psycopg2.Binary(c['data'])]).decode('utf-8')
+                                for c in create_chunks(output))
+
+                cursor.execute("DELETE FROM console_chunk WHERE job_id = %s", [job_id])
+                cursor.execute("""
+                               INSERT INTO console_chunk (job_id, chunk, byte_offset, first_line, lines, size, data)
+                               VALUES """ + rows)
                 cursor.execute("""
-                               UPDATE job SET console = %s WHERE id = %s;
                                DELETE FROM console WHERE job_id = %s;
-                           """, [output, job_id, job_id])
+                               DELETE FROM console_stats WHERE job_id = %s;
+                           """, [job_id, job_id])
             cursor.execute("commit")
         except Exception as e:
             self.logger.error(e)
@@ -892,34 +1288,32 @@ class Scheduler(object):
     def handle_orphaned_jobs(self):
         self.logger.debug("Handling orphaned jobs")
 
-        h = {'Authorization': 'Bearer %s' % self.args.token}
-        r = requests.get(self.args.api_server + '/apis/core.infrabox.net/v1alpha1/namespaces/%s/ibpipelineinvocations' % self.namespace,
-                         headers=h,
-                         timeout=10)
-        data = r.json()
+        if not self.pipeline_controller.informer.has_synced():
+            return
 
-        if 'items' not in data:
+        items = self.pipeline_controller.informer.list()
+
+        if not items:
             return
 
-        for j in data['items']:
-            if 'metadata' not in j:
-                continue
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT id, state FROM job WHERE id = ANY(%s::uuid[])
+        ''', ([j['metadata']['name'] for j in items],))
+        states = dict(cursor.fetchall())
+        cursor.close()
 
+        for j in items:
             metadata = j['metadata']
             name = metadata['name']
             job_id = name
 
-            cursor = self.conn.cursor()
-            cursor.execute('''SELECT state FROM job where id = %s''', (job_id,))
-            result = cursor.fetchall()
-            cursor.close()
-
-            if not result:
+            if job_id not in states:
                 self.logger.debug('Deleting orphaned job %s', job_id)
                 self.kube_delete_job(job_id)
                 continue
 
-            last_state = result[0][0]
+            last_state = states[job_id]
             if last_state in ('killed', 'finished', 'error', 'failure'):
                 self.kube_delete_job(job_id)
                 continue
@@ -1054,9 +1448,9 @@ class Scheduler(object):
         root_url = os.environ['INFRABOX_ROOT_URL']
 
         h = {'Authorization': 'Bearer %s' % self.args.token}
-        r = requests.get(self.args.api_server + '/api/v1/nodes',
-                         headers=h,
-                         timeout=10)
+        r = self.args.session.get(self.args.api_server + '/api/v1/nodes',
+                                  headers=h,
+                                  timeout=10)
         data = r.json()
 
         memory = 0
@@ -1079,6 +1473,9 @@ class Scheduler(object):
             mem = mem.replace('Ki', '')
             memory += int(mem)
 
+        self.cpu_capacity = cpu
+        self.memory_capacity = memory
+
         cursor = self.conn.cursor()
         cursor.execute("""
             INSERT INTO cluster (name, labels, root_url, nodes, cpu_capacity, memory_capacity, active)
@@ -1101,7 +1498,13 @@ class Scheduler(object):
 
         return not (active and enabled)
 
-    def handle(self):
+    def handle_housekeeping(self):
+        # Events wake up the scheduler more often than once a second,
+        # the housekeeping keeps its interval of one second
+        if time.time() - self.last_housekeeping < 1:
+            return
+
+        self.last_housekeeping = time.time()
         self.update_cluster_state()
 
         try:
@@ -1113,6 +1516,9 @@ class Scheduler(object):
         except Exception as e:
             self.logger.exception(e)
 
+    def handle(self):
+        self.handle_housekeeping()
+
         cluster_name = os.environ['INFRABOX_CLUSTER_NAME']
         ha_mode = os.environ['INFRABOX_HA_ENABLED'] == "true"
 
@@ -1126,14 +1532,74 @@ class Scheduler(object):
         elif cluster_name == 'master':
             self.assign_cluster()
 
-        self.schedule()
+        if not self.event_driven:
+            self.schedule()
+            return
+
+        if time.time() - self.last_full_schedule > self.fallback_interval:
+            # Safety net for changes which did not trigger a notification,
+            # i.e. jobs assigned to this cluster by another scheduler
+            self.pending_builds.clear()
+            self.last_full_schedule = time.time()
+            self.schedule()
+        elif self.pending_builds:
+            # A finished job may have freed the capacity a blocked build is waiting for
+            build_ids = self.pending_builds | self.blocked_builds
+            self.pending_builds = set()
+            self.schedule(build_ids)
+
+    def wait_for_events(self, timeout):
+        # Wait until an event which may make a job ready arrives or the timeout expires
+        deadline = time.time() + timeout
+
+        while True:
+            if not self.conn.notifies:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+
+                if select.select([self.conn], [], [], remaining) == ([], [], []):
+                    return
+
+            self.conn.poll()
+            relevant = False
+            while self.conn.notifies:
+                n = self.conn.notifies.pop(0)
+                event = json.loads(n.payload)
+
+                if event.get('state', None) in ('scheduled', 'running'):
+                    # Can't make any other job ready
+                    continue
+
+                relevant = True
+                build_id = event.get('build_id', None)
+                if build_id:
+                    self.pending_builds.add(build_id)
+                else:
+                    # Payload of an old trigger version, fall back to a full run
+                    self.last_full_schedule = 0
+
+            if relevant:
+                return
 
     def run(self):
         self.logger.info("Starting scheduler")
 
+        self.function_controller.start()
+        self.pipeline_controller.start()
+
+        if self.event_driven:
+            cursor = self.conn.cursor()
+            cursor.execute("LISTEN job_update")
+            cursor.close()
+
         while True:
             self.handle()
-            time.sleep(1)
+
+            if self.event_driven:
+                self.wait_for_events(1)
+            else:
+                time.sleep(1)
 
 def main():
     # Arguments
@@ -1157,6 +1623,10 @@ def main():
     args.api_server = "https://" + get_env('INFRABOX_KUBERNETES_MASTER_HOST') \
                                  + ":" + get_env('INFRABOX_KUBERNETES_MASTER_PORT')
 
+    args.workers = int(os.environ.get('INFRABOX_SCHEDULER_WORKERS', '10'))
+    # One connection for every worker of the two controllers, the main loop and the three watches
+    args.session = create_session(2 * args.workers + 4)
+
     os.environ['REQUESTS_CA_BUNDLE'] = '/var/run/secrets/kubernetes.io/serviceaccount/ca.crt'
 
     conn = connect_db()